@@ -19,10 +19,31 @@ from datetime import datetime, timedelta
 from sqlalchemy import create_engine
 import warnings
 import ssl
+import os
+import re
+import json
+import hashlib
+import shutil
+import numbers
+import unicodedata
+import io
+import html
+import zipfile
+import threading
+import itertools
+import time
+import copy
+import inspect
+import functools
+from queue import PriorityQueue
+from collections import OrderedDict
+from concurrent.futures import Future, ThreadPoolExecutor, wait, FIRST_COMPLETED
+from streamlit.runtime.scriptrunner import add_script_run_ctx, get_script_run_ctx
 from sklearn.ensemble import IsolationForest, RandomForestClassifier
 from sklearn.preprocessing import StandardScaler
 from sklearn.cluster import KMeans
 import joblib
+from scipy import sparse
 
 # Configurações SSL
 try:
@@ -444,6 +465,38 @@ def criar_info_box(titulo, descricao):
     </div>
     """
 
+def obter_cursor_pagina(chave, assinatura):
+    """Retorna o cursor da página atual de uma listagem; volta à primeira página se os filtros mudarem."""
+    estado = st.session_state.get(chave)
+    if estado is None or estado['assinatura'] != assinatura:
+        estado = {'assinatura': assinatura, 'cursores': [None]}
+        st.session_state[chave] = estado
+    return estado['cursores'][-1], len(estado['cursores'])
+
+def exibir_controles_paginacao(chave, proximo_cursor):
+    """Exibe os botões Anterior/Próxima de uma listagem paginada por cursor."""
+    estado = st.session_state[chave]
+    col1, col2, col3 = st.columns([1, 1, 4])
+
+    with col1:
+        if st.button("◀ Anterior", key=f"{chave}_anterior", disabled=len(estado['cursores']) == 1):
+            estado['cursores'].pop()
+            st.rerun()
+
+    with col2:
+        if st.button("Próxima ▶", key=f"{chave}_proxima", disabled=proximo_cursor is None):
+            estado['cursores'].append(proximo_cursor)
+            st.rerun()
+
+    with col3:
+        st.caption(f"Página {len(estado['cursores'])}")
+
+def enviar_para_dossie(cnpjs):
+    """Leva uma lista de CNPJs para o dossiê em lote da página de Detalhamento de Empresa."""
+    st.session_state['cnpjs_dossie'] = [str(cnpj) for cnpj in cnpjs]
+    st.session_state['force_page'] = "🏢 Detalhamento de Empresa"
+    st.rerun()
+
 # =============================================================================
 # 5. FUNÇÕES DE CONEXÃO COM BANCO DE DADOS
 # =============================================================================
@@ -480,11 +533,322 @@ def get_impala_engine():
         st.error(f"❌ Erro ao criar engine Impala: {e}")
         return None
 
+# =============================================================================
+# MOTOR DE REGRAS DE RISCO
+# =============================================================================
+# Regras declarativas avaliadas em arrays NumPy e traduzidas para SQL.
+# Cada regra é avaliada na ordem das faixas (a primeira que casar vale), como
+# um CASE WHEN; valores nulos não pontuam.
+
+# Score de risco financeiro (ecd_score_risco_consolidado)
+REGRAS_RISCO_FINANCEIRO = {
+    'liquidez_corrente': {'operador': '<', 'faixas': [(1.0, 3), (1.5, 1)]},
+    'endividamento_geral': {'operador': '>', 'faixas': [(0.8, 3), (0.6, 1)]},
+    'margem_liquida_perc': {'operador': '<', 'faixas': [(0, 2)]}
+}
+
+# Score usado quando ecd_score_risco_consolidado não está disponível
+REGRAS_RISCO_FALLBACK = {
+    'liquidez_corrente': {'operador': '<', 'faixas': [(0.5, 3), (1.0, 2)]},
+    'endividamento_geral': {'operador': '>', 'faixas': [(0.9, 3), (0.7, 2)]},
+    'margem_liquida_perc': {'operador': '<', 'faixas': [(-10, 3), (0, 1)]}
+}
+
+PESOS_SCORE_TOTAL = {
+    'score_equacao_contabil': 0.30,
+    'score_neaf': 0.30,
+    'score_risco_financeiro': 0.40
+}
+
+# Faixas de classificação (limite mínimo, rótulo), da maior para a menor
+CLASSIFICACAO_RISCO = [(7, 'RISCO CRÍTICO'), (5, 'RISCO ALTO'), (3, 'RISCO MODERADO')]
+CLASSIFICACAO_RISCO_PADRAO = 'RISCO BAIXO'
+
+CLASSIFICACAO_RISCO_FALLBACK = [(7, 'Muito Alto'), (5, 'Alto'), (3, 'Médio')]
+CLASSIFICACAO_RISCO_FALLBACK_PADRAO = 'Baixo'
+
+# Prioridade de fiscalização (1 = mais urgente)
+REGRAS_PRIORIDADE = {
+    'score_critico': 7,
+    'ativo_relevante': 100000000,
+    'faixas': [(5, 3), (3, 4)],
+    'padrao': 5
+}
+
+_OPERADORES = {
+    '<': np.less,
+    '<=': np.less_equal,
+    '>': np.greater,
+    '>=': np.greater_equal
+}
+
+def _arredondar(valores, casas=2):
+    """Arredonda como o ROUND do Impala (meio para longe do zero)."""
+    fator = 10 ** casas
+    return np.sign(valores) * np.floor(np.abs(valores) * fator + 0.5) / fator
+
+def pontuar_regras(dados, regras):
+    """Soma os pontos das regras para cada linha (dados: DataFrame ou dict de arrays)."""
+    total = None
+    for coluna, regra in regras.items():
+        valores = np.asarray(dados[coluna], dtype='float64')
+        comparar = _OPERADORES[regra['operador']]
+        with np.errstate(invalid='ignore'):
+            condicoes = [comparar(valores, limite) for limite, _ in regra['faixas']]
+        pontos = np.select(condicoes, [p for _, p in regra['faixas']], default=0)
+        total = pontos if total is None else total + pontos
+    return total
+
+def calcular_score_total(dados, pesos=None):
+    """Combina os componentes do score com os pesos informados."""
+    pesos = pesos or PESOS_SCORE_TOTAL
+    total = 0.0
+    for coluna, peso in pesos.items():
+        total = total + np.nan_to_num(np.asarray(dados[coluna], dtype='float64')) * peso
+    return _arredondar(total, 2)
+
+def classificar_score(score, faixas=None, padrao=None):
+    """Classifica o score pelas faixas (limite mínimo, rótulo)."""
+    if faixas is None:
+        faixas, padrao = CLASSIFICACAO_RISCO, CLASSIFICACAO_RISCO_PADRAO
+    limites = [limite for limite, _ in reversed(faixas)]
+    rotulos = np.array([padrao] + [rotulo for _, rotulo in reversed(faixas)], dtype=object)
+    score = np.asarray(score, dtype='float64')
+    indices = np.where(np.isnan(score), 0, np.digitize(score, limites))
+    return rotulos[indices]
+
+def calcular_prioridade(score, ativo, regras=None):
+    """Calcula a prioridade de fiscalização a partir do score e do ativo total."""
+    regras = regras or REGRAS_PRIORIDADE
+    score = np.asarray(score, dtype='float64')
+    ativo = np.nan_to_num(np.asarray(ativo, dtype='float64'))
+    critico = score >= regras['score_critico']
+    relevante = ativo >= regras['ativo_relevante']
+    condicoes = [critico & relevante, critico | relevante]
+    escolhas = [1, 2]
+    for limite, prioridade in regras['faixas']:
+        condicoes.append(score >= limite)
+        escolhas.append(prioridade)
+    return np.select(condicoes, escolhas, default=regras['padrao'])
+
+def pontuar_empresas(df, regras=None, pesos=None, faixas=None, padrao=None, regras_prioridade=None):
+    """Recalcula score financeiro, score total, classificação e prioridade de um DataFrame."""
+    df = df.copy()
+    if regras is not None or 'score_risco_financeiro' not in df.columns:
+        df['score_risco_financeiro'] = pontuar_regras(df, regras or REGRAS_RISCO_FINANCEIRO)
+    df['score_risco_total'] = calcular_score_total(df, pesos)
+    df['classificacao_risco'] = classificar_score(df['score_risco_total'], faixas, padrao)
+    if 'ativo_total' in df.columns:
+        df['prioridade_fiscalizacao'] = calcular_prioridade(df['score_risco_total'], df['ativo_total'], regras_prioridade)
+    return df
+
+def gerar_sql_regras(regras, alias=''):
+    """Gera a expressão SQL (soma de CASE) equivalente a pontuar_regras."""
+    prefixo = f"{alias}." if alias else ""
+    blocos = []
+    for coluna, regra in regras.items():
+        whens = " ".join(
+            f"WHEN {prefixo}{coluna} {regra['operador']} {limite} THEN {pontos}"
+            for limite, pontos in regra['faixas']
+        )
+        blocos.append(f"CASE {whens} ELSE 0 END")
+    return " +\n    ".join(blocos)
+
+def gerar_sql_score_total(pesos=None, alias=''):
+    """Gera a expressão SQL equivalente a calcular_score_total."""
+    pesos = pesos or PESOS_SCORE_TOTAL
+    prefixo = f"{alias}." if alias else ""
+    termos = " + ".join(f"(COALESCE({prefixo}{coluna}, 0) * {peso:g})" for coluna, peso in pesos.items())
+    return f"ROUND({termos}, 2)"
+
+def gerar_sql_classificacao(expr_score, faixas=None, padrao=None):
+    """Gera o CASE SQL equivalente a classificar_score."""
+    if faixas is None:
+        faixas, padrao = CLASSIFICACAO_RISCO, CLASSIFICACAO_RISCO_PADRAO
+    whens = "\n        ".join(f"WHEN {expr_score} >= {limite} THEN '{rotulo}'" for limite, rotulo in faixas)
+    return f"CASE\n        {whens}\n        ELSE '{padrao}'\n    END"
+
+def gerar_sql_prioridade(expr_score, expr_ativo, regras=None):
+    """Gera o CASE SQL equivalente a calcular_prioridade."""
+    regras = regras or REGRAS_PRIORIDADE
+    linhas = [
+        f"WHEN {expr_score} >= {regras['score_critico']} AND {expr_ativo} >= {regras['ativo_relevante']} THEN 1",
+        f"WHEN {expr_score} >= {regras['score_critico']} OR {expr_ativo} >= {regras['ativo_relevante']} THEN 2"
+    ]
+    linhas += [f"WHEN {expr_score} >= {limite} THEN {prioridade}" for limite, prioridade in regras['faixas']]
+    whens = "\n        ".join(linhas)
+    return f"CASE\n        {whens}\n        ELSE {regras['padrao']}\n    END"
+
 # =============================================================================
 # 6. FUNÇÕES DE CARREGAMENTO DE DADOS (COM CACHE OTIMIZADO)
 # =============================================================================
 
-@st.cache_data(ttl=3600)
+# -----------------------------------------------------------------------------
+# Cache compartilhado dos carregadores (single-flight + stale-while-revalidate)
+# -----------------------------------------------------------------------------
+# Uma única consulta por chave (função + argumentos normalizados) fica em voo;
+# as demais chamadas aguardam o mesmo Future. Entradas vencidas continuam sendo
+# servidas por mais um período enquanto são recarregadas em segundo plano.
+
+TTL_CACHE = 3600
+
+@st.cache_resource
+def _estado_cache_compartilhado():
+    """Valores, consultas em voo e lock do cache dos carregadores (compartilhados entre sessões)."""
+    return {'valores': {}, 'em_voo': {}, 'lock': threading.Lock()}
+
+def _resultado_falhou(valor):
+    """Indica se o carregador retornou falha: None, ou tupla cujo dado principal é None."""
+    return valor is None or (isinstance(valor, tuple) and len(valor) > 0 and valor[0] is None)
+
+def _calcular_entrada_cache(chave, calcular, futuro, validade):
+    """Executa a consulta da chave, guarda o resultado e libera quem está aguardando."""
+    estado = _estado_cache_compartilhado()
+    try:
+        valor = calcular()
+    except Exception as e:
+        with estado['lock']:
+            estado['em_voo'].pop(chave, None)
+        futuro.set_exception(e)
+        return
+
+    with estado['lock']:
+        agora = time.time()
+        # Descartar entradas que já passaram do período de valor obsoleto
+        for chave_antiga in [c for c, e in estado['valores'].items() if e['descartar_em'] < agora]:
+            del estado['valores'][chave_antiga]
+        # None (ou página (None, cursor)) indica falha já reportada pelo carregador: não guardar
+        if not _resultado_falhou(valor):
+            estado['valores'][chave] = {'valor': valor, 'instante': agora, 'descartar_em': agora + validade}
+        estado['em_voo'].pop(chave, None)
+    futuro.set_result(valor)
+
+def _obter_entrada_cache(chave, calcular, ttl, ttl_obsoleto):
+    """Retorna o valor da chave: do cache, da consulta em voo, ou consultando."""
+    estado = _estado_cache_compartilhado()
+    agora = time.time()
+
+    with estado['lock']:
+        entrada = estado['valores'].get(chave)
+        if entrada is not None and agora - entrada['instante'] < ttl:
+            return copy.deepcopy(entrada['valor'])
+
+        obsoleta = entrada is not None and agora - entrada['instante'] < ttl + ttl_obsoleto
+        futuro = estado['em_voo'].get(chave)
+        responsavel = futuro is None
+        if responsavel:
+            futuro = Future()
+            estado['em_voo'][chave] = futuro
+
+    if obsoleta:
+        # Servir o valor vencido e recarregar em segundo plano
+        if responsavel:
+            threading.Thread(
+                target=_calcular_entrada_cache, args=(chave, calcular, futuro, ttl + ttl_obsoleto), daemon=True
+            ).start()
+        return copy.deepcopy(entrada['valor'])
+
+    if responsavel:
+        _calcular_entrada_cache(chave, calcular, futuro, ttl + ttl_obsoleto)
+    return copy.deepcopy(futuro.result())
+
+def cache_compartilhado(ttl=TTL_CACHE, ttl_obsoleto=None):
+    """Decorador de cache dos carregadores; argumentos iniciados por '_' ficam fora da chave."""
+    ttl_obsoleto = ttl if ttl_obsoleto is None else ttl_obsoleto
+
+    def decorador(funcao):
+        assinatura = inspect.signature(funcao)
+
+        @functools.wraps(funcao)
+        def carregador(*args, **kwargs):
+            argumentos = assinatura.bind(*args, **kwargs)
+            argumentos.apply_defaults()
+            chave = (funcao.__name__, repr([
+                (nome, valor) for nome, valor in argumentos.arguments.items() if not nome.startswith('_')
+            ]))
+            return _obter_entrada_cache(chave, lambda: funcao(*args, **kwargs), ttl, ttl_obsoleto)
+
+        return carregador
+
+    return decorador
+
+def limpar_cache_compartilhado():
+    """Descarta todos os valores do cache dos carregadores."""
+    estado = _estado_cache_compartilhado()
+    with estado['lock']:
+        estado['valores'].clear()
+
+# -----------------------------------------------------------------------------
+# Consultas assíncronas das páginas (renderização progressiva)
+# -----------------------------------------------------------------------------
+# A página submete todas as suas consultas de uma vez e desenha cada seção assim
+# que os dados de que ela depende chegam: o primeiro gráfico sai no tempo da
+# consulta mais rápida, e não na soma de todas.
+
+QTD_WORKERS_CONSULTA = 8
+
+@st.cache_resource
+def _executor_consultas():
+    """Pool de threads das consultas das páginas (compartilhado entre sessões)."""
+    return ThreadPoolExecutor(max_workers=QTD_WORKERS_CONSULTA, thread_name_prefix="consulta")
+
+def _executar_consulta(contexto, funcao, args, kwargs):
+    """Executa o carregador na thread do pool com o contexto da sessão (para st.error funcionar)."""
+    add_script_run_ctx(threading.current_thread(), contexto)
+    return funcao(*args, **kwargs)
+
+def submeter_consultas(consultas):
+    """Submete de uma vez as consultas {nome: (função, args, kwargs)}; retorna {nome: Future}."""
+    executor = _executor_consultas()
+    contexto = get_script_run_ctx()
+    return {
+        nome: executor.submit(_executar_consulta, contexto, funcao, args, kwargs)
+        for nome, (funcao, args, kwargs) in consultas.items()
+    }
+
+def resultado_consulta(futuro):
+    """Aguarda e retorna o resultado da consulta (None se ela falhou)."""
+    try:
+        return futuro.result()
+    except Exception as e:
+        st.error(f"Erro ao carregar dados: {e}")
+        return None
+
+# Último erro do carregador na thread atual (cargas em segundo plano, sem sessão)
+_erro_carga = threading.local()
+
+def avisar_erro_carga(mensagem):
+    """st.error na sessão; em thread de segundo plano (sem contexto) só guarda a mensagem para o agendador."""
+    if get_script_run_ctx() is not None:
+        st.error(mensagem)
+    else:
+        _erro_carga.mensagem = mensagem
+
+def secao_pendente(mensagem="Carregando..."):
+    """Reserva o lugar de uma seção na página, exibindo um aviso até os dados chegarem."""
+    espaco = st.empty()
+    espaco.info(f"⏳ {mensagem}")
+    return espaco
+
+def renderizar_progressivo(futuros, secoes):
+    """Desenha as seções na ordem em que suas consultas terminam.
+
+    secoes: lista de (espaço, dependências, função); a função recebe os resultados das dependências.
+    """
+    pendentes = list(secoes)
+    while pendentes:
+        prontas = [s for s in pendentes if all(futuros[d].done() for d in s[1])]
+        if not prontas:
+            em_voo = {futuros[d] for _, dependencias, _ in pendentes for d in dependencias}
+            wait([f for f in em_voo if not f.done()], return_when=FIRST_COMPLETED)
+            continue
+        for secao in prontas:
+            espaco, dependencias, renderizar = secao
+            with espaco.container():
+                renderizar(*[resultado_consulta(futuros[d]) for d in dependencias])
+            pendentes.remove(secao)
+
+@cache_compartilhado(ttl=3600)
 def carregar_resumo_geral(_engine):
     """Carrega resumo agregado para carregamento inicial rápido."""
     if _engine is None:
@@ -492,9 +856,9 @@ def carregar_resumo_geral(_engine):
     
     query = f"""
     SELECT 
-        COUNT(DISTINCT cnpj) as total_empresas,
-        COUNT(DISTINCT ano_referencia) as total_anos,
-        MAX(ano_referencia) as ano_mais_recente,
+        COUNT(DISTINCT cnpj_id) as total_empresas,
+        COUNT(DISTINCT ano_fiscal) as total_anos,
+        MAX(ano_fiscal) as ano_mais_recente,
         COUNT(DISTINCT cnae_divisao) as total_setores,
         COUNT(DISTINCT cd_uf) as total_estados
     FROM {DATABASE}.ecd_empresas_cadastro
@@ -505,21 +869,21 @@ def carregar_resumo_geral(_engine):
         df = pd.read_sql(query, _engine)
         return df.iloc[0].to_dict()
     except Exception as e:
-        st.error(f"Erro ao carregar resumo geral: {e}")
+        avisar_erro_carga(f"Erro ao carregar resumo geral: {e}")
         return None
 
-@st.cache_data(ttl=3600)
+@cache_compartilhado(ttl=3600)
 def carregar_indicadores_agregados(_engine, ano=None):
     """Carrega indicadores financeiros agregados por setor."""
     if _engine is None:
         return None
 
-    ano_filter = f"AND ind.ano_referencia = {ano}" if ano else ""
+    ano_filter = f"AND ind.ano_fiscal = {ano}" if ano else ""
 
     query = f"""
     SELECT
         COALESCE(ec.cnae_divisao_descricao, ec.de_cnae, 'Não Classificado') as setor,
-        COUNT(DISTINCT ec.cnpj) as qtd_empresas,
+        COUNT(DISTINCT ec.cnpj_id) as qtd_empresas,
         ROUND(AVG(ind.ativo_total) / 1000000, 2) as media_ativo_milhoes,
         ROUND(AVG(ind.receita_liquida) / 1000000, 2) as media_receita_milhoes,
         ROUND(AVG(ind.liquidez_corrente), 2) as media_liquidez,
@@ -529,12 +893,12 @@ def carregar_indicadores_agregados(_engine, ano=None):
         ROUND(AVG(ind.roe_retorno_patrimonio_perc), 2) as media_roe
     FROM {DATABASE}.ecd_empresas_cadastro ec
     INNER JOIN {DATABASE}.ecd_indicadores_financeiros ind
-        ON ec.cnpj = ind.cnpj
-        AND CAST(ec.ano_referencia / 100 AS INT) = ind.ano_referencia
+        ON ec.cnpj_id = ind.cnpj_id
+        AND ec.ano_fiscal = ind.ano_fiscal
     WHERE 1=1
         {ano_filter}
     GROUP BY COALESCE(ec.cnae_divisao_descricao, ec.de_cnae, 'Não Classificado')
-    HAVING COUNT(DISTINCT ec.cnpj) > 0
+    HAVING COUNT(DISTINCT ec.cnpj_id) > 0
     ORDER BY qtd_empresas DESC
     LIMIT 50
     """
@@ -543,16 +907,16 @@ def carregar_indicadores_agregados(_engine, ano=None):
         df = pd.read_sql(query, _engine)
         return df
     except Exception as e:
-        st.error(f"Erro ao carregar indicadores agregados: {e}")
+        avisar_erro_carga(f"Erro ao carregar indicadores agregados: {e}")
         return None
 
-@st.cache_data(ttl=3600)
+@cache_compartilhado(ttl=3600)
 def carregar_empresas_por_setor(_engine, setor, ano=None):
     """Carrega lista de empresas de um setor específico."""
     if _engine is None:
         return None
 
-    ano_filter = f"AND ind.ano_referencia = {ano}" if ano else ""
+    ano_filter = f"AND ind.ano_fiscal = {ano}" if ano else ""
 
     query = f"""
     SELECT
@@ -569,11 +933,11 @@ def carregar_empresas_por_setor(_engine, setor, ano=None):
         sr.classificacao_risco
     FROM {DATABASE}.ecd_empresas_cadastro ec
     INNER JOIN {DATABASE}.ecd_indicadores_financeiros ind
-        ON ec.cnpj = ind.cnpj
-        AND CAST(ec.ano_referencia / 100 AS INT) = ind.ano_referencia
+        ON ec.cnpj_id = ind.cnpj_id
+        AND ec.ano_fiscal = ind.ano_fiscal
     LEFT JOIN {DATABASE}.ecd_score_risco_consolidado sr
-        ON ec.cnpj = sr.cnpj
-        AND CAST(ec.ano_referencia / 100 AS INT) = sr.ano_referencia
+        ON ec.cnpj_id = sr.cnpj_id
+        AND ec.ano_fiscal = sr.ano_fiscal
     WHERE COALESCE(ec.cnae_divisao_descricao, ec.de_cnae) = '{setor}'
         {ano_filter}
     ORDER BY ind.ativo_total DESC
@@ -584,88 +948,231 @@ def carregar_empresas_por_setor(_engine, setor, ano=None):
         df = pd.read_sql(query, _engine)
         return df
     except Exception as e:
-        st.error(f"Erro ao carregar empresas: {e}")
+        avisar_erro_carga(f"Erro ao carregar empresas: {e}")
         return None
 
-@st.cache_data(ttl=3600)
-def carregar_dados_empresa(_engine, cnpj):
-    """Carrega dados completos de uma empresa específica (sob demanda)."""
-    if _engine is None:
-        return {}
-    
-    dados = {}
-    
-    # 1. Dados cadastrais
-    query_cadastro = f"""
-    SELECT *
-    FROM {DATABASE}.ecd_empresas_cadastro
-    WHERE cnpj = '{cnpj}'
-    ORDER BY ano_referencia DESC
-    LIMIT 1
-    """
-    
-    # 2. Indicadores financeiros
-    query_indicadores = f"""
-    SELECT *
-    FROM {DATABASE}.ecd_indicadores_financeiros
-    WHERE cnpj = '{cnpj}'
-    ORDER BY ano_referencia DESC
-    """
-    
-    # 3. Balanço Patrimonial (tabela já agregada)
-    query_balanco = f"""
-    SELECT *
-    FROM {DATABASE}.ecd_balanco_patrimonial
-    WHERE cnpj = '{cnpj}'
-    ORDER BY ano_referencia DESC, data_fim_periodo DESC
-    """
-    
-    # 4. DRE - Demonstração do Resultado (tabela já agregada)
-    query_dre = f"""
-    SELECT *
-    FROM {DATABASE}.ecd_dre
-    WHERE cnpj = '{cnpj}'
-    ORDER BY ano_referencia DESC, data_fim_periodo DESC
+def cnpj_para_id(cnpj):
+    """Chave inteira (cnpj_id) das tabelas do build a partir do CNPJ, com ou sem máscara."""
+    return int(re.sub(r'\D', '', str(cnpj)))
+
+def formatar_cnpj(cnpj_id):
+    """CNPJ de 14 dígitos para exibição (recupera os zeros à esquerda perdidos no BIGINT)."""
+    return f"{int(cnpj_id):014d}"
+
+# Consultas pontuais de uma empresa: parte -> (tabela, ordenação, limite)
+PARTES_EMPRESA = {
+    'cadastro': ('ecd_empresas_cadastro', 'ano_referencia DESC', 1),
+    'indicadores': ('ecd_indicadores_financeiros', 'ano_referencia DESC', None),
+    'balanco': ('ecd_balanco_patrimonial', 'ano_referencia DESC, data_fim_periodo DESC', None),
+    'dre': ('ecd_dre', 'ano_referencia DESC, data_fim_periodo DESC', None),
+    'risco': ('ecd_score_risco_consolidado', 'ano_referencia DESC', None)
+}
+
+# Colunas lidas pelo detalhamento em cada parte (o dossiê em lote continua com todas)
+COLUNAS_EMPRESA = {
+    'cadastro': [
+        'cnpj', 'ano_referencia', 'ano_fiscal', 'nm_razao_social', 'nm_fantasia', 'cd_uf',
+        'cd_cnae', 'de_cnae', 'cnae_divisao_descricao', 'empresa_grande_porte', 'tipo_ecd',
+        'nm_natureza_juridica_sefaz', 'nm_reg_apuracao', 'sn_simples_nacional_rfb'
+    ],
+    'indicadores': [
+        'cnpj', 'ano_referencia', 'ano_fiscal', 'periodo_aaaamm',
+        'ativo_total', 'ativo_circulante', 'ativo_nao_circulante',
+        'passivo_total', 'passivo_circulante', 'passivo_nao_circulante',
+        'patrimonio_liquido', 'receita_liquida', 'lucro_bruto',
+        'resultado_liquido', 'custos_totais', 'despesas_totais',
+        'liquidez_corrente', 'liquidez_geral', 'endividamento_geral',
+        'composicao_endividamento', 'margem_liquida_perc', 'margem_bruta_perc',
+        'roa_retorno_ativo_perc', 'roe_retorno_patrimonio_perc'
+    ],
+    'balanco': [
+        'cnpj', 'ano_referencia', 'ano_fiscal', 'periodo_aaaamm', 'data_fim_periodo',
+        'ativo_total', 'ativo_circulante', 'ativo_nao_circulante', 'passivo_pl_total',
+        'passivo_total', 'passivo_circulante', 'passivo_nao_circulante', 'patrimonio_liquido'
+    ],
+    'dre': [
+        'cnpj', 'ano_referencia', 'ano_fiscal', 'periodo_aaaamm', 'data_fim_periodo',
+        'receita_bruta', 'deducoes_receita', 'receita_liquida', 'custos_totais',
+        'despesas_totais', 'lucro_bruto', 'resultado_liquido'
+    ],
+    'risco': [
+        'cnpj', 'ano_referencia', 'ano_fiscal', 'classificacao_risco', 'score_risco_total',
+        'score_equacao_contabil', 'score_neaf', 'score_risco_financeiro', 'qtd_indicios_neaf'
+    ]
+}
+
+@cache_compartilhado(ttl=3600)
+def carregar_parte_empresa(_engine, cnpj, parte, completo=False):
+    """Carrega uma parte (cadastro, indicadores, balanço, DRE ou risco) dos dados de uma empresa.
+
+    Por padrão só as colunas de COLUNAS_EMPRESA; completo=True traz todas (ex.: cadastro completo).
     """
-    
-    # 5. Score de risco
-    query_risco = f"""
-    SELECT *
-    FROM {DATABASE}.ecd_score_risco_consolidado
-    WHERE cnpj = '{cnpj}'
-    ORDER BY ano_referencia DESC
+    if _engine is None:
+        return None
+
+    tabela, ordenacao, limite = PARTES_EMPRESA[parte]
+    colunas = None if completo else COLUNAS_EMPRESA[parte]
+
+    # Consulta pontual no snapshot local, quando já gerado para o build atual
+    df = consultar_snapshot_empresa(obter_versao_build(_engine), parte, cnpj)
+    if df is not None:
+        if colunas:
+            df = df[[coluna for coluna in colunas if coluna in df.columns]]
+        return df.head(limite) if limite else df
+
+    query = f"""
+    SELECT {', '.join(colunas) if colunas else '*'}
+    FROM {DATABASE}.{tabela}
+    WHERE cnpj_id = {cnpj_para_id(cnpj)}
+    ORDER BY {ordenacao}
+    {f'LIMIT {limite}' if limite else ''}
     """
-    
+
     try:
-        dados['cadastro'] = pd.read_sql(query_cadastro, _engine)
-        dados['indicadores'] = pd.read_sql(query_indicadores, _engine)
-        dados['balanco'] = pd.read_sql(query_balanco, _engine)
-        dados['dre'] = pd.read_sql(query_dre, _engine)
-        dados['risco'] = pd.read_sql(query_risco, _engine)
-        return dados
+        return pd.read_sql(query, _engine)
     except Exception as e:
-        st.error(f"Erro ao carregar dados da empresa: {e}")
-        return {}
+        avisar_erro_carga(f"Erro ao carregar dados da empresa ({parte}): {e}")
+        return None
 
-@st.cache_data(ttl=3600)
-def carregar_empresas_alto_risco(_engine, limite=500, ano=None):
-    """Carrega empresas com alto score de risco para fiscalização."""
+def submeter_dados_empresa(_engine, cnpj, partes=None):
+    """Submete em paralelo as consultas das partes da empresa (todas por padrão); retorna {parte: Future}."""
+    return submeter_consultas({
+        parte: (carregar_parte_empresa, (_engine, cnpj, parte), {}) for parte in (PARTES_EMPRESA if partes is None else partes)
+    })
+
+# Abas do detalhamento de empresa -> consultas de que dependem ('setor' = indicadores agregados)
+ABAS_EMPRESA = {
+    "📝 Dados Cadastrais": [],
+    "📊 Indicadores Financeiros": ['indicadores'],
+    "💰 Balanço Patrimonial": ['balanco'],
+    "📈 DRE": ['dre'],
+    "⚠️ Análise de Risco": ['risco', 'indicadores', 'setor']
+}
+
+# Quantidade máxima de CNPJs na lista do IN de cada consulta em lote
+TAMANHO_LOTE_CNPJ = 500
+
+def normalizar_lista_cnpjs(texto):
+    """Extrai os CNPJs (14 dígitos, com ou sem máscara) de um texto, sem repetição."""
+    digitos = re.sub(r'[.\-/]', '', texto or '')
+    return list(dict.fromkeys(re.findall(r'\b\d{14}\b', digitos)))
+
+def carregar_parte_empresas_lote(_engine, cnpjs, parte):
+    """Carrega uma parte dos dados de várias empresas com consultas IN (em lotes)."""
     if _engine is None:
         return None
 
-    # Primeiro, tentar carregar da tabela de score de risco consolidado
+    tabela, ordenacao, limite = PARTES_EMPRESA[parte]
+    versao_build = obter_versao_build(_engine)
+    lotes = []
+
     try:
-        # Verificar se a tabela tem dados
-        check_query = f"SELECT COUNT(*) as cnt FROM {DATABASE}.ecd_score_risco_consolidado LIMIT 1"
-        check_df = pd.read_sql(check_query, _engine)
+        if parte in status_snapshot_empresas(versao_build):
+            # Sem ida ao Impala: uma busca no índice local por empresa
+            lotes = [consultar_snapshot_empresa(versao_build, parte, cnpj) for cnpj in cnpjs]
+            cnpjs = []
+        for inicio in range(0, len(cnpjs), TAMANHO_LOTE_CNPJ):
+            lista_ids = ", ".join(str(cnpj_para_id(cnpj)) for cnpj in cnpjs[inicio:inicio + TAMANHO_LOTE_CNPJ])
+            query = f"""
+            SELECT *
+            FROM {DATABASE}.{tabela}
+            WHERE cnpj_id IN ({lista_ids})
+            ORDER BY cnpj_id, {ordenacao}
+            """
+            lotes.append(pd.read_sql(query, _engine))
+    except Exception as e:
+        avisar_erro_carga(f"Erro ao carregar dados das empresas ({parte}): {e}")
+        return None
 
-        if check_df.iloc[0]['cnt'] > 0:
-            # Tabela de score de risco tem dados - usar query completa
-            ano_filter = f"AND sr.ano_referencia = {ano}" if ano else ""
+    df = pd.concat(lotes, ignore_index=True)
+    df['cnpj'] = df['cnpj'].astype(str)
+    # Mesmo limite por empresa da consulta pontual (ex.: cadastro mais recente)
+    if limite:
+        df = df.groupby('cnpj', sort=False).head(limite)
+    return df
 
-            query = f"""
+def carregar_dados_empresas_lote(_engine, cnpjs):
+    """Carrega as cinco partes de várias empresas: uma consulta em conjunto por parte, em paralelo."""
+    if _engine is None or not cnpjs:
+        return {}
+
+    futuros = submeter_consultas({
+        parte: (carregar_parte_empresas_lote, (_engine, cnpjs, parte), {}) for parte in PARTES_EMPRESA
+    })
+    dados = {parte: resultado_consulta(futuro) for parte, futuro in futuros.items()}
+    if any(df is None for df in dados.values()):
+        return {}
+    return dados
+
+# Ordenação da fila de fiscalização (chave da paginação por cursor)
+ORDEM_ALTO_RISCO = [
+    ('prioridade_fiscalizacao', 'ASC'),
+    ('score_risco_total', 'DESC'),
+    ('cnpj', 'ASC'),
+    ('ano_fiscal', 'DESC')
+]
+
+def _literal_sql(valor):
+    """Formata um valor Python como literal SQL."""
+    if isinstance(valor, str):
+        return "'" + valor.replace("'", "''") + "'"
+    return repr(valor)
+
+def _filtro_keyset(ordem, cursor, alias='t'):
+    """Gera a condição WHERE que retorna as linhas posteriores ao cursor na ordenação."""
+    if cursor is None:
+        return "1=1"
+    condicoes = []
+    for i, (coluna, direcao) in enumerate(ordem):
+        iguais = [f"{alias}.{c} = {_literal_sql(v)}" for (c, _), v in zip(ordem[:i], cursor[:i])]
+        operador = '>' if direcao == 'ASC' else '<'
+        iguais.append(f"{alias}.{coluna} {operador} {_literal_sql(cursor[i])}")
+        condicoes.append("(" + " AND ".join(iguais) + ")")
+    return "(" + " OR ".join(condicoes) + ")"
+
+def _ordenacao_sql(ordem, alias='t'):
+    """Gera a cláusula ORDER BY da ordenação."""
+    return ", ".join(f"{alias}.{coluna} {direcao}" for coluna, direcao in ordem)
+
+def _paginar(df, ordem, tamanho_pagina):
+    """Separa a página (lida com uma linha extra) e o cursor da próxima página."""
+    if len(df) <= tamanho_pagina:
+        return df, None
+    df = df.iloc[:tamanho_pagina]
+    ultima = df.iloc[-1]
+    cursor = tuple(
+        str(ultima[coluna]) if coluna == 'cnpj'
+        else int(ultima[coluna]) if coluna == 'ano_fiscal'
+        else float(ultima[coluna])
+        for coluna, _ in ordem
+    )
+    return df, cursor
+
+@cache_compartilhado(ttl=3600)
+def carregar_pagina_alto_risco(_engine, ano=None, cursor=None, tamanho_pagina=100, score_minimo=3, uf=None):
+    """Carrega uma página da fila de fiscalização (prioridade, score, cnpj) a partir do cursor."""
+    if _engine is None:
+        return None, None
+
+    # Tabela de score sem dados (segundo o catálogo) - usar fallback com indicadores financeiros
+    if not tabela_disponivel(_engine, 'ecd_score_risco_consolidado'):
+        try:
+            return _carregar_pagina_risco_fallback(_engine, ano, cursor, tamanho_pagina, score_minimo, uf)
+        except Exception as e:
+            avisar_erro_carga(f"Erro ao carregar empresas de alto risco: {e}")
+            return None, None
+
+    try:
+        ano_filter = f"AND sr.ano_fiscal = {ano}" if ano else ""
+        uf_filter = f"AND ec.cd_uf = {_literal_sql(uf)}" if uf else ""
+        sql_prioridade = gerar_sql_prioridade("sr.score_risco_total", "COALESCE(ind.ativo_total, 0)")
+
+        query = f"""
+        SELECT t.*
+        FROM (
             SELECT
                 sr.cnpj,
+                sr.ano_fiscal,
                 COALESCE(ec.nm_razao_social, 'N/A') as nm_razao_social,
                 COALESCE(ec.nm_fantasia, '') as nm_fantasia,
                 COALESCE(ec.cd_uf, 'N/A') as cd_uf,
@@ -682,115 +1189,151 @@ def carregar_empresas_alto_risco(_engine, limite=500, ano=None):
                 ROUND(COALESCE(ind.liquidez_corrente, 0), 2) as liquidez,
                 ROUND(COALESCE(ind.endividamento_geral, 0), 2) as endividamento,
                 ROUND(COALESCE(ind.margem_liquida_perc, 0), 2) as margem_liquida,
-                CASE
-                    WHEN sr.score_risco_total >= 7 AND COALESCE(ind.ativo_total, 0) >= 100000000 THEN 1
-                    WHEN sr.score_risco_total >= 7 OR COALESCE(ind.ativo_total, 0) >= 100000000 THEN 2
-                    WHEN sr.score_risco_total >= 5 THEN 3
-                    WHEN sr.score_risco_total >= 3 THEN 4
-                    ELSE 5
-                END as prioridade_fiscalizacao
-            FROM {DATABASE}.ecd_score_risco_consolidado sr
-            LEFT JOIN {DATABASE}.ecd_empresas_cadastro ec
-                ON sr.cnpj = ec.cnpj
-            LEFT JOIN {DATABASE}.ecd_indicadores_financeiros ind
-                ON sr.cnpj = ind.cnpj
-                AND sr.ano_referencia = ind.ano_referencia
-            WHERE sr.score_risco_total >= 3
+                {sql_prioridade} as prioridade_fiscalizacao
+            FROM {sql_ultimo_periodo('ecd_score_risco_consolidado')} sr
+            LEFT JOIN {tabela_empresas(_engine)} ec
+                ON sr.cnpj_id = ec.cnpj_id
+            LEFT JOIN {sql_ultimo_periodo('ecd_indicadores_financeiros')} ind
+                ON sr.cnpj_id = ind.cnpj_id
+                AND sr.ano_fiscal = ind.ano_fiscal
+            WHERE sr.score_risco_total >= {float(score_minimo)}
                 {ano_filter}
-            ORDER BY prioridade_fiscalizacao ASC, sr.score_risco_total DESC
-            LIMIT {limite}
-            """
-            df = pd.read_sql(query, _engine)
-            return df
-        else:
-            # Tabela de score vazia - usar fallback com indicadores financeiros
-            return _carregar_empresas_risco_fallback(_engine, limite, ano)
-
+                {uf_filter}
+        ) t
+        WHERE {_filtro_keyset(ORDEM_ALTO_RISCO, cursor)}
+        ORDER BY {_ordenacao_sql(ORDEM_ALTO_RISCO)}
+        LIMIT {int(tamanho_pagina) + 1}
+        """
+        df = pd.read_sql(query, _engine)
+        return _paginar(df, ORDEM_ALTO_RISCO, tamanho_pagina)
     except Exception as e:
-        # Se falhar, tentar fallback
-        try:
-            return _carregar_empresas_risco_fallback(_engine, limite, ano)
-        except Exception as e2:
-            st.error(f"Erro ao carregar empresas de alto risco: {e2}")
-            return None
+        avisar_erro_carga(f"Erro ao carregar empresas de alto risco: {e}")
+        return None, None
 
-def _carregar_empresas_risco_fallback(_engine, limite=500, ano=None):
+def carregar_empresas_alto_risco(_engine, limite=500, ano=None):
+    """Carrega as primeiras empresas da fila de fiscalização."""
+    df, _ = carregar_pagina_alto_risco(_engine, ano=ano, tamanho_pagina=limite)
+    return df
+
+def _carregar_pagina_risco_fallback(_engine, ano=None, cursor=None, tamanho_pagina=100, score_minimo=3, uf=None):
     """Fallback: calcula risco baseado apenas em indicadores financeiros."""
-    ano_filter = f"AND ind.ano_referencia = {ano}" if ano else ""
+    ano_filter = f"AND ind.ano_fiscal = {ano}" if ano else ""
+    uf_filter = f"AND ec.cd_uf = {_literal_sql(uf)}" if uf else ""
+    sql_score = gerar_sql_regras(REGRAS_RISCO_FALLBACK, alias='ind')
+
+    # Prioridade é constante no fallback, então a mesma ordenação por cursor se aplica
+    query = f"""
+    SELECT t.*
+    FROM (
+        SELECT
+            ind.cnpj,
+            ind.ano_fiscal,
+            COALESCE(ec.nm_razao_social, 'N/A') as nm_razao_social,
+            COALESCE(ec.nm_fantasia, '') as nm_fantasia,
+            COALESCE(ec.cd_uf, 'N/A') as cd_uf,
+            COALESCE(ec.cnae_divisao_descricao, ec.de_cnae, 'Não Classificado') as setor,
+            COALESCE(ec.empresa_grande_porte, 'N') as empresa_grande_porte,
+            -- Calcular score de risco baseado em indicadores
+            {sql_score} as score_risco_total,
+            0 as score_equacao_contabil,
+            0 as score_neaf,
+            0 as score_risco_financeiro,
+            0 as qtd_indicios_neaf,
+            ROUND(COALESCE(ind.ativo_total, 0) / 1000000, 2) as ativo_milhoes,
+            ROUND(COALESCE(ind.receita_liquida, 0) / 1000000, 2) as receita_milhoes,
+            ROUND(COALESCE(ind.liquidez_corrente, 0), 2) as liquidez,
+            ROUND(COALESCE(ind.endividamento_geral, 0), 2) as endividamento,
+            ROUND(COALESCE(ind.margem_liquida_perc, 0), 2) as margem_liquida,
+            3 as prioridade_fiscalizacao
+        FROM {sql_ultimo_periodo('ecd_indicadores_financeiros')} ind
+        LEFT JOIN {tabela_empresas(_engine)} ec
+            ON ind.cnpj_id = ec.cnpj_id
+        WHERE 1=1
+            {ano_filter}
+            {uf_filter}
+            AND (ind.liquidez_corrente < 1.0 OR ind.endividamento_geral > 0.7 OR ind.margem_liquida_perc < 0)
+    ) t
+    WHERE t.score_risco_total >= {float(score_minimo)}
+        AND {_filtro_keyset(ORDEM_ALTO_RISCO, cursor)}
+    ORDER BY {_ordenacao_sql(ORDEM_ALTO_RISCO)}
+    LIMIT {int(tamanho_pagina) + 1}
+    """
+    df = pd.read_sql(query, _engine)
+
+    # Classificação calculada pelo motor de regras (mesmas faixas do SQL anterior)
+    df.insert(
+        df.columns.get_loc('score_risco_total') + 1,
+        'classificacao_risco',
+        classificar_score(df['score_risco_total'], CLASSIFICACAO_RISCO_FALLBACK, CLASSIFICACAO_RISCO_FALLBACK_PADRAO)
+    )
+    return _paginar(df, ORDEM_ALTO_RISCO, tamanho_pagina)
+
+@cache_compartilhado(ttl=3600)
+def carregar_componentes_risco(_engine, ano=None):
+    """Carrega os componentes do score de todas as empresas do ano em arrays compactos (simulador)."""
+    if _engine is None:
+        return None
+
+    ano_filter = f"AND sr.ano_fiscal = {ano}" if ano else ""
 
     query = f"""
     SELECT
-        ind.cnpj,
-        COALESCE(ec.nm_razao_social, 'N/A') as nm_razao_social,
-        COALESCE(ec.nm_fantasia, '') as nm_fantasia,
-        COALESCE(ec.cd_uf, 'N/A') as cd_uf,
-        COALESCE(ec.cnae_divisao_descricao, ec.de_cnae, 'Não Classificado') as setor,
-        COALESCE(ec.empresa_grande_porte, 'N') as empresa_grande_porte,
-        -- Calcular score de risco baseado em indicadores
-        CASE
-            WHEN ind.liquidez_corrente < 0.5 THEN 3
-            WHEN ind.liquidez_corrente < 1.0 THEN 2
-            ELSE 0
-        END +
-        CASE
-            WHEN ind.endividamento_geral > 0.9 THEN 3
-            WHEN ind.endividamento_geral > 0.7 THEN 2
-            ELSE 0
-        END +
-        CASE
-            WHEN ind.margem_liquida_perc < -10 THEN 3
-            WHEN ind.margem_liquida_perc < 0 THEN 1
-            ELSE 0
-        END as score_risco_total,
-        CASE
-            WHEN (CASE WHEN ind.liquidez_corrente < 0.5 THEN 3 WHEN ind.liquidez_corrente < 1.0 THEN 2 ELSE 0 END +
-                  CASE WHEN ind.endividamento_geral > 0.9 THEN 3 WHEN ind.endividamento_geral > 0.7 THEN 2 ELSE 0 END +
-                  CASE WHEN ind.margem_liquida_perc < -10 THEN 3 WHEN ind.margem_liquida_perc < 0 THEN 1 ELSE 0 END) >= 7 THEN 'Muito Alto'
-            WHEN (CASE WHEN ind.liquidez_corrente < 0.5 THEN 3 WHEN ind.liquidez_corrente < 1.0 THEN 2 ELSE 0 END +
-                  CASE WHEN ind.endividamento_geral > 0.9 THEN 3 WHEN ind.endividamento_geral > 0.7 THEN 2 ELSE 0 END +
-                  CASE WHEN ind.margem_liquida_perc < -10 THEN 3 WHEN ind.margem_liquida_perc < 0 THEN 1 ELSE 0 END) >= 5 THEN 'Alto'
-            WHEN (CASE WHEN ind.liquidez_corrente < 0.5 THEN 3 WHEN ind.liquidez_corrente < 1.0 THEN 2 ELSE 0 END +
-                  CASE WHEN ind.endividamento_geral > 0.9 THEN 3 WHEN ind.endividamento_geral > 0.7 THEN 2 ELSE 0 END +
-                  CASE WHEN ind.margem_liquida_perc < -10 THEN 3 WHEN ind.margem_liquida_perc < 0 THEN 1 ELSE 0 END) >= 3 THEN 'Médio'
-            ELSE 'Baixo'
-        END as classificacao_risco,
-        0 as score_equacao_contabil,
-        0 as score_neaf,
-        0 as score_risco_financeiro,
-        0 as qtd_indicios_neaf,
-        ROUND(COALESCE(ind.ativo_total, 0) / 1000000, 2) as ativo_milhoes,
-        ROUND(COALESCE(ind.receita_liquida, 0) / 1000000, 2) as receita_milhoes,
-        ROUND(COALESCE(ind.liquidez_corrente, 0), 2) as liquidez,
-        ROUND(COALESCE(ind.endividamento_geral, 0), 2) as endividamento,
-        ROUND(COALESCE(ind.margem_liquida_perc, 0), 2) as margem_liquida,
-        3 as prioridade_fiscalizacao
-    FROM {DATABASE}.ecd_indicadores_financeiros ind
-    LEFT JOIN {DATABASE}.ecd_empresas_cadastro ec
-        ON ind.cnpj = ec.cnpj
+        sr.cnpj_id,
+        COALESCE(sr.razao_social, 'N/A') as nm_razao_social,
+        COALESCE(sr.score_equacao_contabil, 0) as score_equacao_contabil,
+        COALESCE(sr.score_neaf, 0) as score_neaf,
+        COALESCE(sr.score_risco_financeiro, 0) as score_risco_financeiro,
+        COALESCE(ind.ativo_total, 0) as ativo_total
+    FROM {sql_ultimo_periodo('ecd_score_risco_consolidado')} sr
+    LEFT JOIN {sql_ultimo_periodo('ecd_indicadores_financeiros')} ind
+        ON sr.cnpj_id = ind.cnpj_id
+        AND sr.ano_fiscal = ind.ano_fiscal
     WHERE 1=1
         {ano_filter}
-        AND (ind.liquidez_corrente < 1.0 OR ind.endividamento_geral > 0.7 OR ind.margem_liquida_perc < 0)
-    ORDER BY
-        CASE WHEN ind.liquidez_corrente < 0.5 THEN 3 WHEN ind.liquidez_corrente < 1.0 THEN 2 ELSE 0 END +
-        CASE WHEN ind.endividamento_geral > 0.9 THEN 3 WHEN ind.endividamento_geral > 0.7 THEN 2 ELSE 0 END +
-        CASE WHEN ind.margem_liquida_perc < -10 THEN 3 WHEN ind.margem_liquida_perc < 0 THEN 1 ELSE 0 END DESC,
-        ind.ativo_total DESC
-    LIMIT {limite}
     """
-    df = pd.read_sql(query, _engine)
-    return df
 
-@st.cache_data(ttl=3600)
+    try:
+        df = pd.read_sql(query, _engine)
+        componentes = {
+            'cnpj_id': df['cnpj_id'].to_numpy(dtype='int64'),
+            'nm_razao_social': df['nm_razao_social'].to_numpy(dtype=object),
+            'ativo_total': pd.to_numeric(df['ativo_total'], errors='coerce').fillna(0).to_numpy(dtype='float64')
+        }
+        for coluna in PESOS_SCORE_TOTAL:
+            componentes[coluna] = pd.to_numeric(df[coluna], errors='coerce').fillna(0).to_numpy(dtype='float32')
+        return componentes
+    except Exception as e:
+        avisar_erro_carga(f"Erro ao carregar componentes de risco: {e}")
+        return None
+
+def _ranquear_prioridade(score, prioridade):
+    """Posição de cada empresa na fila (prioridade ASC, score DESC), começando em 1."""
+    ordem = np.lexsort((-score, prioridade))
+    posicoes = np.empty(len(ordem), dtype='int64')
+    posicoes[ordem] = np.arange(1, len(ordem) + 1)
+    return posicoes
+
+def simular_ponderacao(componentes, pesos, faixas=None, padrao=None, regras_prioridade=None):
+    """Recalcula score, classificação, prioridade e posição para toda a população."""
+    score = calcular_score_total(componentes, pesos)
+    prioridade = calcular_prioridade(score, componentes['ativo_total'], regras_prioridade)
+    return {
+        'score_risco_total': score,
+        'classificacao_risco': classificar_score(score, faixas, padrao),
+        'prioridade_fiscalizacao': prioridade,
+        'posicao': _ranquear_prioridade(score, prioridade)
+    }
+
+@cache_compartilhado(ttl=3600)
 def carregar_plano_contas_agregado(_engine, ano=None):
-    """Carrega estatísticas agregadas do plano de contas (otimizado para evitar timeout)."""
+    """Carrega estatísticas agregadas do plano de contas, com saldos pré-agregados por conta e ano."""
     if _engine is None:
         return None
 
-    # Query simplificada - apenas plano de contas sem JOIN com saldos
-    # Isso evita o timeout causado pelo JOIN pesado
-    ano_filter_plano = f"AND ano_referencia BETWEEN {ano}01 AND {ano}12" if ano else ""
+    ano_filter_plano = f"AND ano_fiscal = {ano}" if ano else ""
+    ano_filter_saldos = f"WHERE ano_fiscal = {ano}" if ano else ""
 
-    query = f"""
+    query_plano = f"""
     SELECT
         cd_conta,
         nm_conta,
@@ -800,95 +1343,304 @@ def carregar_plano_contas_agregado(_engine, ano=None):
         nivel_conta,
         cd_conta_sint1,
         nm_conta_sint1,
-        COUNT(DISTINCT cnpj) AS qtd_empresas_usam
+        COUNT(DISTINCT cnpj_id) AS qtd_empresas_usam
     FROM {DATABASE}.ecd_plano_contas
     WHERE tipo_conta = 'A'
         {ano_filter_plano}
     GROUP BY cd_conta, nm_conta, descricao_grupo_balanco, cd_conta_referencial,
              tipo_conta, nivel_conta, cd_conta_sint1, nm_conta_sint1
-    HAVING COUNT(DISTINCT cnpj) >= 5
+    HAVING COUNT(DISTINCT cnpj_id) >= 5
     ORDER BY qtd_empresas_usam DESC
     LIMIT 200
     """
 
+    # Saldos lidos de ecd_saldos_contas_estatisticas (agregada no build): sem JOIN com os saldos
+    query = f"""
+    WITH plano AS ({query_plano}),
+
+    saldos AS (
+        SELECT
+            cd_conta,
+            SUM(qtd_saldos) AS qtd_saldos,
+            SUM(soma_saldo) AS soma_saldo,
+            SUM(soma_quadrados_saldo) AS soma_quadrados_saldo,
+            MIN(min_saldo) AS min_saldo,
+            MAX(max_saldo) AS max_saldo,
+            -- Quantis não se somam entre anos: sem filtro de ano, média das medianas
+            AVG(saldo_mediana) AS saldo_mediana
+        FROM {DATABASE}.ecd_saldos_contas_estatisticas
+        {ano_filter_saldos}
+        GROUP BY cd_conta
+    )
+
+    SELECT
+        p.*,
+        s.qtd_saldos,
+        s.soma_saldo,
+        s.soma_quadrados_saldo,
+        s.min_saldo,
+        s.max_saldo,
+        s.saldo_mediana
+    FROM plano p
+    LEFT JOIN saldos s ON s.cd_conta = p.cd_conta
+    ORDER BY p.qtd_empresas_usam DESC
+    """
+
+    colunas_saldo = ['qtd_saldos', 'soma_saldo', 'soma_quadrados_saldo', 'min_saldo', 'max_saldo', 'saldo_mediana']
+
     try:
-        df = pd.read_sql(query, _engine)
+        if tabela_disponivel(_engine, 'ecd_saldos_contas_estatisticas'):
+            df = pd.read_sql(query, _engine)
+        else:
+            # Build anterior à tabela de estatísticas: plano sem saldos
+            df = pd.read_sql(query_plano, _engine)
+            for coluna in colunas_saldo:
+                df[coluna] = np.nan
+
+        for coluna in colunas_saldo:
+            df[coluna] = pd.to_numeric(df[coluna], errors='coerce')
+
+        # Média e desvio amostral a partir de qtd, soma e soma dos quadrados
+        qtd = df['qtd_saldos'].where(df['qtd_saldos'] > 0)
+        media = df['soma_saldo'] / qtd
+        variancia = (df['soma_quadrados_saldo'] - df['soma_saldo'] ** 2 / qtd) / (qtd - 1).where(qtd > 1)
+        desvio = np.sqrt(variancia.clip(lower=0))
+
+        df['media_saldo_milhoes'] = (media / 1e6).fillna(0.0)
+        df['mediana_saldo_milhoes'] = (df['saldo_mediana'] / 1e6).fillna(0.0)
+        df['desvio_saldo_milhoes'] = (desvio / 1e6).fillna(0.0)
+        df['total_saldo_bilhoes'] = (df['soma_saldo'] / 1e9).fillna(0.0)
+        df['min_saldo_milhoes'] = (df['min_saldo'] / 1e6).fillna(0.0)
+        df['max_saldo_milhoes'] = (df['max_saldo'] / 1e6).fillna(0.0)
+        df['coef_variacao'] = (desvio / media.abs().where(media != 0) * 100).fillna(0.0)
+
+        return df.drop(columns=colunas_saldo)
+    except Exception as e:
+        avisar_erro_carga(f"Erro ao carregar plano de contas: {e}")
+        return None
 
-        # Adicionar colunas de saldo com valores padrão (serão carregados sob demanda se necessário)
-        df['media_saldo_milhoes'] = 0.0
-        df['total_saldo_bilhoes'] = 0.0
-        df['min_saldo_milhoes'] = 0.0
-        df['max_saldo_milhoes'] = 0.0
+# Saldos por conta: cache por (build, ano, conta), compartilhado entre sessões,
+# com descarte LRU por quantidade e por tamanho total (cada conta traz todas as
+# empresas e todos os períodos). As sessões recebem cópias.
+LIMITE_CONTAS_CACHE_SALDOS = 200
+LIMITE_BYTES_CACHE_SALDOS = 256 * 1024 ** 2
+TAMANHO_LOTE_CONTAS = 500
 
-        return df
+@st.cache_resource
+def _cache_saldos_contas():
+    """Saldos já buscados de cada conta (DataFrame, bytes), em ordem de uso."""
+    return {'contas': OrderedDict(), 'bytes': 0, 'lock': threading.Lock()}
+
+def carregar_saldos_contas(_engine, cd_contas, ano=None):
+    """Carrega os saldos de várias contas com uma consulta IN; retorna {cd_conta: DataFrame}."""
+    if _engine is None or not cd_contas:
+        return {}
+
+    versao_build = obter_versao_build(_engine)
+    cache = _cache_saldos_contas()
+    cd_contas = list(dict.fromkeys(str(conta) for conta in cd_contas))
+    saldos = {}
+
+    with cache['lock']:
+        for conta in cd_contas:
+            chave = (versao_build, ano, conta)
+            if chave in cache['contas']:
+                cache['contas'].move_to_end(chave)
+                saldos[conta] = cache['contas'][chave][0]
+
+    # Só as contas ainda não buscadas vão para o Impala
+    faltantes = [conta for conta in cd_contas if conta not in saldos]
+    # ecd_saldos_contas_v2 é carregada fora do build (sem ano_fiscal): faixa AAAAMM do ano
+    ano_filter = f"AND ano_referencia BETWEEN {ano}01 AND {ano}12" if ano else ""
+
+    try:
+        for inicio in range(0, len(faltantes), TAMANHO_LOTE_CONTAS):
+            lote = faltantes[inicio:inicio + TAMANHO_LOTE_CONTAS]
+            lista_contas = ", ".join(_literal_sql(conta) for conta in lote)
+            query = f"""
+            SELECT
+                cnpj,
+                cd_conta,
+                saldo_final_contabil,
+                data_fim_periodo
+            FROM {DATABASE}.ecd_saldos_contas_v2
+            WHERE cd_conta IN ({lista_contas})
+                {ano_filter}
+            """
+            df = pd.read_sql(query, _engine)
+            df['cd_conta'] = df['cd_conta'].astype(str)
+            df['saldo_final_contabil'] = pd.to_numeric(df['saldo_final_contabil'], errors='coerce')
+            grupos = dict(tuple(df.groupby('cd_conta', sort=False)))
+
+            with cache['lock']:
+                for conta in lote:
+                    # Conta sem saldos também é guardada (DataFrame vazio)
+                    df_conta = grupos.get(conta, df.iloc[0:0]).sort_values(
+                        ['data_fim_periodo', 'cnpj'], ascending=[False, True]
+                    ).reset_index(drop=True)
+                    chave = (versao_build, ano, conta)
+                    if chave not in cache['contas']:
+                        tamanho = int(df_conta.memory_usage(deep=True).sum())
+                        cache['contas'][chave] = (df_conta, tamanho)
+                        cache['bytes'] += tamanho
+                    saldos[conta] = df_conta
+                # Descartar as menos usadas recentemente
+                while len(cache['contas']) > LIMITE_CONTAS_CACHE_SALDOS or cache['bytes'] > LIMITE_BYTES_CACHE_SALDOS:
+                    _, (_, tamanho_descartada) = cache['contas'].popitem(last=False)
+                    cache['bytes'] -= tamanho_descartada
     except Exception as e:
-        st.error(f"Erro ao carregar plano de contas: {e}")
+        avisar_erro_carga(f"Erro ao carregar saldos das contas: {e}")
         return None
 
-@st.cache_data(ttl=3600)
-def carregar_saldos_conta_especifica(_engine, cd_conta, ano=None):
-    """Carrega saldos de uma conta específica (sob demanda)."""
+    # Cópias: os DataFrames do cache são compartilhados entre sessões
+    return {conta: saldos[conta].copy() for conta in cd_contas}
+
+def resumir_saldos_contas(saldos):
+    """Distribuição do saldo de fim de período por empresa, uma por conta ({cd_conta: dict})."""
+    resumos = {}
+    for conta, df in saldos.items():
+        if df.empty:
+            continue
+        # Último período de cada empresa (os saldos já vêm do mais recente para o mais antigo)
+        ultimos = df.drop_duplicates('cnpj')['saldo_final_contabil']
+        distribuicao = calcular_distribuicao(ultimos)
+        if distribuicao is not None:
+            distribuicao['qtd_registros'] = len(df)
+            resumos[conta] = distribuicao
+    return resumos
+
+def iterar_linhas_saldos(saldos):
+    """Percorre os saldos completos das contas, um DataFrame por conta (para exportação)."""
+    for conta, df in saldos.items():
+        if not df.empty:
+            yield conta, df
+
+@cache_compartilhado(ttl=3600)
+def carregar_rollup_contas_sinteticas(_engine, ano=None):
+    """Carrega o roll-up das contas analíticas por conta sintética ancestral (qualquer nível)."""
     if _engine is None:
         return None
 
-    ano_filter = f"AND ano_referencia = {ano}" if ano else ""
+    ano_filter = f"AND ano_fiscal = {ano}" if ano else ""
 
+    # Closure table: cada conta analítica aparece uma vez para cada ancestral,
+    # então basta agrupar pelo ancestral, sem percorrer a hierarquia
     query = f"""
     SELECT
-        cnpj,
-        cd_conta,
-        saldo_final_contabil,
-        data_fim_periodo
-    FROM {DATABASE}.ecd_saldos_contas_v2
-    WHERE cd_conta = '{cd_conta}'
+        cd_conta_ancestral AS cd_conta,
+        nm_conta_ancestral AS nm_conta,
+        nivel_ancestral AS nivel_conta,
+        COUNT(DISTINCT cd_conta_descendente) AS qtd_contas_analiticas,
+        COUNT(DISTINCT id_ecd) AS qtd_empresas_usam,
+        MAX(profundidade) AS profundidade_max
+    FROM {DATABASE}.ecd_plano_contas_hierarquia
+    WHERE profundidade > 0
+        AND tipo_conta_descendente = 'A'
         {ano_filter}
-    ORDER BY data_fim_periodo DESC
-    LIMIT 1000
+    GROUP BY cd_conta_ancestral, nm_conta_ancestral, nivel_ancestral
+    HAVING COUNT(DISTINCT id_ecd) >= 5
+    ORDER BY qtd_empresas_usam DESC
+    LIMIT 200
     """
 
     try:
         df = pd.read_sql(query, _engine)
         return df
     except Exception as e:
+        avisar_erro_carga(f"Erro ao carregar hierarquia do plano de contas: {e}")
         return None
 
-@st.cache_data(ttl=3600)
+@cache_compartilhado(ttl=3600)
 def carregar_indicios_neaf(_engine, cnpj=None, limite=500):
-    """Carrega indícios de NEAF detalhados."""
+    """Carrega indícios de NEAF por empresa e tipo, do resumo gerado no build (limite=None para todos)."""
     if _engine is None:
         return None
 
-    cnpj_filter = f"WHERE cnpj = '{cnpj}'" if cnpj else ""
+    cnpj_filter = f"WHERE r.cnpj_id = {cnpj_para_id(cnpj)}" if cnpj else ""
+    limite_sql = f"LIMIT {limite}" if limite else ""
 
     query = f"""
     SELECT
-        cnpj,
-        descricao_indicio,
-        complemento_indicio,
-        COUNT(*) as qtd_ocorrencias
-    FROM {DATABASE}.ecd_neaf_indicios
+        r.cnpj,
+        t.descricao_indicio,
+        r.complementos,
+        r.qtd_complementos_distintos,
+        r.qtd_ocorrencias
+    FROM {DATABASE}.ecd_neaf_indicios_resumo r
+    INNER JOIN {DATABASE}.ecd_neaf_tipos_indicio t
+        ON t.id_tipo_indicio = r.id_tipo_indicio
     {cnpj_filter}
-    GROUP BY cnpj, descricao_indicio, complemento_indicio
-    ORDER BY qtd_ocorrencias DESC
-    LIMIT {limite}
+    ORDER BY r.qtd_ocorrencias DESC, r.cnpj
+    {limite_sql}
     """
 
+    if not tabela_disponivel(_engine, 'ecd_neaf_indicios_resumo'):
+        # Build anterior ao resumo (e ao cnpj_id): agrupar os indícios na hora
+        cnpj_filter = f"WHERE r.cnpj = {_literal_sql(cnpj)}" if cnpj else ""
+        query = f"""
+        SELECT
+            r.cnpj,
+            r.descricao_indicio,
+            GROUP_CONCAT(r.complemento_indicio, ' | ') AS complementos,
+            COUNT(r.complemento_indicio) AS qtd_complementos_distintos,
+            SUM(r.qtd) AS qtd_ocorrencias
+        FROM (
+            SELECT cnpj, descricao_indicio, complemento_indicio, COUNT(*) AS qtd
+            FROM {DATABASE}.ecd_neaf_indicios
+            GROUP BY cnpj, descricao_indicio, complemento_indicio
+        ) r
+        {cnpj_filter}
+        GROUP BY r.cnpj, r.descricao_indicio
+        ORDER BY qtd_ocorrencias DESC, r.cnpj
+        {limite_sql}
+        """
+
     try:
         df = pd.read_sql(query, _engine)
         return df
     except Exception as e:
-        st.error(f"Erro ao carregar indícios NEAF: {e}")
+        avisar_erro_carga(f"Erro ao carregar indícios NEAF: {e}")
+        return None
+
+@cache_compartilhado(ttl=3600)
+def carregar_tipos_indicio_neaf(_engine):
+    """Carrega o catálogo de tipos de indício NEAF (código, descrição, empresas e ocorrências)."""
+    if _engine is None:
+        return None
+
+    query = f"""
+    SELECT
+        id_tipo_indicio,
+        descricao_indicio,
+        qtd_empresas,
+        qtd_ocorrencias
+    FROM {DATABASE}.ecd_neaf_tipos_indicio
+    ORDER BY qtd_empresas DESC
+    """
+
+    try:
+        return pd.read_sql(query, _engine)
+    except Exception as e:
+        avisar_erro_carga(f"Erro ao carregar tipos de indício NEAF: {e}")
         return None
 
-@st.cache_data(ttl=3600)
-def carregar_score_neaf(_engine, limite=500):
-    """Carrega scores de risco NEAF."""
+@cache_compartilhado(ttl=3600)
+def carregar_score_neaf(_engine, ano=None, limite=500):
+    """Carrega scores de risco NEAF do ano fiscal (último ano sem filtro; limite=None para todas as empresas)."""
     if _engine is None:
         return None
 
+    # Lê só a partição do ano; indícios contam no ano em que estavam vigentes.
+    # Linhas zeradas marcam empresas que perderam os indícios no recálculo do ano.
+    ano_filter = (
+        f"ns.ano_fiscal = {ano}" if ano else
+        f"ns.ano_fiscal = (SELECT MAX(ano_fiscal) FROM {DATABASE}.ecd_neaf_score_risco WHERE qtd_total_indicios > 0)"
+    )
+
     query = f"""
     SELECT
         ns.cnpj,
+        ns.ano_fiscal,
         ec.nm_razao_social,
         ec.cnae_divisao_descricao as setor,
         ec.cd_uf,
@@ -897,27 +1649,28 @@ def carregar_score_neaf(_engine, limite=500):
         ns.score_risco_neaf,
         ns.classificacao_risco_neaf
     FROM {DATABASE}.ecd_neaf_score_risco ns
-    INNER JOIN {DATABASE}.ecd_empresas_cadastro ec
-        ON ns.cnpj = ec.cnpj
+    INNER JOIN {tabela_empresas(_engine)} ec
+        ON ns.cnpj_id = ec.cnpj_id
+    WHERE {ano_filter}
+        AND ns.qtd_total_indicios > 0
     ORDER BY ns.score_risco_neaf DESC
-    LIMIT {limite}
+    {f'LIMIT {limite}' if limite else ''}
     """
 
     try:
         df = pd.read_sql(query, _engine)
         return df
     except Exception as e:
-        st.error(f"Erro ao carregar score NEAF: {e}")
+        avisar_erro_carga(f"Erro ao carregar score NEAF: {e}")
         return None
 
-@st.cache_data(ttl=3600)
+@cache_compartilhado(ttl=3600)
 def carregar_inconsistencias_equacao(_engine, ano=None, limite=500):
     """Carrega inconsistências na equação contábil."""
     if _engine is None:
         return None
 
-    # ie.ano_referencia é YYYYMM, então filtramos pelo ano
-    ano_filter = f"AND CAST(ie.ano_referencia / 100 AS INT) = {ano}" if ano else ""
+    ano_filter = f"AND ie.ano_fiscal = {ano}" if ano else ""
 
     query = f"""
     SELECT
@@ -934,9 +1687,8 @@ def carregar_inconsistencias_equacao(_engine, ano=None, limite=500):
         ie.classificacao_inconsistencia,
         ie.score_risco_equacao
     FROM {DATABASE}.ecd_inconsistencias_equacao ie
-    INNER JOIN {DATABASE}.ecd_empresas_cadastro ec
-        ON ie.cnpj = ec.cnpj
-        AND ie.ano_referencia = ec.ano_referencia
+    INNER JOIN {tabela_empresas(_engine)} ec
+        ON ie.cnpj_id = ec.cnpj_id
     WHERE ie.classificacao_inconsistencia != 'OK'
         {ano_filter}
     ORDER BY ie.score_risco_equacao DESC, ABS(ie.diferenca_absoluta) DESC
@@ -947,16 +1699,16 @@ def carregar_inconsistencias_equacao(_engine, ano=None, limite=500):
         df = pd.read_sql(query, _engine)
         return df
     except Exception as e:
-        st.error(f"Erro ao carregar inconsistências: {e}")
+        avisar_erro_carga(f"Erro ao carregar inconsistências: {e}")
         return None
 
-@st.cache_data(ttl=3600)
+@cache_compartilhado(ttl=3600)
 def carregar_inconsistencias_variacoes(_engine, ano=None, limite=500):
     """Carrega variações anômalas de contas."""
     if _engine is None:
         return None
 
-    ano_filter = f"AND iv.ano_referencia = {ano}" if ano else ""
+    ano_filter = f"AND iv.ano_fiscal = {ano}" if ano else ""
 
     query = f"""
     SELECT
@@ -973,8 +1725,8 @@ def carregar_inconsistencias_variacoes(_engine, ano=None, limite=500):
         iv.classificacao_variacao,
         iv.score_risco_variacao
     FROM {DATABASE}.ecd_inconsistencias_variacoes iv
-    INNER JOIN {DATABASE}.ecd_empresas_cadastro ec
-        ON iv.cnpj = ec.cnpj
+    INNER JOIN {tabela_empresas(_engine)} ec
+        ON iv.cnpj_id = ec.cnpj_id
     WHERE iv.classificacao_variacao IN ('Variação Extrema', 'Variação Muito Alta', 'Variação Alta')
         {ano_filter}
     ORDER BY iv.score_risco_variacao DESC, ABS(iv.variacao_percentual) DESC
@@ -985,18 +1737,25 @@ def carregar_inconsistencias_variacoes(_engine, ano=None, limite=500):
         df = pd.read_sql(query, _engine)
         return df
     except Exception as e:
-        st.error(f"Erro ao carregar variações: {e}")
+        avisar_erro_carga(f"Erro ao carregar variações: {e}")
         return None
 
-@st.cache_data(ttl=3600)
+@cache_compartilhado(ttl=3600)
 def carregar_benchmark_setorial(_engine, ano=None):
     """Carrega benchmark setorial por CNAE."""
     if _engine is None:
         return None
 
-    # Primeiro, tentar carregar da tabela de benchmark
+    # Tabela de benchmark sem dados (segundo o catálogo) - gerar a partir de indicadores
+    if not tabela_disponivel(_engine, 'ecd_benchmark_setorial'):
+        try:
+            return _gerar_benchmark_dinamico(_engine, ano)
+        except Exception as e:
+            avisar_erro_carga(f"Erro ao carregar benchmark setorial: {e}")
+            return None
+
     try:
-        ano_filter = f"WHERE ano_referencia = {ano}" if ano else ""
+        ano_filter = f"WHERE ano_fiscal = {ano}" if ano else ""
 
         query = f"""
         SELECT
@@ -1029,20 +1788,15 @@ def carregar_benchmark_setorial(_engine, ano=None):
         if df is not None and not df.empty:
             return df
 
-        # Tabela vazia - gerar benchmark a partir de indicadores
+        # Sem benchmark para o ano - gerar a partir de indicadores
         return _gerar_benchmark_dinamico(_engine, ano)
-
     except Exception as e:
-        # Tabela não existe - gerar benchmark dinamicamente
-        try:
-            return _gerar_benchmark_dinamico(_engine, ano)
-        except Exception as e2:
-            st.error(f"Erro ao carregar benchmark setorial: {e2}")
-            return None
+        avisar_erro_carga(f"Erro ao carregar benchmark setorial: {e}")
+        return None
 
 def _gerar_benchmark_dinamico(_engine, ano=None):
-    """Gera benchmark setorial dinamicamente a partir dos dados de indicadores."""
-    ano_filter = f"AND ind.ano_referencia = {ano}" if ano else ""
+    """Gera benchmark setorial dinamicamente a partir dos dados de indicadores (um valor por empresa e ano)."""
+    ano_filter = f"AND ind.ano_fiscal = {ano}" if ano else ""
 
     query = f"""
     SELECT
@@ -1053,7 +1807,7 @@ def _gerar_benchmark_dinamico(_engine, ano=None):
         COALESCE(ec.cnae_divisao, 'N/A') as cnae_divisao,
         COALESCE(ec.cnae_divisao_descricao, ec.de_cnae, 'Não Classificado') as cnae_divisao_descricao,
         {ano if ano else 2024} as ano_referencia,
-        COUNT(DISTINCT ec.cnpj) as qtd_empresas_setor,
+        COUNT(DISTINCT ec.cnpj_id) as qtd_empresas_setor,
         ROUND(AVG(ind.ativo_total), 2) as media_ativo_total_setor,
         ROUND(AVG(ind.receita_liquida), 2) as media_receita_liquida_setor,
         ROUND(AVG(ind.resultado_liquido), 2) as media_resultado_liquido_setor,
@@ -1065,9 +1819,9 @@ def _gerar_benchmark_dinamico(_engine, ano=None):
         ROUND(MAX(ind.liquidez_corrente), 2) as max_liquidez_setor,
         ROUND(MIN(ind.margem_liquida_perc), 2) as min_margem_liquida_setor,
         ROUND(MAX(ind.margem_liquida_perc), 2) as max_margem_liquida_setor
-    FROM {DATABASE}.ecd_indicadores_financeiros ind
-    LEFT JOIN {DATABASE}.ecd_empresas_cadastro ec
-        ON ind.cnpj = ec.cnpj
+    FROM {sql_ultimo_periodo('ecd_indicadores_financeiros')} ind
+    LEFT JOIN {tabela_empresas(_engine)} ec
+        ON ind.cnpj_id = ec.cnpj_id
     WHERE 1=1
         {ano_filter}
     GROUP BY
@@ -1076,7 +1830,7 @@ def _gerar_benchmark_dinamico(_engine, ano=None):
         COALESCE(ec.cnae_secao, 'N/A'),
         COALESCE(ec.cnae_secao_descricao, 'Não Classificado'),
         COALESCE(ec.cnae_divisao_descricao, ec.de_cnae, 'Não Classificado')
-    HAVING COUNT(DISTINCT ec.cnpj) >= 3
+    HAVING COUNT(DISTINCT ec.cnpj_id) >= 3
     ORDER BY qtd_empresas_setor DESC
     LIMIT 100
     """
@@ -1084,13 +1838,14 @@ def _gerar_benchmark_dinamico(_engine, ano=None):
     df = pd.read_sql(query, _engine)
     return df
 
-@st.cache_data(ttl=3600)
-def carregar_empresas_suspeitas_indicador(_engine, indicador, threshold_min=None, threshold_max=None, ano=None):
-    """Carrega empresas suspeitas para um indicador específico."""
+@cache_compartilhado(ttl=3600)
+def carregar_empresas_suspeitas_indicador(_engine, indicador, threshold_min=None, threshold_max=None, ano=None,
+                                          cursor=None, tamanho_pagina=100):
+    """Carrega uma página de empresas suspeitas para um indicador específico (paginação por cursor)."""
     if _engine is None:
-        return None
+        return None, None
     
-    ano_filter = f"AND ind.ano_referencia = {ano}" if ano else ""
+    ano_filter = f"AND ind.ano_fiscal = {ano}" if ano else ""
     
     # Mapear indicador para coluna e condições
     condicoes = {
@@ -1102,51 +1857,896 @@ def carregar_empresas_suspeitas_indicador(_engine, indicador, threshold_min=None
     }
     
     if indicador not in condicoes:
-        return None
+        return None, None
     
     coluna, condicao, ordem = condicoes[indicador]
+    ordem_pagina = [('valor_indicador', ordem), ('cnpj', 'ASC'), ('ano_fiscal', 'DESC')]
     
+    # Médias do setor calculadas sobre todo o conjunto antes de aplicar o cursor
     query = f"""
-    SELECT 
-        ec.cnpj,
-        ec.nm_razao_social,
-        ec.cd_uf,
-        COALESCE(ec.cnae_divisao_descricao, ec.de_cnae, 'Não Classificado') as setor,
-        ROUND(ind.{coluna}, 2) as valor_indicador,
-        ROUND(ind.ativo_total / 1000000, 2) as ativo_milhoes,
-        ROUND(ind.receita_liquida / 1000000, 2) as receita_milhoes,
-        sr.score_risco_total,
+    SELECT t.*
+    FROM (
+        SELECT 
+            ind.cnpj,
+            ind.ano_fiscal,
+            ec.nm_razao_social,
+            ec.cd_uf,
+            COALESCE(ec.cnae_divisao_descricao, ec.de_cnae, 'Não Classificado') as setor,
+            ROUND(ind.{coluna}, 2) as valor_indicador,
+            ROUND(ind.ativo_total / 1000000, 2) as ativo_milhoes,
+            ROUND(ind.receita_liquida / 1000000, 2) as receita_milhoes,
+            sr.score_risco_total,
+
+            -- Média do setor
+            ROUND(AVG(ind.{coluna}) OVER (PARTITION BY COALESCE(ec.cnae_divisao_descricao, ec.de_cnae, 'Não Classificado')), 2) as media_setor,
+
+            -- Desvio da média
+            ROUND(ind.{coluna} - AVG(ind.{coluna}) OVER (PARTITION BY COALESCE(ec.cnae_divisao_descricao, ec.de_cnae, 'Não Classificado')), 2) as desvio_setor
+
+        FROM {sql_ultimo_periodo('ecd_indicadores_financeiros')} ind
+        INNER JOIN {tabela_empresas(_engine)} ec
+            ON ind.cnpj_id = ec.cnpj_id
+        LEFT JOIN {sql_ultimo_periodo('ecd_score_risco_consolidado')} sr
+            ON ind.cnpj_id = sr.cnpj_id
+            AND ind.ano_fiscal = sr.ano_fiscal
+        WHERE {condicao}
+            {ano_filter}
+    ) t
+    WHERE {_filtro_keyset(ordem_pagina, cursor)}
+    ORDER BY {_ordenacao_sql(ordem_pagina)}
+    LIMIT {int(tamanho_pagina) + 1}
+    """
+    
+    try:
+        df = pd.read_sql(query, _engine)
+        return _paginar(df, ordem_pagina, tamanho_pagina)
+    except Exception as e:
+        avisar_erro_carga(f"Erro ao carregar empresas suspeitas: {e}")
+        return None, None
 
-        -- Média do setor
-        ROUND(AVG(ind.{coluna}) OVER (PARTITION BY COALESCE(ec.cnae_divisao_descricao, ec.de_cnae, 'Não Classificado')), 2) as media_setor,
+# -----------------------------------------------------------------------------
+# Distribuições por empresa (resumos compactos para os gráficos)
+# -----------------------------------------------------------------------------
+# Os valores por empresa não vão para o navegador: são resumidos em quantis,
+# estatísticas do box plot e faixas do histograma, por indicador x setor x ano.
+
+INDICADORES_DISTRIBUICAO = {
+    'Liquidez Corrente': 'liquidez_corrente',
+    'Endividamento Geral': 'endividamento_geral',
+    'Margem Líquida': 'margem_liquida_perc',
+    'ROA': 'roa_retorno_ativo_perc',
+    'ROE': 'roe_retorno_patrimonio_perc'
+}
+
+QUANTIS_DISTRIBUICAO = [1, 5, 25, 50, 75, 95, 99]
+
+QTD_FAIXAS_HISTOGRAMA = 40
+
+def calcular_distribuicao(valores, qtd_faixas=QTD_FAIXAS_HISTOGRAMA):
+    """Resume os valores em quantis, estatísticas do box plot e faixas do histograma."""
+    valores = np.asarray(valores, dtype=float)
+    valores = valores[np.isfinite(valores)]
+    if len(valores) == 0:
+        return None
 
-        -- Desvio da média
-        ROUND(ind.{coluna} - AVG(ind.{coluna}) OVER (PARTITION BY COALESCE(ec.cnae_divisao_descricao, ec.de_cnae, 'Não Classificado')), 2) as desvio_setor
+    quantis = dict(zip([f"p{q}" for q in QUANTIS_DISTRIBUICAO], np.percentile(valores, QUANTIS_DISTRIBUICAO)))
+
+    # Box plot de Tukey: bigodes até o último valor dentro de 1,5 x IQR
+    iqr = quantis['p75'] - quantis['p25']
+    dentro = valores[(valores >= quantis['p25'] - 1.5 * iqr) & (valores <= quantis['p75'] + 1.5 * iqr)]
+
+    # Histograma entre p1 e p99; os extremos são contados à parte
+    inicio_hist, fim_hist = quantis['p1'], quantis['p99']
+    if fim_hist <= inicio_hist:
+        fim_hist = inicio_hist + 1
+    contagens, bordas = np.histogram(valores, bins=qtd_faixas, range=(inicio_hist, fim_hist))
+
+    return {
+        'qtd': len(valores),
+        'media': float(valores.mean()),
+        'desvio': float(valores.std(ddof=1)) if len(valores) > 1 else 0.0,
+        'minimo': float(valores.min()),
+        'maximo': float(valores.max()),
+        'quantis': quantis,
+        'box': {
+            'q1': quantis['p25'],
+            'mediana': quantis['p50'],
+            'q3': quantis['p75'],
+            'bigode_inferior': float(dentro.min()),
+            'bigode_superior': float(dentro.max()),
+            'qtd_outliers': int(len(valores) - len(dentro))
+        },
+        'histograma': {
+            'bordas': bordas,
+            'contagens': contagens,
+            'abaixo': int((valores < inicio_hist).sum()),
+            'acima': int((valores > fim_hist).sum())
+        }
+    }
 
-    FROM {DATABASE}.ecd_indicadores_financeiros ind
-    INNER JOIN {DATABASE}.ecd_empresas_cadastro ec
-        ON ind.cnpj = ec.cnpj
-        AND ind.ano_referencia = CAST(ec.ano_referencia / 100 AS INT)
-    LEFT JOIN {DATABASE}.ecd_score_risco_consolidado sr
-        ON ind.cnpj = sr.cnpj
-        AND ind.ano_referencia = sr.ano_referencia
-    WHERE {condicao}
+def _ultimo_periodo_snapshot(df):
+    """Uma linha por (cnpj_id, ano): o período mais recente do ano (como sql_ultimo_periodo)."""
+    df = df.sort_values(['periodo_aaaamm', 'ano_referencia'], kind='stable')
+    return df.drop_duplicates(['cnpj_id', 'ano'], keep='last').drop(columns=['periodo_aaaamm', 'ano_referencia'])
+
+def _carregar_valores_indicador(_engine, coluna, ano=None):
+    """Valores do indicador com o setor, um por empresa e ano (snapshot local ou consulta de duas colunas)."""
+    versao_build = obter_versao_build(_engine)
+
+    if {'indicadores', 'cadastro'} <= set(status_snapshot_empresas(versao_build)):
+        indicadores = _abrir_snapshot(versao_build, 'indicadores')['colunas']
+        cadastro = _abrir_snapshot(versao_build, 'cadastro')['colunas']
+
+        df_ind = pd.DataFrame({
+            'cnpj_id': indicadores['cnpj_id'],
+            'ano': indicadores['ano_fiscal'],
+            'periodo_aaaamm': indicadores['periodo_aaaamm'],
+            'ano_referencia': indicadores['ano_referencia'],
+            'valor': indicadores[coluna]
+        })
+        if ano:
+            df_ind = df_ind[df_ind['ano'] == ano]
+        # Balancetes mensais: sem isso a empresa entraria uma vez por período
+        df_ind = _ultimo_periodo_snapshot(df_ind)
+
+        # Mesmo setor das consultas: divisão CNAE, descrição CNAE ou 'Não Classificado'
+        setor = pd.Series(cadastro['cnae_divisao_descricao'])
+        setor = setor.where(setor != '', pd.Series(cadastro['de_cnae'])).replace('', 'Não Classificado')
+        df_cad = _ultimo_periodo_snapshot(pd.DataFrame({
+            'cnpj_id': cadastro['cnpj_id'],
+            'ano': cadastro['ano_fiscal'],
+            'periodo_aaaamm': cadastro['periodo_aaaamm'],
+            'ano_referencia': cadastro['ano_referencia'],
+            'setor': setor
+        }))
+        return df_ind.merge(df_cad, on=['cnpj_id', 'ano'])[['setor', 'valor']]
+
+    ano_filter = f"AND ind.ano_fiscal = {ano}" if ano else ""
+
+    query = f"""
+    SELECT
+        COALESCE(ec.cnae_divisao_descricao, ec.de_cnae, 'Não Classificado') as setor,
+        ind.{coluna} as valor
+    FROM {sql_ultimo_periodo('ecd_indicadores_financeiros')} ind
+    INNER JOIN {sql_ultimo_periodo('ecd_empresas_cadastro')} ec
+        ON ind.cnpj_id = ec.cnpj_id
+        AND ind.ano_fiscal = ec.ano_fiscal
+    WHERE ind.{coluna} IS NOT NULL
         {ano_filter}
-    ORDER BY valor_indicador {ordem}
-    LIMIT 100
     """
-    
+    return pd.read_sql(query, _engine)
+
+@cache_compartilhado(ttl=3600)
+def carregar_distribuicao_indicador(_engine, indicador, ano=None):
+    """Distribuição por empresa de um indicador, geral e por setor (somente os resumos)."""
+    if _engine is None or indicador not in INDICADORES_DISTRIBUICAO:
+        return None
+
+    try:
+        df = _carregar_valores_indicador(_engine, INDICADORES_DISTRIBUICAO[indicador], ano)
+    except Exception as e:
+        avisar_erro_carga(f"Erro ao carregar distribuição do indicador: {e}")
+        return None
+
+    if df is None or df.empty:
+        return None
+
+    df['valor'] = pd.to_numeric(df['valor'], errors='coerce')
+    setores = {setor: calcular_distribuicao(grupo['valor']) for setor, grupo in df.groupby('setor')}
+    return {
+        'geral': calcular_distribuicao(df['valor']),
+        'setores': {setor: dist for setor, dist in setores.items() if dist is not None}
+    }
+
+# Tabelas gravadas pelo build (ordem de execução)
+TABELAS_BUILD = [
+    'ecd_empresas_cadastro',
+    'ecd_empresa_dim',
+    'ecd_plano_contas_arestas',
+    'ecd_plano_contas_hierarquia',
+    'ecd_plano_contas',
+    'ecd_saldos_contas_v2',
+    'ecd_saldos_contas_estatisticas',
+    'ecd_balanco_patrimonial',
+    'ecd_dre',
+    'ecd_indicadores_financeiros',
+    'ecd_neaf_indicios',
+    'ecd_neaf_tipos_indicio',
+    'ecd_neaf_indicios_resumo',
+    'ecd_neaf_indicios_vigencia',
+    'ecd_neaf_score_risco',
+    'ecd_inconsistencias_equacao',
+    'ecd_inconsistencias_variacoes',
+    'ecd_benchmark_setorial',
+    'ecd_score_risco_consolidado'
+]
+
+@st.cache_resource
+def obter_estado_cache():
+    """Estado compartilhado entre sessões para invalidação do cache por versão do build."""
+    return {'versao_build': None}
+
+@st.cache_data(ttl=300)
+def obter_versao_build(_engine):
+    """Retorna o id do último build concluído (usado como versão dos dados)."""
+    if _engine is None:
+        return None
+
+    query = f"""
+    SELECT MAX(id_build) AS id_build
+    FROM {DATABASE}.ecd_build_metrics
+    WHERE etapa = 'fim_build'
+    """
+
+    try:
+        df = pd.read_sql(query, _engine)
+        versao = df.iloc[0]['id_build']
+        return str(versao) if pd.notna(versao) else None
+    except Exception:
+        # Tabela de telemetria ainda não criada
+        return None
+
+@cache_compartilhado(ttl=3600)
+def carregar_metricas_build(_engine, qtd_builds=30):
+    """Carrega a telemetria por etapa dos últimos builds."""
+    if _engine is None:
+        return None
+
+    query = f"""
+    SELECT
+        m.id_build,
+        m.etapa,
+        m.dt_inicio,
+        m.dt_fim,
+        unix_timestamp(m.dt_fim) - unix_timestamp(m.dt_inicio) AS duracao_seg,
+        m.linhas_entrada,
+        m.linhas_saida,
+        m.qtd_cnpjs,
+        m.taxa_nulos_cnpj,
+        m.coluna_chave,
+        m.taxa_nulos_chave
+    FROM {DATABASE}.ecd_build_metrics m
+    INNER JOIN (
+        SELECT DISTINCT id_build
+        FROM {DATABASE}.ecd_build_metrics
+        ORDER BY id_build DESC
+        LIMIT {int(qtd_builds)}
+    ) ub ON m.id_build = ub.id_build
+    WHERE m.etapa NOT IN ('inicio_build', 'fim_build')
+    ORDER BY m.id_build, m.dt_fim
+    """
+
     try:
         df = pd.read_sql(query, _engine)
+        df['duracao_min'] = pd.to_numeric(df['duracao_seg'], errors='coerce') / 60
         return df
     except Exception as e:
-        st.error(f"Erro ao carregar empresas suspeitas: {e}")
+        avisar_erro_carga(f"Erro ao carregar métricas do build: {e}")
+        return None
+
+def _converter_tamanho_bytes(tamanho):
+    """Converte o tamanho do SHOW TABLE STATS (ex.: '1.25GB') em bytes."""
+    unidades = {'B': 1, 'KB': 1024, 'MB': 1024 ** 2, 'GB': 1024 ** 3, 'TB': 1024 ** 4}
+    texto = str(tamanho).strip().upper()
+    for unidade in ['TB', 'GB', 'MB', 'KB', 'B']:
+        if texto.endswith(unidade):
+            try:
+                return int(float(texto[:-len(unidade)]) * unidades[unidade])
+            except ValueError:
+                return None
+    return None
+
+@cache_compartilhado(ttl=3600)
+def carregar_catalogo_tabelas(_engine, versao_build=None):
+    """Catálogo de disponibilidade das tabelas do build (SHOW TABLES / SHOW TABLE STATS, sem varrer dados)."""
+    if _engine is None:
         return None
 
+    try:
+        df_tabelas = pd.read_sql(f"SHOW TABLES IN {DATABASE}", _engine)
+        existentes = set(df_tabelas.iloc[:, 0].astype(str).str.lower())
+    except Exception:
+        # Sem a listagem, considerar todas e deixar o SHOW TABLE STATS decidir
+        existentes = set(TABELAS_BUILD)
+
+    registros = []
+    for tabela in TABELAS_BUILD:
+        registro = {'tabela': tabela, 'existe': tabela in existentes, 'linhas': None, 'arquivos': None, 'bytes': None}
+
+        if registro['existe']:
+            try:
+                df_stats = pd.read_sql(f"SHOW TABLE STATS {DATABASE}.{tabela}", _engine)
+                # Em tabelas particionadas a última linha é o 'Total'
+                total = df_stats.iloc[-1]
+                registro['linhas'] = pd.to_numeric(total.get('#Rows'), errors='coerce')
+                registro['arquivos'] = pd.to_numeric(total.get('#Files'), errors='coerce')
+                registro['bytes'] = _converter_tamanho_bytes(total.get('Size'))
+            except Exception:
+                registro['existe'] = False
+
+        # #Rows = -1 significa estatísticas não computadas: usar o tamanho em disco
+        if not registro['existe']:
+            registro['com_dados'] = False
+        elif pd.notna(registro['linhas']) and registro['linhas'] >= 0:
+            registro['com_dados'] = registro['linhas'] > 0
+        elif registro['bytes'] is not None:
+            registro['com_dados'] = registro['bytes'] > 0
+        else:
+            registro['com_dados'] = True
+
+        registros.append(registro)
+
+    return pd.DataFrame(registros)
+
+def tabela_disponivel(_engine, tabela):
+    """Indica se a tabela existe e tem dados, segundo o catálogo da versão atual do build."""
+    catalogo = carregar_catalogo_tabelas(_engine, obter_versao_build(_engine))
+
+    # Sem catálogo, tentar a consulta normalmente
+    if catalogo is None or catalogo.empty or tabela not in catalogo['tabela'].values:
+        return True
+
+    return bool(catalogo.loc[catalogo['tabela'] == tabela, 'com_dados'].iloc[0])
+
+def sql_ultimo_periodo(tabela):
+    """Subconsulta da tabela com uma linha por (cnpj_id, ano_fiscal): o período mais recente do ano."""
+    return f"""(
+        SELECT *
+        FROM (
+            SELECT x.*, ROW_NUMBER() OVER (
+                PARTITION BY x.cnpj_id, x.ano_fiscal
+                ORDER BY x.periodo_aaaamm DESC, x.ano_referencia DESC
+            ) AS rn_periodo
+            FROM {DATABASE}.{tabela} x
+        ) u
+        WHERE u.rn_periodo = 1
+    )"""
+
+def tabela_empresas(_engine):
+    """Fonte de atributos por cnpj com uma linha por empresa (dimensão ou cadastro mais recente)."""
+    if tabela_disponivel(_engine, 'ecd_empresa_dim'):
+        return f"{DATABASE}.ecd_empresa_dim"
+
+    # Sem a dimensão, deduplicar o cadastro na consulta para não multiplicar linhas no join
+    return f"""(
+        SELECT *
+        FROM (
+            SELECT c.*, ROW_NUMBER() OVER (PARTITION BY c.cnpj_id ORDER BY c.ano_referencia DESC) AS rn
+            FROM {DATABASE}.ecd_empresas_cadastro c
+        ) cr
+        WHERE cr.rn = 1
+    )"""
+
+# -----------------------------------------------------------------------------
+# Cargas em segundo plano (aquecimento do cache e pré-carga de páginas)
+# -----------------------------------------------------------------------------
+
+QTD_WORKERS_CARGA = 3
+
+# Menor valor = executa antes
+PRIORIDADE_PREFETCH = 0
+
+# Espera (s) antes de repetir uma carga que falhou
+INTERVALO_NOVA_TENTATIVA_CARGA = 300
+
+def _executar_cargas(agendador):
+    """Worker: consome a fila de cargas e chama os carregadores (populando o cache compartilhado)."""
+    while True:
+        _, _, chave, funcao, args, kwargs = agendador['fila'].get()
+        with agendador['lock']:
+            agendador['tarefas'][chave] = {'status': 'executando', 'instante': time.time()}
+        _erro_carga.mensagem = None
+        try:
+            # Os carregadores tratam os próprios erros e devolvem None ou (None, None)
+            status = 'erro' if _resultado_falhou(funcao(*args, **kwargs)) else 'concluido'
+            erro = _erro_carga.mensagem
+        except Exception as e:
+            status, erro = 'erro', str(e)
+        with agendador['lock']:
+            agendador['tarefas'][chave] = {'status': status, 'instante': time.time(), 'erro': erro}
+        agendador['fila'].task_done()
+
+@st.cache_resource
+def _agendador_cargas():
+    """Fila de cargas com prioridade e workers (compartilhados entre sessões)."""
+    agendador = {
+        'fila': PriorityQueue(),
+        'tarefas': {},
+        'lock': threading.Lock(),
+        'sequencia': itertools.count()
+    }
+    for i in range(QTD_WORKERS_CARGA):
+        threading.Thread(target=_executar_cargas, args=(agendador,), daemon=True, name=f"carga-{i}").start()
+    return agendador
+
+def _chave_carga(funcao, args, kwargs):
+    """Chave da carga: função + argumentos (o primeiro é o engine, ignorado como no cache)."""
+    return (funcao.__name__, repr(args[1:]), repr(sorted(kwargs.items())))
+
+def agendar_carga(prioridade, funcao, *args, **kwargs):
+    """Enfileira uma carga; cargas iguais pendentes, em execução, ainda no cache ou que acabaram de falhar não são repetidas."""
+    agendador = _agendador_cargas()
+    chave = _chave_carga(funcao, args, kwargs)
+
+    with agendador['lock']:
+        tarefa = agendador['tarefas'].get(chave)
+        if tarefa is not None:
+            em_andamento = tarefa['status'] in ('pendente', 'executando')
+            recente = tarefa['status'] == 'concluido' and time.time() - tarefa['instante'] < TTL_CACHE
+            falha_recente = tarefa['status'] == 'erro' and time.time() - tarefa['instante'] < INTERVALO_NOVA_TENTATIVA_CARGA
+            if em_andamento or recente or falha_recente:
+                return chave
+        agendador['tarefas'][chave] = {'status': 'pendente', 'instante': time.time()}
+
+    agendador['fila'].put((prioridade, next(agendador['sequencia']), chave, funcao, args, kwargs))
+    return chave
+
+def status_cargas(chaves):
+    """Retorna o status de cada carga agendada."""
+    agendador = _agendador_cargas()
+    with agendador['lock']:
+        return [agendador['tarefas'].get(chave, {}).get('status', 'pendente') for chave in chaves]
+
+def limpar_status_cargas():
+    """Esquece as cargas concluídas (após limpar o cache, elas precisam ser refeitas)."""
+    agendador = _agendador_cargas()
+    with agendador['lock']:
+        for chave in [c for c, t in agendador['tarefas'].items() if t['status'] in ('concluido', 'erro')]:
+            del agendador['tarefas'][chave]
+
+def prefetch_pagina(funcao, *args, **kwargs):
+    """Pré-carrega em segundo plano uma página (popula o cache da função)."""
+    agendar_carga(PRIORIDADE_PREFETCH, funcao, *args, **kwargs)
+
+def agendar_aquecimento(_engine, ano):
+    """Enfileira as cargas das páginas principais para o ano selecionado."""
+    # Argumentos idênticos aos das páginas, para que a chave do cache coincida
+    cargas = [
+        (1, carregar_indicadores_agregados, (_engine, ano), {}),
+        (2, carregar_pagina_alto_risco, (_engine,), {'ano': ano, 'cursor': None, 'tamanho_pagina': 200, 'score_minimo': 5, 'uf': None}),
+        (3, carregar_benchmark_setorial, (_engine,), {'ano': ano}),
+        (4, carregar_score_neaf, (_engine,), {'ano': ano, 'limite': None}),
+        (5, carregar_inconsistencias_equacao, (_engine,), {'ano': ano, 'limite': 500}),
+        (5, carregar_inconsistencias_variacoes, (_engine,), {'ano': ano, 'limite': 500}),
+        (6, carregar_plano_contas_agregado, (_engine, ano), {}),
+        (6, carregar_rollup_contas_sinteticas, (_engine, ano), {}),
+        (7, carregar_distribuicao_indicador, (_engine, 'Liquidez Corrente'), {'ano': ano}),
+        (8, calcular_coocorrencia_neaf, (_engine, obter_versao_build(_engine)), {})
+    ]
+    return [agendar_carga(prioridade, funcao, *args, **kwargs) for prioridade, funcao, args, kwargs in cargas]
+
+# -----------------------------------------------------------------------------
+# Snapshots locais das tabelas por empresa (consulta pontual sem ir ao Impala)
+# -----------------------------------------------------------------------------
+# Cada parte de PARTES_EMPRESA é gravada ordenada por cnpj, com um arquivo .npy
+# por coluna (aberto com memory-map). O índice cnpj -> faixa de linhas (chaves
+# ordenadas + início de cada faixa) localiza o histórico da empresa por busca
+# binária. Há uma pasta por versão do build; as anteriores são descartadas.
+# A leitura é feita em blocos (a consulta já vem ordenada por cnpj_id): a
+# memória fica limitada a um bloco, e não à tabela inteira. Falhas ficam
+# registradas para a página de Operações e a nova tentativa espera cada vez mais.
+
+DIRETORIO_SNAPSHOTS = os.environ.get(
+    'ECD_DIRETORIO_SNAPSHOTS',
+    os.path.join(os.path.dirname(os.path.abspath(__file__)), 'snapshots')
+)
+
+# Geração dos snapshots roda depois do aquecimento das páginas
+PRIORIDADE_SNAPSHOT = 9
+
+# Linhas lidas do Impala por bloco
+TAMANHO_BLOCO_SNAPSHOT = 200_000
+
+# Espera (s) após uma falha na geração; dobra a cada falha seguinte, até o máximo
+ESPERA_FALHA_SNAPSHOT = 15 * 60
+ESPERA_MAXIMA_FALHA_SNAPSHOT = 24 * 3600
+
+def _diretorio_snapshot(versao_build):
+    """Pasta dos snapshots de uma versão do build."""
+    return os.path.join(DIRETORIO_SNAPSHOTS, str(versao_build))
+
+def _coluna_para_array(serie):
+    """Converte a coluna em array de tipo fixo (necessário para o memory-map)."""
+    if serie.dtype != object:
+        return serie.to_numpy()
+    valores = serie.dropna()
+    # DECIMAL do Impala chega como objeto Decimal
+    if len(valores) and valores.map(lambda v: isinstance(v, numbers.Number)).all():
+        return pd.to_numeric(serie, errors='coerce').to_numpy()
+    return serie.map(lambda v: '' if v is None or v != v else str(v)).to_numpy(dtype=str)
+
+def _tipo_coluna_snapshot(blocos):
+    """Tipo único da coluna entre os blocos; blocos só de nulos (texto vazio) não impõem texto a uma coluna de valores."""
+    textos = [b for b in blocos if b.dtype.kind == 'U']
+    valores = [b.dtype for b in blocos if b.dtype.kind != 'U']
+    if valores and not any((b != '').any() for b in textos):
+        tipo = np.result_type(*valores)
+        # Blocos só de nulos viram NaN
+        return np.result_type(tipo, np.float64) if textos and tipo.kind in 'biu' else tipo
+    # Texto de tamanho fixo: o maior dos blocos (valores convertidos cabem em 32 caracteres)
+    return np.dtype(f"<U{max([b.dtype.itemsize // 4 for b in textos] + [32 if valores else 1])}")
+
+def _ajustar_bloco_snapshot(bloco, tipo):
+    """Converte o bloco para o tipo da coluna (bloco só de nulos vira NaN/NaT)."""
+    if bloco.dtype.kind == 'U' and tipo.kind != 'U':
+        return np.full(len(bloco), np.datetime64('NaT') if tipo.kind == 'M' else np.nan, dtype=tipo)
+    return bloco.astype(tipo)
+
+def _gravar_snapshot_parte(pasta, blocos):
+    """Grava as colunas e o índice cnpj_id -> faixa de linhas de uma parte, bloco a bloco (blocos em ordem de cnpj_id)."""
+    os.makedirs(pasta)
+    colunas, arquivos_blocos = [], []
+    chaves, inicios = [], []
+    total, ultima_chave = 0, None
+
+    for numero, df in enumerate(blocos):
+        colunas = list(df.columns)
+        chaves_bloco = df['cnpj_id'].to_numpy(dtype=np.int64)
+        if len(chaves_bloco) == 0:
+            continue
+        anteriores = np.r_[chaves_bloco[0] - 1 if ultima_chave is None else ultima_chave, chaves_bloco[:-1]]
+        if (chaves_bloco < anteriores).any():
+            raise ValueError("Consulta do snapshot fora de ordem de cnpj_id")
+        # Início de cada empresa (a que continua do bloco anterior não abre faixa nova)
+        novas = np.flatnonzero(chaves_bloco != anteriores)
+        chaves.append(chaves_bloco[novas])
+        inicios.append(novas + total)
+        total += len(chaves_bloco)
+        ultima_chave = chaves_bloco[-1]
+
+        arquivos = {}
+        for posicao, coluna in enumerate(colunas):
+            arquivos[coluna] = os.path.join(pasta, f"_bloco_{numero}_{posicao}.npy")
+            np.save(arquivos[coluna], _coluna_para_array(df[coluna]))
+        arquivos_blocos.append(arquivos)
+
+    chaves = np.concatenate(chaves) if chaves else np.array([], dtype=np.int64)
+    inicios = np.concatenate(inicios) if inicios else np.array([], dtype=np.int64)
+    np.save(os.path.join(pasta, '_chaves.npy'), chaves)
+    np.save(os.path.join(pasta, '_inicios.npy'), np.r_[inicios, total].astype(np.int64))
+
+    # Junta os blocos de cada coluna direto no arquivo final (memory-map)
+    for coluna in colunas:
+        partes = [np.load(arquivos[coluna], mmap_mode='r') for arquivos in arquivos_blocos]
+        if not partes:
+            np.save(os.path.join(pasta, f"{coluna}.npy"), np.array([]))
+            continue
+        tipo = _tipo_coluna_snapshot(partes)
+        destino = np.lib.format.open_memmap(os.path.join(pasta, f"{coluna}.npy"), mode='w+', dtype=tipo, shape=(total,))
+        inicio = 0
+        for parte in partes:
+            destino[inicio:inicio + len(parte)] = _ajustar_bloco_snapshot(parte, tipo)
+            inicio += len(parte)
+        destino.flush()
+        del destino, partes
+        for arquivos in arquivos_blocos:
+            os.remove(arquivos[coluna])
+
+    with open(os.path.join(pasta, '_colunas.json'), 'w', encoding='utf-8') as arquivo:
+        json.dump(colunas, arquivo)
+
+@st.cache_resource
+def _estado_snapshot():
+    """Situação da geração dos snapshots (compartilhada entre sessões), exibida na página de Operações."""
+    return {'versao_build': None, 'falhas': 0, 'erro': None, 'proxima_tentativa': 0.0, 'lock': threading.Lock()}
+
+def situacao_snapshot(versao_build):
+    """Falhas, último erro e horário da próxima tentativa da geração para a versão do build."""
+    estado = _estado_snapshot()
+    with estado['lock']:
+        if estado['versao_build'] != versao_build:
+            return {'falhas': 0, 'erro': None, 'proxima_tentativa': 0.0}
+        return {chave: estado[chave] for chave in ('falhas', 'erro', 'proxima_tentativa')}
+
+def snapshot_em_espera(versao_build):
+    """True enquanto a geração da versão aguarda a espera após uma falha."""
+    return time.time() < situacao_snapshot(versao_build)['proxima_tentativa']
+
+def _registrar_falha_snapshot(versao_build, erro):
+    """Guarda o erro e agenda a próxima tentativa com espera exponencial."""
+    estado = _estado_snapshot()
+    with estado['lock']:
+        if estado['versao_build'] != versao_build:
+            estado.update(versao_build=versao_build, falhas=0)
+        estado['falhas'] += 1
+        espera = min(ESPERA_FALHA_SNAPSHOT * 2 ** (estado['falhas'] - 1), ESPERA_MAXIMA_FALHA_SNAPSHOT)
+        estado['erro'] = f"{type(erro).__name__}: {erro}"
+        estado['proxima_tentativa'] = time.time() + espera
+
+def gerar_snapshot_empresas(_engine, versao_build):
+    """Grava os snapshots locais das tabelas por empresa para a versão do build; retorna a pasta (None se falhou)."""
+    if _engine is None or versao_build is None:
+        return
+    destino = _diretorio_snapshot(versao_build)
+    if os.path.exists(destino):
+        return destino
+    if snapshot_em_espera(versao_build):
+        return
+
+    temporario = f"{destino}.tmp-{os.getpid()}-{threading.get_ident()}"
+    try:
+        for parte, (tabela, ordenacao, _) in PARTES_EMPRESA.items():
+            query = f"""
+            SELECT *
+            FROM {DATABASE}.{tabela}
+            WHERE cnpj_id IS NOT NULL
+            ORDER BY cnpj_id, {ordenacao}
+            """
+            blocos = pd.read_sql(query, _engine, chunksize=TAMANHO_BLOCO_SNAPSHOT)
+            _gravar_snapshot_parte(os.path.join(temporario, parte), blocos)
+        os.replace(temporario, destino)
+    except Exception as e:
+        # Sem snapshot as consultas continuam no Impala; nova tentativa após a espera
+        _registrar_falha_snapshot(versao_build, e)
+        return
+    finally:
+        shutil.rmtree(temporario, ignore_errors=True)
+
+    # Descartar snapshots de builds anteriores
+    for nome in os.listdir(DIRETORIO_SNAPSHOTS):
+        if nome != str(versao_build) and '.tmp-' not in nome:
+            shutil.rmtree(os.path.join(DIRETORIO_SNAPSHOTS, nome), ignore_errors=True)
+    return destino
+
+@st.cache_resource
+def _snapshots_abertos():
+    """Snapshots já abertos com memory-map (compartilhados entre sessões)."""
+    return {'partes': {}, 'lock': threading.Lock()}
+
+def _abrir_snapshot(versao_build, parte):
+    """Abre o snapshot de uma parte; None se ainda não foi gerado para a versão."""
+    estado = _snapshots_abertos()
+    chave = (str(versao_build), parte)
+
+    with estado['lock']:
+        if chave not in estado['partes']:
+            pasta = os.path.join(_diretorio_snapshot(versao_build), parte)
+            if not os.path.exists(os.path.join(pasta, '_colunas.json')):
+                return None
+            with open(os.path.join(pasta, '_colunas.json'), encoding='utf-8') as arquivo:
+                colunas = json.load(arquivo)
+            # Snapshots de outras versões não serão mais consultados
+            for chave_antiga in [c for c in estado['partes'] if c[0] != chave[0]]:
+                del estado['partes'][chave_antiga]
+            estado['partes'][chave] = {
+                'chaves': np.load(os.path.join(pasta, '_chaves.npy'), mmap_mode='r'),
+                'inicios': np.load(os.path.join(pasta, '_inicios.npy'), mmap_mode='r'),
+                'colunas': {
+                    coluna: np.load(os.path.join(pasta, f"{coluna}.npy"), mmap_mode='r') for coluna in colunas
+                }
+            }
+        return estado['partes'][chave]
+
+def consultar_snapshot_empresa(versao_build, parte, cnpj):
+    """Retorna o histórico da empresa no snapshot local (None se não houver snapshot)."""
+    if versao_build is None:
+        return None
+    snapshot = _abrir_snapshot(versao_build, parte)
+    if snapshot is None:
+        return None
+
+    chaves = snapshot['chaves']
+    cnpj_id = cnpj_para_id(cnpj)
+    posicao = np.searchsorted(chaves, cnpj_id)
+    if posicao < len(chaves) and chaves[posicao] == cnpj_id:
+        inicio, fim = snapshot['inicios'][posicao], snapshot['inicios'][posicao + 1]
+    else:
+        inicio = fim = 0
+    return pd.DataFrame({coluna: np.array(valores[inicio:fim]) for coluna, valores in snapshot['colunas'].items()})
+
+def status_snapshot_empresas(versao_build):
+    """Partes com snapshot local gerado para a versão do build."""
+    if versao_build is None:
+        return []
+    pasta = _diretorio_snapshot(versao_build)
+    return [parte for parte in PARTES_EMPRESA if os.path.exists(os.path.join(pasta, parte, '_colunas.json'))]
+
+# -----------------------------------------------------------------------------
+# Busca de empresas por CNPJ e razão social (índice em memória por build)
+# -----------------------------------------------------------------------------
+# Arrays ordenados com busca binária por prefixo: CNPJs (busca por parte do
+# CNPJ) e termos normalizados das razões sociais e nomes fantasia, cada termo
+# apontando para a sua empresa.
+
+# Termos são truncados (prefixos mais longos são conferidos no nome completo)
+TAMANHO_MAXIMO_TERMO = 20
+
+# Limite de empresas conferidas quando o termo mais raro ainda é muito comum
+LIMITE_CANDIDATOS_BUSCA = 5000
+
+def _normalizar_texto_busca(texto):
+    """Maiúsculas, sem acentos e sem pontuação (para comparar nomes)."""
+    sem_acentos = unicodedata.normalize('NFKD', str(texto or '')).encode('ascii', 'ignore').decode('ascii')
+    return " ".join(re.sub(r'[^A-Z0-9]+', ' ', sem_acentos.upper()).split())
+
+def _faixa_prefixo(ordenados, prefixo):
+    """Intervalo [início, fim) dos itens do array ordenado que começam com o prefixo."""
+    proximo = prefixo[:-1] + bytes([prefixo[-1] + 1])
+    return np.searchsorted(ordenados, prefixo, 'left'), np.searchsorted(ordenados, proximo, 'left')
+
+@st.cache_resource(ttl=TTL_CACHE)
+def carregar_indice_busca_empresas(_engine, versao_build=None):
+    """Carrega (uma vez por build) o índice de busca de empresas por CNPJ e nome."""
+    if _engine is None:
+        return None
+
+    query = f"""
+    SELECT cnpj, nm_razao_social, nm_fantasia
+    FROM (
+        SELECT
+            cnpj,
+            nm_razao_social,
+            nm_fantasia,
+            ROW_NUMBER() OVER (PARTITION BY cnpj_id ORDER BY ano_referencia DESC) AS rn
+        FROM {DATABASE}.ecd_empresas_cadastro
+        WHERE cnpj IS NOT NULL
+    ) t
+    WHERE rn = 1
+    """
+
+    try:
+        df = pd.read_sql(query, _engine)
+    except Exception as e:
+        avisar_erro_carga(f"Erro ao carregar índice de busca de empresas: {e}")
+        return None
+
+    df['cnpj'] = df['cnpj'].astype(str)
+    df['nm_razao_social'] = df['nm_razao_social'].fillna('')
+    df['nm_fantasia'] = df['nm_fantasia'].fillna('')
+    # Nome normalizado com espaço inicial: ' TERMO' casa apenas início de palavra
+    nomes = (' ' + (df['nm_razao_social'] + ' ' + df['nm_fantasia']).map(_normalizar_texto_busca)).to_numpy(dtype=object)
+
+    cnpjs = df['cnpj'].to_numpy(dtype='S14')
+    ordem_cnpj = np.argsort(cnpjs, kind='stable')
+
+    # Um par (empresa, termo) por palavra distinta do nome
+    termos = (
+        pd.Series(nomes).str.split().explode().dropna().str.slice(0, TAMANHO_MAXIMO_TERMO)
+        .rename_axis('empresa').reset_index(name='termo').drop_duplicates()
+    )
+    termos_bytes = termos['termo'].to_numpy(dtype=f'S{TAMANHO_MAXIMO_TERMO}')
+    ordem_termos = np.argsort(termos_bytes, kind='stable')
+
+    return {
+        'empresas': df[['cnpj', 'nm_razao_social', 'nm_fantasia']].reset_index(drop=True),
+        'nomes': nomes,
+        'cnpjs': cnpjs[ordem_cnpj],
+        'ordem_cnpj': ordem_cnpj,
+        'termos': termos_bytes[ordem_termos],
+        'empresa_termo': termos['empresa'].to_numpy(dtype=np.int64)[ordem_termos]
+    }
+
+def buscar_empresas(indice, texto, limite=20):
+    """Sugestões de empresas por parte do CNPJ ou por prefixos de palavras da razão social / nome fantasia."""
+    vazio = pd.DataFrame(columns=['cnpj', 'nm_razao_social', 'nm_fantasia'])
+    if indice is None or not str(texto or '').strip():
+        return vazio
+
+    texto = str(texto).strip()
+    if re.fullmatch(r'[\d.\-/\s]+', texto):
+        # Parte inicial do CNPJ (com ou sem máscara)
+        digitos = re.sub(r'\D', '', texto)
+        if not digitos:
+            return vazio
+        inicio, fim = _faixa_prefixo(indice['cnpjs'], digitos.encode('ascii'))
+        posicoes = indice['ordem_cnpj'][inicio:min(fim, inicio + limite)]
+        return indice['empresas'].iloc[posicoes].reset_index(drop=True)
+
+    consulta = _normalizar_texto_busca(texto)
+    palavras = consulta.split()
+    if not palavras:
+        return vazio
+
+    # Começar pela palavra mais rara; as demais são conferidas no nome completo
+    faixas = [_faixa_prefixo(indice['termos'], p[:TAMANHO_MAXIMO_TERMO].encode('ascii')) for p in palavras]
+    inicio, fim = min(faixas, key=lambda faixa: faixa[1] - faixa[0])
+    candidatos = np.unique(indice['empresa_termo'][inicio:min(fim, inicio + LIMITE_CANDIDATOS_BUSCA)])
+
+    nomes = pd.Series(indice['nomes'][candidatos], index=candidatos)
+    for palavra in palavras:
+        nomes = nomes[nomes.str.contains(' ' + palavra, regex=False)]
+
+    # Nomes que começam com a consulta primeiro, depois ordem alfabética
+    ranking = pd.DataFrame({'prefixo': ~nomes.str.startswith(' ' + consulta), 'nome': nomes})
+    posicoes = ranking.sort_values(['prefixo', 'nome']).index[:limite]
+    return indice['empresas'].loc[posicoes].reset_index(drop=True)
+
 # =============================================================================
 # 7. FUNÇÕES DE VISUALIZAÇÃO
 # =============================================================================
 
+# -----------------------------------------------------------------------------
+# Cache de figuras (evita reconstruir e serializar gráficos a cada rerun)
+# -----------------------------------------------------------------------------
+# Chave: id do gráfico + impressão digital das entradas (dados e parâmetros).
+# Guarda o objeto go.Figure (st.plotly_chart não revalida uma figura pronta,
+# ao contrário de um dict), com descarte LRU por quantidade e por tamanho total
+# (medido pelo JSON uma única vez, na construção).
+
+LIMITE_FIGURAS_CACHE = 300
+LIMITE_BYTES_FIGURAS_CACHE = 256 * 1024 ** 2
+
+@st.cache_resource
+def _cache_figuras():
+    """Figuras prontas (compartilhadas entre sessões), em ordem de uso."""
+    return {'figuras': OrderedDict(), 'bytes': 0, 'lock': threading.Lock()}
+
+def _atualizar_impressao(hash_entradas, valor):
+    """Acrescenta um valor (DataFrame, array, coleção ou escalar) ao hash das entradas."""
+    if isinstance(valor, (pd.DataFrame, pd.Series, pd.Index)):
+        colunas = list(valor.columns) if isinstance(valor, pd.DataFrame) else [valor.name]
+        hash_entradas.update(repr((type(valor).__name__, colunas, valor.shape)).encode())
+        try:
+            hash_entradas.update(pd.util.hash_pandas_object(valor, index=not isinstance(valor, pd.Index)).to_numpy().tobytes())
+        except TypeError:
+            # Células não hasheáveis (listas, dicts)
+            hash_entradas.update(valor.to_json().encode())
+    elif isinstance(valor, np.ndarray):
+        _atualizar_impressao(hash_entradas, pd.Series(valor.ravel()))
+        hash_entradas.update(repr(valor.shape).encode())
+    elif isinstance(valor, dict):
+        hash_entradas.update(b'{')
+        for chave in sorted(valor, key=repr):
+            hash_entradas.update(repr(chave).encode())
+            _atualizar_impressao(hash_entradas, valor[chave])
+        hash_entradas.update(b'}')
+    elif isinstance(valor, (list, tuple)):
+        hash_entradas.update(f"{type(valor).__name__}[{len(valor)}]".encode())
+        for item in valor:
+            _atualizar_impressao(hash_entradas, item)
+    elif callable(valor):
+        # Funções são recriadas a cada rerun: vale o nome, não o endereço
+        hash_entradas.update(getattr(valor, '__qualname__', type(valor).__name__).encode())
+    else:
+        hash_entradas.update(repr(valor).encode())
+
+def impressao_digital(entradas):
+    """Hash das entradas de um gráfico."""
+    hash_entradas = hashlib.sha1()
+    _atualizar_impressao(hash_entradas, entradas)
+    return hash_entradas.hexdigest()
+
+def obter_figura(id_grafico, entradas, construir):
+    """Figura do cache se as entradas não mudaram; senão constrói e guarda."""
+    cache = _cache_figuras()
+    chave = (id_grafico, impressao_digital(entradas))
+
+    with cache['lock']:
+        item = cache['figuras'].get(chave)
+        if item is not None:
+            cache['figuras'].move_to_end(chave)
+            return item[0]
+
+    fig = construir()
+    tamanho = len(fig.to_json())
+
+    with cache['lock']:
+        if chave not in cache['figuras']:
+            cache['figuras'][chave] = (fig, tamanho)
+            cache['bytes'] += tamanho
+        # Descartar as menos usadas recentemente
+        while len(cache['figuras']) > LIMITE_FIGURAS_CACHE or cache['bytes'] > LIMITE_BYTES_FIGURAS_CACHE:
+            _, (_, tamanho_descartada) = cache['figuras'].popitem(last=False)
+            cache['bytes'] -= tamanho_descartada
+    return fig
+
+def exibir_figura(id_grafico, entradas, construir):
+    """st.plotly_chart com cache da figura; `construir` só é chamada quando as entradas mudam."""
+    st.plotly_chart(obter_figura(id_grafico, entradas, construir), use_container_width=True)
+
+def exibir_grafico(id_grafico, funcao, *args, layout=None, ajustes=(), **kwargs):
+    """Gráfico de uma chamada (px.bar, px.pie, ...) com cache; `ajustes` são pares (método da figura, parâmetros)."""
+    def construir():
+        fig = funcao(*args, **kwargs)
+        if layout:
+            fig.update_layout(**layout)
+        for metodo, parametros in ajustes:
+            getattr(fig, metodo)(**parametros)
+        return fig
+
+    exibir_figura(id_grafico, (funcao, args, kwargs, layout, ajustes), construir)
+
+
 def criar_balanco_patrimonial(dados_balanco, ano):
     """Cria visualização do Balanço Patrimonial."""
     if dados_balanco is None or dados_balanco.empty:
@@ -1155,13 +2755,7 @@ def criar_balanco_patrimonial(dados_balanco, ano):
     
     # Filtrar por ano se especificado
     if ano:
-        # Converter ano para formato YYYYMM (início e fim do ano)
-        ano_inicio = int(f"{ano}01")
-        ano_fim = int(f"{ano}12")
-        df = dados_balanco[
-            (dados_balanco['ano_referencia'] >= ano_inicio) & 
-            (dados_balanco['ano_referencia'] <= ano_fim)
-        ].copy()
+        df = dados_balanco[dados_balanco['ano_fiscal'] == ano].copy()
     else:
         df = dados_balanco.copy()
     
@@ -1203,38 +2797,40 @@ def criar_balanco_patrimonial(dados_balanco, ano):
     
     df_sorted = df.sort_values('data_fim_periodo')
     
-    fig = go.Figure()
-    
-    fig.add_trace(go.Scatter(
-        x=df_sorted['data_fim_periodo'],
-        y=df_sorted['ativo_total'],
-        name='Ativo Total',
-        line=dict(color='#2196F3', width=3)
-    ))
-    
-    fig.add_trace(go.Scatter(
-        x=df_sorted['data_fim_periodo'],
-        y=df_sorted['passivo_total'],
-        name='Passivo Total',
-        line=dict(color='#FF9800', width=3)
-    ))
-    
-    fig.add_trace(go.Scatter(
-        x=df_sorted['data_fim_periodo'],
-        y=df_sorted['patrimonio_liquido'],
-        name='Patrimônio Líquido',
-        line=dict(color='#4CAF50', width=3)
-    ))
-    
-    fig.update_layout(
-        title='Evolução do Balanço Patrimonial',
-        xaxis_title='Período',
-        yaxis_title='Valor (R$)',
-        hovermode='x unified',
-        height=400
-    )
-    
-    st.plotly_chart(fig, use_container_width=True)
+    def construir_figura():
+        fig = go.Figure()
+
+        fig.add_trace(go.Scatter(
+            x=df_sorted['data_fim_periodo'],
+            y=df_sorted['ativo_total'],
+            name='Ativo Total',
+            line=dict(color='#2196F3', width=3)
+        ))
+
+        fig.add_trace(go.Scatter(
+            x=df_sorted['data_fim_periodo'],
+            y=df_sorted['passivo_total'],
+            name='Passivo Total',
+            line=dict(color='#FF9800', width=3)
+        ))
+
+        fig.add_trace(go.Scatter(
+            x=df_sorted['data_fim_periodo'],
+            y=df_sorted['patrimonio_liquido'],
+            name='Patrimônio Líquido',
+            line=dict(color='#4CAF50', width=3)
+        ))
+
+        fig.update_layout(
+            title='Evolução do Balanço Patrimonial',
+            xaxis_title='Período',
+            yaxis_title='Valor (R$)',
+            hovermode='x unified',
+            height=400
+        )
+        return fig
+
+    exibir_figura('criar_balanco_patrimonial_evolucao_mensal', (df_sorted,), construir_figura)
     
     # Tabela detalhada
     st.markdown("---")
@@ -1271,13 +2867,7 @@ def criar_dre(dados_dre, ano):
     
     # Filtrar por ano se especificado
     if ano:
-        # Converter ano para formato YYYYMM (início e fim do ano)
-        ano_inicio = int(f"{ano}01")
-        ano_fim = int(f"{ano}12")
-        df = dados_dre[
-            (dados_dre['ano_referencia'] >= ano_inicio) & 
-            (dados_dre['ano_referencia'] <= ano_fim)
-        ].copy()
+        df = dados_dre[dados_dre['ano_fiscal'] == ano].copy()
     else:
         df = dados_dre.copy()
     
@@ -1319,46 +2909,48 @@ def criar_dre(dados_dre, ano):
     
     df_sorted = df.sort_values('data_fim_periodo')
     
-    fig = go.Figure()
-    
-    fig.add_trace(go.Scatter(
-        x=df_sorted['data_fim_periodo'],
-        y=df_sorted['receita_liquida'],
-        name='Receita Líquida',
-        line=dict(color='#4CAF50', width=3),
-        fill='tonexty'
-    ))
-    
-    fig.add_trace(go.Scatter(
-        x=df_sorted['data_fim_periodo'],
-        y=df_sorted['custos_totais'],
-        name='Custos Totais',
-        line=dict(color='#FF9800', width=2)
-    ))
-    
-    fig.add_trace(go.Scatter(
-        x=df_sorted['data_fim_periodo'],
-        y=df_sorted['despesas_totais'],
-        name='Despesas Totais',
-        line=dict(color='#F44336', width=2)
-    ))
-    
-    fig.add_trace(go.Scatter(
-        x=df_sorted['data_fim_periodo'],
-        y=df_sorted['resultado_liquido'],
-        name='Resultado Líquido',
-        line=dict(color='#2196F3', width=3)
-    ))
-    
-    fig.update_layout(
-        title='Evolução da DRE',
-        xaxis_title='Período',
-        yaxis_title='Valor (R$)',
-        hovermode='x unified',
-        height=400
-    )
-    
-    st.plotly_chart(fig, use_container_width=True)
+    def construir_figura():
+        fig = go.Figure()
+
+        fig.add_trace(go.Scatter(
+            x=df_sorted['data_fim_periodo'],
+            y=df_sorted['receita_liquida'],
+            name='Receita Líquida',
+            line=dict(color='#4CAF50', width=3),
+            fill='tonexty'
+        ))
+
+        fig.add_trace(go.Scatter(
+            x=df_sorted['data_fim_periodo'],
+            y=df_sorted['custos_totais'],
+            name='Custos Totais',
+            line=dict(color='#FF9800', width=2)
+        ))
+
+        fig.add_trace(go.Scatter(
+            x=df_sorted['data_fim_periodo'],
+            y=df_sorted['despesas_totais'],
+            name='Despesas Totais',
+            line=dict(color='#F44336', width=2)
+        ))
+
+        fig.add_trace(go.Scatter(
+            x=df_sorted['data_fim_periodo'],
+            y=df_sorted['resultado_liquido'],
+            name='Resultado Líquido',
+            line=dict(color='#2196F3', width=3)
+        ))
+
+        fig.update_layout(
+            title='Evolução da DRE',
+            xaxis_title='Período',
+            yaxis_title='Valor (R$)',
+            hovermode='x unified',
+            height=400
+        )
+        return fig
+
+    exibir_figura('criar_dre_evolucao_mensal', (df_sorted,), construir_figura)
     
     # Tabela detalhada
     st.markdown("---")
@@ -1394,58 +2986,279 @@ def criar_graficos_indicadores(dados_indicadores):
         return
     
     df = dados_indicadores.copy()
-    df['ano'] = df['ano_referencia'] // 100
+    df['ano'] = df['ano_fiscal']
     df = df.sort_values('ano')
     
     # Criar subplots
-    fig = make_subplots(
-        rows=2, cols=2,
-        subplot_titles=('Liquidez Corrente', 'Endividamento Geral', 
-                       'Margem Líquida (%)', 'ROE (%)'),
-        vertical_spacing=0.12,
-        horizontal_spacing=0.1
-    )
-    
-    # Liquidez
-    fig.add_trace(
-        go.Scatter(x=df['ano'], y=df['liquidez_corrente'], 
-                  mode='lines+markers', name='Liquidez',
-                  line=dict(color='#4CAF50', width=3)),
-        row=1, col=1
-    )
-    
-    # Endividamento
-    fig.add_trace(
-        go.Scatter(x=df['ano'], y=df['endividamento_geral'], 
-                  mode='lines+markers', name='Endividamento',
-                  line=dict(color='#F44336', width=3)),
-        row=1, col=2
-    )
-    
-    # Margem Líquida
-    fig.add_trace(
-        go.Scatter(x=df['ano'], y=df['margem_liquida_perc'], 
-                  mode='lines+markers', name='Margem',
-                  line=dict(color='#2196F3', width=3)),
-        row=2, col=1
+    def construir_figura():
+        fig = make_subplots(
+            rows=2, cols=2,
+            subplot_titles=('Liquidez Corrente', 'Endividamento Geral', 
+                           'Margem Líquida (%)', 'ROE (%)'),
+            vertical_spacing=0.12,
+            horizontal_spacing=0.1
+        )
+
+        # Liquidez
+        fig.add_trace(
+            go.Scatter(x=df['ano'], y=df['liquidez_corrente'], 
+                      mode='lines+markers', name='Liquidez',
+                      line=dict(color='#4CAF50', width=3)),
+            row=1, col=1
+        )
+
+        # Endividamento
+        fig.add_trace(
+            go.Scatter(x=df['ano'], y=df['endividamento_geral'], 
+                      mode='lines+markers', name='Endividamento',
+                      line=dict(color='#F44336', width=3)),
+            row=1, col=2
+        )
+
+        # Margem Líquida
+        fig.add_trace(
+            go.Scatter(x=df['ano'], y=df['margem_liquida_perc'], 
+                      mode='lines+markers', name='Margem',
+                      line=dict(color='#2196F3', width=3)),
+            row=2, col=1
+        )
+
+        # ROE
+        fig.add_trace(
+            go.Scatter(x=df['ano'], y=df['roe_retorno_patrimonio_perc'], 
+                      mode='lines+markers', name='ROE',
+                      line=dict(color='#FF9800', width=3)),
+            row=2, col=2
+        )
+
+        fig.update_layout(height=600, showlegend=False, title_text="Evolução dos Indicadores Financeiros")
+        return fig
+
+    exibir_figura('criar_graficos_indicadores', (df,), construir_figura)
+
+# Acima deste número de pontos os scatters usam WebGL e oferecem o mapa de densidade
+LIMITE_PONTOS_SVG = 1000
+
+# Máximo de pontos desenhados no modo amostrado (outliers não entram na conta)
+LIMITE_PONTOS_SCATTER = 5000
+
+def amostrar_por_densidade(df, x, y, limite=LIMITE_PONTOS_SCATTER, preservar=None, qtd_celulas=50, semente=42):
+    """Reduz os pontos de um scatter mantendo a forma da nuvem e todos os outliers.
+
+    Os pontos fora de P1-P99 (em x ou y) e os marcados em `preservar` (máscara booleana)
+    são sempre mantidos. Os demais são amostrados por célula de uma grade, com cota
+    proporcional à raiz da contagem: regiões esparsas ficam proporcionalmente mais representadas.
+    """
+    if len(df) <= limite:
+        return df
+
+    vx = pd.to_numeric(df[x], errors='coerce').to_numpy(dtype=float)
+    vy = pd.to_numeric(df[y], errors='coerce').to_numpy(dtype=float)
+    validos = np.isfinite(vx) & np.isfinite(vy)
+
+    x_min, x_max = np.nanpercentile(vx[validos], [1, 99])
+    y_min, y_max = np.nanpercentile(vy[validos], [1, 99])
+    outliers = validos & ((vx < x_min) | (vx > x_max) | (vy < y_min) | (vy > y_max))
+    if preservar is not None:
+        outliers |= np.asarray(preservar, dtype=bool)
+
+    # Célula da grade de cada ponto comum
+    comuns = np.flatnonzero(validos & ~outliers)
+    ix = np.clip(((vx[comuns] - x_min) / max(x_max - x_min, 1e-12) * qtd_celulas).astype(int), 0, qtd_celulas - 1)
+    iy = np.clip(((vy[comuns] - y_min) / max(y_max - y_min, 1e-12) * qtd_celulas).astype(int), 0, qtd_celulas - 1)
+    celulas = ix * qtd_celulas + iy
+
+    contagens = np.bincount(celulas, minlength=qtd_celulas ** 2)
+    pesos = np.sqrt(contagens)
+    cotas = np.ceil(max(limite - outliers.sum(), 0) * pesos / max(pesos.sum(), 1)).astype(int)
+
+    # Posição aleatória de cada ponto dentro da sua célula; fica quem está dentro da cota
+    gerador = np.random.default_rng(semente)
+    ordem = np.lexsort((gerador.random(len(celulas)), celulas))
+    inicio_celula = np.r_[0, np.cumsum(contagens)[:-1]]
+    posicao = np.empty(len(celulas), dtype=int)
+    posicao[ordem] = np.arange(len(celulas)) - inicio_celula[celulas[ordem]]
+
+    manter = outliers.copy()
+    manter[comuns[posicao < cotas[celulas]]] = True
+    return df[manter]
+
+def criar_mapa_densidade(df, x, y, qtd_faixas=80, labels=None):
+    """Mapa de densidade (histograma 2D calculado no servidor) para a população inteira."""
+    labels = labels or {}
+    vx = pd.to_numeric(df[x], errors='coerce').to_numpy(dtype=float)
+    vy = pd.to_numeric(df[y], errors='coerce').to_numpy(dtype=float)
+    validos = np.isfinite(vx) & np.isfinite(vy)
+
+    # Faixa P0,5-P99,5 para que poucos extremos não comprimam o mapa
+    faixa_x = np.nanpercentile(vx[validos], [0.5, 99.5])
+    faixa_y = np.nanpercentile(vy[validos], [0.5, 99.5])
+    contagens, bordas_x, bordas_y = np.histogram2d(vx[validos], vy[validos], bins=qtd_faixas, range=[faixa_x, faixa_y])
+    contagens = np.where(contagens > 0, contagens, np.nan)
+
+    fig = go.Figure(go.Heatmap(
+        x=(bordas_x[:-1] + bordas_x[1:]) / 2,
+        y=(bordas_y[:-1] + bordas_y[1:]) / 2,
+        z=np.log10(contagens.T),
+        customdata=contagens.T,
+        colorscale='YlOrRd',
+        colorbar=dict(title='Empresas (log10)'),
+        hovertemplate='x: %{x:.2f}<br>y: %{y:.2f}<br>Empresas: %{customdata:,.0f}<extra></extra>'
+    ))
+    fig.update_layout(xaxis_title=labels.get(x, x), yaxis_title=labels.get(y, y))
+    return fig
+
+def exibir_scatter_grande(df, x, y, chave, preservar=None, layout=None, linhas_referencia=None, **kwargs):
+    """px.scatter para populações grandes: WebGL, amostragem por densidade ou mapa de densidade.
+
+    Abaixo de LIMITE_PONTOS_SVG desenha todos os pontos normalmente. `layout` vai para
+    update_layout e `linhas_referencia` é uma lista de ('v' ou 'h', valor, texto).
+    """
+    modo = "Pontos"
+    if len(df) > LIMITE_PONTOS_SVG:
+        modo = st.radio(
+            "Visualização",
+            ["Pontos (amostra com outliers)", "Mapa de densidade (todas as empresas)"],
+            horizontal=True,
+            key=f"modo_scatter_{chave}"
+        )
+        if modo.startswith("Mapa"):
+            st.caption(f"Densidade de {len(df):,} empresas")
+        else:
+            st.caption(f"Amostra por densidade de {len(df):,} empresas (outliers sempre exibidos)")
+
+    def construir_figura():
+        if modo.startswith("Mapa"):
+            fig = criar_mapa_densidade(df, x, y, labels=kwargs.get('labels'))
+        elif len(df) > LIMITE_PONTOS_SVG:
+            df_amostra = amostrar_por_densidade(df, x, y, preservar=preservar)
+            fig = px.scatter(df_amostra, x=x, y=y, render_mode='webgl', **kwargs)
+        else:
+            fig = px.scatter(df, x=x, y=y, **kwargs)
+
+        for direcao, valor, texto in linhas_referencia or []:
+            linha = fig.add_vline if direcao == 'v' else fig.add_hline
+            linha(valor, line_dash="dash", line_color="gray", annotation_text=texto)
+        fig.update_layout(**(layout or {}))
+        return fig
+
+    exibir_figura(f"scatter_{chave}", (modo, df, x, y, preservar, layout, linhas_referencia, kwargs), construir_figura)
+
+def criar_histograma_distribuicao(distribuicao, titulo_eixo):
+    """Histograma a partir das faixas pré-calculadas, com linhas nos percentis 5, 50 e 95."""
+    histograma = distribuicao['histograma']
+    bordas = np.asarray(histograma['bordas'])
+
+    fig = go.Figure(go.Bar(
+        x=(bordas[:-1] + bordas[1:]) / 2,
+        y=histograma['contagens'],
+        width=np.diff(bordas),
+        marker_color='#3b82f6',
+        customdata=np.column_stack([bordas[:-1], bordas[1:]]),
+        hovertemplate='%{customdata[0]:.2f} a %{customdata[1]:.2f}<br>Empresas: %{y:,}<extra></extra>'
+    ))
+
+    for percentil, cor in [('p5', '#f59e0b'), ('p50', '#1e3a8a'), ('p95', '#f59e0b')]:
+        fig.add_vline(
+            x=distribuicao['quantis'][percentil], line_dash='dash', line_color=cor,
+            annotation_text=percentil.upper(), annotation_position='top'
+        )
+
+    fig.update_layout(
+        xaxis_title=titulo_eixo,
+        yaxis_title='Empresas',
+        bargap=0,
+        showlegend=False
     )
-    
-    # ROE
-    fig.add_trace(
-        go.Scatter(x=df['ano'], y=df['roe_retorno_patrimonio_perc'], 
-                  mode='lines+markers', name='ROE',
-                  line=dict(color='#FF9800', width=3)),
-        row=2, col=2
+    if histograma['abaixo'] or histograma['acima']:
+        fig.add_annotation(
+            text=f"Fora do gráfico: {histograma['abaixo']:,} abaixo do P1 e {histograma['acima']:,} acima do P99",
+            xref='paper', yref='paper', x=1, y=1.08, showarrow=False, font=dict(size=10)
+        )
+    return fig
+
+def criar_box_distribuicao(distribuicoes, titulo_eixo):
+    """Box plots a partir das estatísticas pré-calculadas (um por grupo)."""
+    nomes = list(distribuicoes.keys())
+    boxes = [distribuicoes[nome]['box'] for nome in nomes]
+
+    fig = go.Figure(go.Box(
+        x=nomes,
+        q1=[box['q1'] for box in boxes],
+        median=[box['mediana'] for box in boxes],
+        q3=[box['q3'] for box in boxes],
+        lowerfence=[box['bigode_inferior'] for box in boxes],
+        upperfence=[box['bigode_superior'] for box in boxes],
+        mean=[distribuicoes[nome]['media'] for nome in nomes],
+        boxpoints=False,
+        marker_color='#06b6d4'
+    ))
+    fig.update_layout(yaxis_title=titulo_eixo, showlegend=False)
+    fig.update_xaxes(tickfont=dict(size=9))
+    return fig
+
+# Seções do dossiê de empresa (parte -> título)
+TITULOS_DOSSIE = {
+    'cadastro': 'Dados Cadastrais',
+    'indicadores': 'Indicadores Financeiros',
+    'balanco': 'Balanço Patrimonial',
+    'dre': 'DRE',
+    'risco': 'Análise de Risco'
+}
+
+def gerar_relatorio_empresa_html(cnpj, partes):
+    """Monta o relatório HTML de uma empresa a partir das partes do dossiê."""
+    cadastro = partes['cadastro']
+    razao_social = cadastro['nm_razao_social'].iloc[0] if not cadastro.empty else 'Empresa não encontrada'
+
+    secoes = [
+        f"<h1>{html.escape(str(razao_social))}</h1>",
+        f"<p><strong>CNPJ:</strong> {cnpj} | <strong>Gerado em:</strong> {datetime.now().strftime('%d/%m/%Y %H:%M')}</p>"
+    ]
+    for parte, titulo in TITULOS_DOSSIE.items():
+        df = partes[parte]
+        secoes.append(f"<h2>{titulo}</h2>")
+        secoes.append(df.to_html(index=False, na_rep='', border=0) if not df.empty else "<p>Sem dados.</p>")
+
+    return (
+        f"<html><head><meta charset='utf-8'><title>Dossiê {cnpj}</title></head>"
+        f"<body>{''.join(secoes)}</body></html>"
     )
-    
-    fig.update_layout(height=600, showlegend=False, title_text="Evolução dos Indicadores Financeiros")
-    
-    st.plotly_chart(fig, use_container_width=True)
+
+def _arquivos_dossie_empresa(cnpj, partes, formato):
+    """Gera os arquivos (nome, conteúdo) do dossiê de uma empresa."""
+    if formato == 'HTML':
+        return [(f"{cnpj}.html", gerar_relatorio_empresa_html(cnpj, partes).encode('utf-8'))]
+
+    arquivos = []
+    for parte, df in partes.items():
+        buffer = io.BytesIO()
+        df.to_parquet(buffer, index=False)
+        arquivos.append((f"{cnpj}/{parte}.parquet", buffer.getvalue()))
+    return arquivos
+
+def gerar_dossie_lote(dados, cnpjs, formato='HTML'):
+    """Gera em paralelo os dossiês das empresas e retorna o arquivo zip (bytes)."""
+    por_empresa = {parte: dict(tuple(df.groupby('cnpj', sort=False))) for parte, df in dados.items()}
+
+    def arquivos_empresa(cnpj):
+        partes = {parte: por_empresa[parte].get(cnpj, df.iloc[0:0]) for parte, df in dados.items()}
+        return _arquivos_dossie_empresa(cnpj, partes, formato)
+
+    buffer = io.BytesIO()
+    with zipfile.ZipFile(buffer, 'w', zipfile.ZIP_DEFLATED) as arquivo_zip:
+        for arquivos in _executor_consultas().map(arquivos_empresa, cnpjs):
+            for nome, conteudo in arquivos:
+                arquivo_zip.writestr(nome, conteudo)
+    return buffer.getvalue()
 
 # =============================================================================
 # 8. FUNÇÕES DE MACHINE LEARNING
 # =============================================================================
 
+# Empresas da fila de fiscalização usadas no treino e nos gráficos do ML
+LIMITE_EMPRESAS_ML = 20000
+
 def treinar_modelo_fiscalizacao(dados_empresas):
     """Treina modelo de ML para identificar empresas para fiscalização."""
     if dados_empresas is None or dados_empresas.empty:
@@ -1521,6 +3334,103 @@ def calcular_score_ml(dados_ml, dados_empresas):
     
     return dados_empresas_ml
 
+# -----------------------------------------------------------------------------
+# Mineração de padrões NEAF (coocorrência de tipos de indício)
+# -----------------------------------------------------------------------------
+# Matriz esparsa empresa x tipo de indício (1 = a empresa tem o indício);
+# coocorrência = Mᵀ·M, sem self-join no banco.
+
+# Mínimo de empresas para um conjunto de indícios ser frequente
+SUPORTE_MINIMO_ITEMSETS = 20
+# Pares frequentes estendidos a trios (os de maior suporte)
+LIMITE_PARES_ITEMSETS = 500
+
+def _carregar_incidencia_neaf(_engine):
+    """Pares (cnpj_id, tipo de indício) distintos, do resumo do build ou de ecd_neaf_indicios."""
+    if tabela_disponivel(_engine, 'ecd_neaf_indicios_resumo'):
+        query = f"""
+        SELECT r.cnpj_id, t.descricao_indicio
+        FROM {DATABASE}.ecd_neaf_indicios_resumo r
+        INNER JOIN {DATABASE}.ecd_neaf_tipos_indicio t
+            ON t.id_tipo_indicio = r.id_tipo_indicio
+        """
+    else:
+        query = f"""
+        SELECT DISTINCT CAST(cnpj AS BIGINT) AS cnpj_id, descricao_indicio
+        FROM {DATABASE}.ecd_neaf_indicios
+        WHERE descricao_indicio IS NOT NULL
+        """
+    return pd.read_sql(query, _engine)
+
+@cache_compartilhado(ttl=3600)
+def calcular_coocorrencia_neaf(_engine, versao_build, suporte_minimo=SUPORTE_MINIMO_ITEMSETS):
+    """Coocorrência, lift e itemsets frequentes dos tipos de indício NEAF (uma vez por build)."""
+    if _engine is None:
+        return None
+
+    try:
+        df = _carregar_incidencia_neaf(_engine)
+    except Exception as e:
+        avisar_erro_carga(f"Erro ao carregar indícios NEAF para coocorrência: {e}")
+        return None
+    if df.empty:
+        return None
+
+    linhas, _ = pd.factorize(df['cnpj_id'])
+    colunas, tipos = pd.factorize(df['descricao_indicio'])
+    incidencia = sparse.csr_matrix(
+        (np.ones(len(df), dtype=np.int32), (linhas, colunas)),
+        shape=(linhas.max() + 1, len(tipos))
+    )
+    # Pares repetidos somariam; a matriz é binária
+    incidencia.data[:] = 1
+    qtd_empresas = incidencia.shape[0]
+
+    coocorrencia = (incidencia.T @ incidencia).toarray()
+    qtd_por_tipo = np.diag(coocorrencia).astype(float)
+    suporte = qtd_por_tipo / qtd_empresas
+
+    # Pares (i < j) que ocorrem juntos ao menos uma vez
+    tipo_a, tipo_b = np.nonzero(np.triu(coocorrencia, k=1))
+    qtd_pares = coocorrencia[tipo_a, tipo_b].astype(float)
+    associacoes = pd.DataFrame({
+        'indicio_a': tipos[tipo_a],
+        'indicio_b': tipos[tipo_b],
+        'qtd_empresas': qtd_pares.astype(int),
+        'suporte': qtd_pares / qtd_empresas,
+        'confianca_a_b': qtd_pares / qtd_por_tipo[tipo_a],
+        'confianca_b_a': qtd_pares / qtd_por_tipo[tipo_b],
+        'lift': qtd_pares * qtd_empresas / (qtd_por_tipo[tipo_a] * qtd_por_tipo[tipo_b])
+    }).sort_values(['lift', 'qtd_empresas'], ascending=False, ignore_index=True)
+
+    # Itemsets frequentes (Apriori até 3 tipos): cada par frequente é estendido
+    # de uma vez com o produto da sua coluna pela matriz inteira
+    itemsets = [((tipos[i],), int(qtd_por_tipo[i])) for i in np.nonzero(qtd_por_tipo >= suporte_minimo)[0]]
+    frequentes = [(a, b, q) for a, b, q in zip(tipo_a, tipo_b, qtd_pares) if q >= suporte_minimo]
+    frequentes = sorted(frequentes, key=lambda par: -par[2])[:LIMITE_PARES_ITEMSETS]
+    incidencia_colunas = incidencia.tocsc()
+    for a, b, qtd in frequentes:
+        itemsets.append(((tipos[a], tipos[b]), int(qtd)))
+        ambos = incidencia_colunas[:, a].multiply(incidencia_colunas[:, b])
+        qtd_trios = np.asarray((ambos.T @ incidencia_colunas).todense()).ravel()
+        # c > b evita repetir o mesmo trio em outra ordem
+        for c in np.nonzero(qtd_trios >= suporte_minimo)[0]:
+            if c > b and coocorrencia[a, c] >= suporte_minimo and coocorrencia[b, c] >= suporte_minimo:
+                itemsets.append(((tipos[a], tipos[b], tipos[c]), int(qtd_trios[c])))
+
+    df_itemsets = pd.DataFrame(itemsets, columns=['indicios', 'qtd_empresas'])
+    df_itemsets['tamanho'] = df_itemsets['indicios'].map(len)
+    df_itemsets['suporte'] = df_itemsets['qtd_empresas'] / qtd_empresas
+    df_itemsets['indicios'] = df_itemsets['indicios'].map(' + '.join)
+
+    return {
+        'qtd_empresas': qtd_empresas,
+        'tipos': pd.DataFrame({'indicio': tipos, 'qtd_empresas': qtd_por_tipo.astype(int), 'suporte': suporte}),
+        'coocorrencia': coocorrencia,
+        'associacoes': associacoes,
+        'itemsets': df_itemsets.sort_values(['tamanho', 'qtd_empresas'], ascending=[False, False], ignore_index=True)
+    }
+
 # =============================================================================
 # 9. SIDEBAR - NAVEGAÇÃO PRINCIPAL
 # =============================================================================
@@ -1537,6 +3447,15 @@ if engine is None:
     st.sidebar.info("Configure as credenciais em st.secrets")
     st.stop()
 
+# Invalidar o cache quando um novo build terminar
+versao_build = obter_versao_build(engine)
+estado_cache = obter_estado_cache()
+if versao_build and estado_cache['versao_build'] not in (None, versao_build):
+    st.cache_data.clear()
+    limpar_cache_compartilhado()
+    limpar_status_cargas()
+estado_cache['versao_build'] = versao_build
+
 # Carregar resumo geral
 with st.sidebar:
     with st.spinner("Carregando dados..."):
@@ -1550,6 +3469,8 @@ with st.sidebar:
             st.sidebar.metric("Anos", resumo['total_anos'])
             st.sidebar.metric("Ano Mais Recente", resumo['ano_mais_recente'])
             st.sidebar.metric("Setores", resumo['total_setores'])
+            if versao_build:
+                st.sidebar.caption(f"🗓️ Build dos dados: {versao_build}")
             st.sidebar.markdown("---")
 
 # Menu de navegação
@@ -1566,7 +3487,8 @@ pagina = st.sidebar.radio(
         "🗂️ Plano de Contas",
         "🔍 Indícios NEAF",
         "⚖️ Inconsistências Contábeis",
-        "📈 Benchmark Setorial"
+        "📈 Benchmark Setorial",
+        "🛠️ Operações do Build"
     ],
     label_visibility="collapsed"
 )
@@ -1583,6 +3505,23 @@ st.sidebar.markdown("### ⚙️ Filtros Globais")
 anos_disponiveis = list(range(2018, 2025))
 ano_selecionado = st.sidebar.selectbox("Ano de Referência", anos_disponiveis, index=len(anos_disponiveis)-1)
 
+# Aquecer em segundo plano o cache das páginas para o ano selecionado
+chaves_aquecimento = agendar_aquecimento(engine, ano_selecionado)
+# Snapshots locais das tabelas por empresa (uma vez por build, após o aquecimento)
+if not snapshot_em_espera(versao_build):
+    agendar_carga(PRIORIDADE_SNAPSHOT, gerar_snapshot_empresas, engine, versao_build)
+status_aquecimento = status_cargas(chaves_aquecimento)
+cargas_finalizadas = sum(status in ('concluido', 'erro') for status in status_aquecimento)
+if cargas_finalizadas < len(chaves_aquecimento):
+    st.sidebar.progress(
+        cargas_finalizadas / len(chaves_aquecimento),
+        text=f"Pré-carregando páginas: {cargas_finalizadas}/{len(chaves_aquecimento)}"
+    )
+elif 'erro' in status_aquecimento:
+    st.sidebar.caption(f"⚠️ {status_aquecimento.count('erro')} página(s) não pré-carregada(s): serão consultadas ao abrir")
+else:
+    st.sidebar.caption("✅ Páginas pré-carregadas")
+
 st.sidebar.markdown("---")
 st.sidebar.info("💡 **Dica:** Comece pela Visão Geral e depois navegue para análises específicas.")
 
@@ -1666,17 +3605,17 @@ if pagina == "🏠 Visão Geral":
             df_setores['qtd_empresas'] = pd.to_numeric(df_setores['qtd_empresas'], errors='coerce').fillna(0)
             df_top_setores = df_setores.nlargest(15, 'qtd_empresas')
             
-            fig = px.bar(
+            exibir_grafico(
+                'visao_geral_empresas_por_setor_top_15', px.bar,
                 df_top_setores,
                 x='qtd_empresas',
                 y='setor',
                 orientation='h',
                 color='qtd_empresas',
                 color_continuous_scale='Blues',
-                labels={'qtd_empresas': 'Quantidade', 'setor': 'Setor'}
+                labels={'qtd_empresas': 'Quantidade', 'setor': 'Setor'},
+                layout=dict(height=600, showlegend=False)
             )
-            fig.update_layout(height=600, showlegend=False)
-            st.plotly_chart(fig, use_container_width=True)
         
         with col2:
             st.markdown("### 💰 Ativo Médio por Setor (Top 15)")
@@ -1684,17 +3623,17 @@ if pagina == "🏠 Visão Geral":
             df_setores['media_ativo_milhoes'] = pd.to_numeric(df_setores['media_ativo_milhoes'], errors='coerce').fillna(0)
             df_top_ativo = df_setores.nlargest(15, 'media_ativo_milhoes')
             
-            fig = px.bar(
+            exibir_grafico(
+                'visao_geral_ativo_medio_por_setor_top_15', px.bar,
                 df_top_ativo,
                 x='media_ativo_milhoes',
                 y='setor',
                 orientation='h',
                 color='media_ativo_milhoes',
                 color_continuous_scale='Greens',
-                labels={'media_ativo_milhoes': 'Ativo Médio (R$ Mi)', 'setor': 'Setor'}
+                labels={'media_ativo_milhoes': 'Ativo Médio (R$ Mi)', 'setor': 'Setor'},
+                layout=dict(height=600, showlegend=False)
             )
-            fig.update_layout(height=600, showlegend=False)
-            st.plotly_chart(fig, use_container_width=True)
         
         st.markdown("---")
         
@@ -1707,18 +3646,18 @@ if pagina == "🏠 Visão Geral":
             df_setores['media_liquidez'] = pd.to_numeric(df_setores['media_liquidez'], errors='coerce').fillna(0)
             df_liquidez = df_setores.nlargest(15, 'media_liquidez')
             
-            fig = px.bar(
+            exibir_grafico(
+                'visao_geral_liquidez_corrente_por_setor', px.bar,
                 df_liquidez,
                 x='media_liquidez',
                 y='setor',
                 orientation='h',
                 color='media_liquidez',
                 color_continuous_scale='RdYlGn',
-                labels={'media_liquidez': 'Liquidez Corrente', 'setor': 'Setor'}
+                labels={'media_liquidez': 'Liquidez Corrente', 'setor': 'Setor'},
+                layout=dict(height=600, showlegend=False),
+                ajustes=[('add_vline', dict(x=1, line_dash="dash", line_color="red", annotation_text="Mínimo Saudável"))]
             )
-            fig.add_vline(x=1, line_dash="dash", line_color="red", annotation_text="Mínimo Saudável")
-            fig.update_layout(height=600, showlegend=False)
-            st.plotly_chart(fig, use_container_width=True)
         
         with col2:
             st.markdown("### 📈 ROE Médio por Setor (%)")
@@ -1726,17 +3665,17 @@ if pagina == "🏠 Visão Geral":
             df_setores['media_roe'] = pd.to_numeric(df_setores['media_roe'], errors='coerce').fillna(0)
             df_roe = df_setores.nlargest(15, 'media_roe')
             
-            fig = px.bar(
+            exibir_grafico(
+                'visao_geral_roe_medio_por_setor', px.bar,
                 df_roe,
                 x='media_roe',
                 y='setor',
                 orientation='h',
                 color='media_roe',
                 color_continuous_scale='Oranges',
-                labels={'media_roe': 'ROE (%)', 'setor': 'Setor'}
+                labels={'media_roe': 'ROE (%)', 'setor': 'Setor'},
+                layout=dict(height=600, showlegend=False)
             )
-            fig.update_layout(height=600, showlegend=False)
-            st.plotly_chart(fig, use_container_width=True)
         
         # Tabela resumida
         st.markdown("---")
@@ -1807,17 +3746,18 @@ elif pagina == "📊 Análise por Setor":
             with col1:
                 st.markdown("#### Distribuição por Porte")
                 porte_count = df_empresas['empresa_grande_porte'].value_counts()
-                fig = px.pie(
+                exibir_grafico(
+                    'analise_por_setor_distribuicao_por_porte', px.pie,
                     values=porte_count.values,
                     names=porte_count.index,
                     title="Grande Porte vs Outros"
                 )
-                st.plotly_chart(fig, use_container_width=True)
             
             with col2:
                 st.markdown("#### Classificação de Risco")
                 risco_count = df_empresas['classificacao_risco'].value_counts()
-                fig = px.pie(
+                exibir_grafico(
+                    'analise_por_setor_classificacao_de_risco', px.pie,
                     values=risco_count.values,
                     names=risco_count.index,
                     title="Distribuição por Risco",
@@ -1828,7 +3768,6 @@ elif pagina == "📊 Análise por Setor":
                         'Baixo': '#689f38'
                     }
                 )
-                st.plotly_chart(fig, use_container_width=True)
             
             # Top empresas por ativo
             st.markdown("#### 💰 Top 10 Empresas por Ativo")
@@ -1836,17 +3775,17 @@ elif pagina == "📊 Análise por Setor":
             df_empresas['ativo_milhoes'] = pd.to_numeric(df_empresas['ativo_milhoes'], errors='coerce').fillna(0)
             df_top = df_empresas.nlargest(10, 'ativo_milhoes')
             
-            fig = px.bar(
+            exibir_grafico(
+                'analise_por_setor_top_10_empresas_por_ativo', px.bar,
                 df_top,
                 x='ativo_milhoes',
                 y='nm_razao_social',
                 orientation='h',
                 color='liquidez',
                 color_continuous_scale='RdYlGn',
-                labels={'ativo_milhoes': 'Ativo (R$ Mi)', 'nm_razao_social': 'Empresa'}
+                labels={'ativo_milhoes': 'Ativo (R$ Mi)', 'nm_razao_social': 'Empresa'},
+                layout=dict(height=500)
             )
-            fig.update_layout(height=500)
-            st.plotly_chart(fig, use_container_width=True)
             
             # Tabela de empresas
             st.markdown("#### 📋 Listagem Completa de Empresas")
@@ -1935,10 +3874,9 @@ elif pagina == "🏢 Detalhamento de Empresa":
     with col1:
         # Verificar se veio de drilldown
         cnpj_inicial = st.session_state.get('cnpj_drill', '')
-        cnpj_busca = st.text_input(
-            "Digite o CNPJ da empresa (14 dígitos)", 
+        termo_busca = st.text_input(
+            "Digite o CNPJ (completo ou início) ou parte da razão social / nome fantasia", 
             value=cnpj_inicial,
-            max_chars=14,
             key='cnpj_input'
         )
     
@@ -1947,31 +3885,113 @@ elif pagina == "🏢 Detalhamento de Empresa":
         buscar = st.button("🔎 Buscar", use_container_width=True)
     
     # Limpar session state após usar
-    if 'cnpj_drill' in st.session_state and cnpj_busca:
+    if 'cnpj_drill' in st.session_state and termo_busca:
         del st.session_state['cnpj_drill']
+
+    # CNPJ completo vai direto; os demais termos mostram sugestões do índice de busca
+    termo_busca = termo_busca.strip()
+    cnpj_busca = re.sub(r'\D', '', termo_busca) if re.fullmatch(r'[\d.\-/\s]+', termo_busca) else ''
+    if termo_busca:
+        indice_busca = carregar_indice_busca_empresas(engine, versao_build)
+
+        if len(cnpj_busca) != 14:
+            df_sugestoes = buscar_empresas(indice_busca, termo_busca)
+
+            def descrever_sugestao(posicao):
+                sugestao = df_sugestoes.loc[posicao]
+                fantasia = f" ({sugestao['nm_fantasia']})" if sugestao['nm_fantasia'] else ""
+                return f"{sugestao['cnpj']} - {sugestao['nm_razao_social']}{fantasia}"
+
+            if not df_sugestoes.empty:
+                posicao = st.selectbox(
+                    f"Empresas encontradas ({len(df_sugestoes)})",
+                    df_sugestoes.index,
+                    format_func=descrever_sugestao,
+                    key='sugestao_empresa'
+                )
+                cnpj_busca = df_sugestoes.loc[posicao, 'cnpj']
+            elif indice_busca is not None:
+                st.warning("Nenhuma empresa encontrada para o termo informado.")
+        elif indice_busca is not None and buscar_empresas(indice_busca, cnpj_busca, limite=1).empty:
+            # CNPJ fora do cadastro: evita as consultas da empresa
+            st.error("CNPJ não encontrado no cadastro ECD.")
+            cnpj_busca = ''
+
+    # Dossiê em lote: vários CNPJs colados ou enviados das páginas de Alto Risco / ML
+    cnpjs_enviados = st.session_state.pop('cnpjs_dossie', None)
+    if cnpjs_enviados:
+        st.session_state['texto_dossie'] = "\n".join(cnpjs_enviados)
+
+    with st.expander("📦 Dossiê em Lote (vários CNPJs)", expanded=bool(cnpjs_enviados)):
+        texto_cnpjs = st.text_area(
+            "CNPJs (um por linha, com ou sem máscara)",
+            key='texto_dossie',
+            height=150,
+            help="Cole a lista ou use o botão de dossiê nas páginas de Empresas Alto Risco e Fiscalização Inteligente."
+        )
+        cnpjs_lote = normalizar_lista_cnpjs(texto_cnpjs)
+
+        col1, col2 = st.columns(2)
+        with col1:
+            formato_dossie = st.radio("Formato", ["HTML", "Parquet"], horizontal=True, key='formato_dossie')
+        with col2:
+            st.metric("CNPJs válidos", len(cnpjs_lote))
+
+        if st.button("📦 Gerar Dossiês", disabled=not cnpjs_lote):
+            with st.spinner(f"Carregando dados de {len(cnpjs_lote)} empresas..."):
+                dados_lote = carregar_dados_empresas_lote(engine, cnpjs_lote)
+
+            if dados_lote:
+                nao_encontrados = len(set(cnpjs_lote) - set(dados_lote['cadastro']['cnpj']))
+                if nao_encontrados:
+                    st.warning(f"{nao_encontrados} CNPJ(s) não encontrados no cadastro.")
+
+                try:
+                    with st.spinner("Gerando relatórios..."):
+                        arquivo_zip = gerar_dossie_lote(dados_lote, cnpjs_lote, formato_dossie)
+                    st.download_button(
+                        label=f"📥 Download ({len(cnpjs_lote)} empresas)",
+                        data=arquivo_zip,
+                        file_name=f"dossies_{datetime.now().strftime('%Y%m%d_%H%M')}.zip",
+                        mime="application/zip"
+                    )
+                except Exception as e:
+                    st.error(f"Erro ao gerar dossiês: {e}")
     
     if cnpj_busca and len(cnpj_busca) == 14:
-        with st.spinner("Carregando dados completos da empresa..."):
-            dados_empresa = carregar_dados_empresa(engine, cnpj_busca)
+        # Só o cadastro bloqueia o cabeçalho; as demais consultas dependem da aba aberta
+        futuros = submeter_dados_empresa(engine, cnpj_busca, ['cadastro'])
+
+        with st.spinner("Carregando dados cadastrais da empresa..."):
+            df_cadastro = resultado_consulta(futuros['cadastro'])
         
-        if dados_empresa and 'cadastro' in dados_empresa and not dados_empresa['cadastro'].empty:
-            cadastro = dados_empresa['cadastro'].iloc[0]
+        if df_cadastro is not None and not df_cadastro.empty:
+            cadastro = df_cadastro.iloc[0]
             
             # Header da empresa
             st.markdown(f"## {cadastro['nm_razao_social']}")
             st.markdown(f"**CNPJ:** {cnpj_busca} | **UF:** {cadastro['cd_uf']} | **Setor:** {cadastro.get('cnae_divisao_descricao', 'N/A')}")
             
-            # Abas de navegação
-            tab1, tab2, tab3, tab4, tab5 = st.tabs([
-                "📝 Dados Cadastrais",
-                "📊 Indicadores Financeiros",
-                "💰 Balanço Patrimonial",
-                "📈 DRE",
-                "⚠️ Análise de Risco"
-            ])
+            # Abas de navegação: com st.tabs todas seriam desenhadas (e consultadas) a
+            # cada rerun; aqui só a aba escolhida busca os seus dados
+            aba = st.radio(
+                "Aba",
+                list(ABAS_EMPRESA),
+                horizontal=True,
+                key='aba_empresa',
+                label_visibility="collapsed"
+            )
+            dependencias_aba = ABAS_EMPRESA[aba]
+            futuros.update(submeter_dados_empresa(
+                engine, cnpj_busca, [d for d in dependencias_aba if d in PARTES_EMPRESA]
+            ))
+            if 'setor' in dependencias_aba:
+                futuros.update(submeter_consultas({
+                    'setor': (carregar_indicadores_agregados, (engine, ano_selecionado), {})
+                }))
             
             # ABA 1: Dados Cadastrais
-            with tab1:
+            if aba == "📝 Dados Cadastrais":
                 col1, col2 = st.columns(2)
                 
                 with col1:
@@ -1991,14 +4011,25 @@ elif pagina == "🏢 Detalhamento de Empresa":
                     st.write(f"**Natureza Jurídica:** {cadastro.get('nm_natureza_juridica_sefaz', 'N/A')}")
                     st.write(f"**Regime de Apuração:** {cadastro.get('nm_reg_apuracao', 'N/A')}")
                     st.write(f"**Simples Nacional:** {cadastro.get('sn_simples_nacional_rfb', 'N/A')}")
+
+                # Demais colunas do cadastro (~40) só são buscadas quando pedidas
+                if st.checkbox("Mostrar cadastro completo", key='cadastro_completo'):
+                    df_cadastro_completo = carregar_parte_empresa(engine, cnpj_busca, 'cadastro', completo=True)
+                    if df_cadastro_completo is not None and not df_cadastro_completo.empty:
+                        extras = df_cadastro_completo.iloc[0].drop(COLUNAS_EMPRESA['cadastro'], errors='ignore')
+                        st.dataframe(
+                            pd.DataFrame({'Campo': extras.index, 'Valor': extras.astype(str).values}),
+                            use_container_width=True,
+                            hide_index=True
+                        )
             
-            # ABA 2: Indicadores Financeiros
-            with tab2:
-                if 'indicadores' in dados_empresa and not dados_empresa['indicadores'].empty:
+            def exibir_indicadores(indicadores):
+                """ABA 2: Indicadores Financeiros."""
+                if indicadores is not None and not indicadores.empty:
                     st.markdown("### 📊 Indicadores Financeiros")
 
                     # ✅ Versão com mais colunas
-                    df_indicadores = dados_empresa['indicadores'][[
+                    df_indicadores = indicadores[[
                         'ativo_total', 'ativo_circulante', 'ativo_nao_circulante',
                         'passivo_total', 'passivo_circulante', 'passivo_nao_circulante',
                         'patrimonio_liquido', 'receita_liquida', 'lucro_bruto',
@@ -2037,31 +4068,31 @@ elif pagina == "🏢 Detalhamento de Empresa":
                     )
                 else:
                     st.warning("Sem dados de indicadores financeiros.")
-            
-            # ABA 3: Balanço Patrimonial
-            with tab3:
-                if 'balanco' in dados_empresa and not dados_empresa['balanco'].empty:
-                    anos_balanco = sorted([x // 100 for x in dados_empresa['balanco']['ano_referencia'].unique()], reverse=True)
+
+            def exibir_balanco(balanco):
+                """ABA 3: Balanço Patrimonial."""
+                if balanco is not None and not balanco.empty:
+                    anos_balanco = sorted(balanco['ano_fiscal'].unique().tolist(), reverse=True)
                     ano_bp = st.selectbox("Selecione o Ano", anos_balanco, key='ano_bp')
-                    criar_balanco_patrimonial(dados_empresa['balanco'], ano_bp)
+                    criar_balanco_patrimonial(balanco, ano_bp)
                 else:
                     st.warning("Sem dados de Balanço Patrimonial.")
-            
-            # ABA 4: DRE
-            with tab4:
-                if 'dre' in dados_empresa and not dados_empresa['dre'].empty:
-                    anos_dre = sorted([x // 100 for x in dados_empresa['dre']['ano_referencia'].unique()], reverse=True)
+
+            def exibir_dre(dre):
+                """ABA 4: DRE."""
+                if dre is not None and not dre.empty:
+                    anos_dre = sorted(dre['ano_fiscal'].unique().tolist(), reverse=True)
                     ano_dre = st.selectbox("Selecione o Ano", anos_dre, key='ano_dre')
-                    criar_dre(dados_empresa['dre'], ano_dre)
+                    criar_dre(dre, ano_dre)
                 else:
                     st.warning("Sem dados de DRE.")
-            
-            # ABA 5: Análise de Risco (COM COMPARAÇÃO SETORIAL)
-            with tab5:
-                if 'risco' in dados_empresa and not dados_empresa['risco'].empty:
+
+            def exibir_risco(risco):
+                """ABA 5: resumo do risco consolidado."""
+                if risco is not None and not risco.empty:
                     st.markdown("### ⚠️ Análise de Risco Consolidada")
                     
-                    risco_atual = dados_empresa['risco'].iloc[0]
+                    risco_atual = risco.iloc[0]
                     
                     col1, col2, col3, col4 = st.columns(4)
                     
@@ -2090,142 +4121,146 @@ elif pagina == "🏢 Detalhamento de Empresa":
                         st.metric("Indícios NEAF", int(risco_atual['qtd_indicios_neaf']))
                     
                     st.markdown("---")
-                    
-                    # ANÁLISE COMPARATIVA COM O SETOR
-                    st.markdown("### 📊 Análise Comparativa com o Setor")
-                    
-                    setor_empresa = cadastro.get('cnae_divisao_descricao', None)
-                    
-                    if setor_empresa and 'indicadores' in dados_empresa and not dados_empresa['indicadores'].empty:
-                        # Carregar dados do setor
-                        with st.spinner("Carregando dados do setor para comparação..."):
-                            df_setor = carregar_indicadores_agregados(engine, ano_selecionado)
-                        
-                        if df_setor is not None and not df_setor.empty:
-                            setor_info = df_setor[df_setor['setor'] == setor_empresa]
-                            
-                            if not setor_info.empty:
-                                setor_info = setor_info.iloc[0]
-                                ind_empresa = dados_empresa['indicadores'].iloc[0]
-                                
-                                # Criar tabela comparativa
-                                st.markdown(f"**Comparando com o setor:** {setor_empresa}")
-                                st.markdown(f"**Quantidade de empresas no setor:** {int(setor_info['qtd_empresas']):,}")
-                                
-                                # Análise de cada indicador
-                                indicadores_analise = {
-                                    'Liquidez Corrente': {
-                                        'valor_empresa': ind_empresa['liquidez_corrente'],
-                                        'media_setor': setor_info['media_liquidez'],
-                                        'ideal_min': 1.0,
-                                        'ideal_max': 2.0
-                                    },
-                                    'Endividamento Geral': {
-                                        'valor_empresa': ind_empresa['endividamento_geral'],
-                                        'media_setor': setor_info['media_endividamento'],
-                                        'ideal_min': 0.0,
-                                        'ideal_max': 0.5
-                                    },
-                                    'Margem Líquida (%)': {
-                                        'valor_empresa': ind_empresa['margem_liquida_perc'],
-                                        'media_setor': setor_info['media_margem_liquida'],
-                                        'ideal_min': 5.0,
-                                        'ideal_max': 100.0
-                                    },
-                                    'ROA (%)': {
-                                        'valor_empresa': ind_empresa['roa_retorno_ativo_perc'],
-                                        'media_setor': setor_info['media_roa'],
-                                        'ideal_min': 5.0,
-                                        'ideal_max': 100.0
-                                    },
-                                    'ROE (%)': {
-                                        'valor_empresa': ind_empresa['roe_retorno_patrimonio_perc'],
-                                        'media_setor': setor_info['media_roe'],
-                                        'ideal_min': 10.0,
-                                        'ideal_max': 100.0
-                                    }
+                else:
+                    st.warning("Sem dados de análise de risco.")
+
+            def exibir_comparativo_setor(risco, indicadores, df_setor):
+                """ABA 5: comparação com o setor (consultado em paralelo às consultas da empresa)."""
+                if risco is None or risco.empty:
+                    return
+                
+                # ANÁLISE COMPARATIVA COM O SETOR
+                st.markdown("### 📊 Análise Comparativa com o Setor")
+
+                setor_empresa = cadastro.get('cnae_divisao_descricao', None)
+
+                if setor_empresa and indicadores is not None and not indicadores.empty:
+                    if df_setor is not None and not df_setor.empty:
+                        setor_info = df_setor[df_setor['setor'] == setor_empresa]
+
+                        if not setor_info.empty:
+                            setor_info = setor_info.iloc[0]
+                            ind_empresa = indicadores.iloc[0]
+
+                            # Criar tabela comparativa
+                            st.markdown(f"**Comparando com o setor:** {setor_empresa}")
+                            st.markdown(f"**Quantidade de empresas no setor:** {int(setor_info['qtd_empresas']):,}")
+
+                            # Análise de cada indicador
+                            indicadores_analise = {
+                                'Liquidez Corrente': {
+                                    'valor_empresa': ind_empresa['liquidez_corrente'],
+                                    'media_setor': setor_info['media_liquidez'],
+                                    'ideal_min': 1.0,
+                                    'ideal_max': 2.0
+                                },
+                                'Endividamento Geral': {
+                                    'valor_empresa': ind_empresa['endividamento_geral'],
+                                    'media_setor': setor_info['media_endividamento'],
+                                    'ideal_min': 0.0,
+                                    'ideal_max': 0.5
+                                },
+                                'Margem Líquida (%)': {
+                                    'valor_empresa': ind_empresa['margem_liquida_perc'],
+                                    'media_setor': setor_info['media_margem_liquida'],
+                                    'ideal_min': 5.0,
+                                    'ideal_max': 100.0
+                                },
+                                'ROA (%)': {
+                                    'valor_empresa': ind_empresa['roa_retorno_ativo_perc'],
+                                    'media_setor': setor_info['media_roa'],
+                                    'ideal_min': 5.0,
+                                    'ideal_max': 100.0
+                                },
+                                'ROE (%)': {
+                                    'valor_empresa': ind_empresa['roe_retorno_patrimonio_perc'],
+                                    'media_setor': setor_info['media_roe'],
+                                    'ideal_min': 10.0,
+                                    'ideal_max': 100.0
                                 }
-                                
-                                # ✅ NOVO: Limpar valores None do dicionário
-                                for indicador in indicadores_analise:
-                                    if indicadores_analise[indicador]['valor_empresa'] is None or \
-                                       pd.isna(indicadores_analise[indicador]['valor_empresa']):
-                                        indicadores_analise[indicador]['valor_empresa'] = 0
-                                    
-                                    if indicadores_analise[indicador]['media_setor'] is None or \
-                                       pd.isna(indicadores_analise[indicador]['media_setor']):
-                                        indicadores_analise[indicador]['media_setor'] = 0
-                                
-                                # Criar visualização para cada indicador
-                                for indicador, valores in indicadores_analise.items():
-                                    valor_emp = valores['valor_empresa']
-                                    media_set = valores['media_setor']
-                                    ideal_min = valores['ideal_min']
-                                    ideal_max = valores['ideal_max']
-                                    
-                                    # Calcular desvio percentual
-                                    if media_set != 0:
-                                        desvio_perc = ((valor_emp - media_set) / abs(media_set)) * 100
-                                    else:
-                                        desvio_perc = 0
-                                    
-                                    # Determinar status
-                                    if valor_emp == 0 and media_set == 0:
-                                        status = "⚪ Sem dados"
-                                        cor_status = "alert-medio"
-                                    elif ideal_min <= valor_emp <= ideal_max:
-                                        status = "✅ Normal"
-                                        cor_status = "alert-positivo"
-                                    elif abs(desvio_perc) > 50:
-                                        status = "🚨 Anômalo (>50% de desvio)"
-                                        cor_status = "alert-critico"
-                                    elif abs(desvio_perc) > 25:
-                                        status = "⚠️ Atenção (>25% de desvio)"
-                                        cor_status = "alert-alto"
-                                    else:
-                                        status = "⚡ Levemente diferente"
-                                        cor_status = "alert-medio"
-                                    
-                                    # Exibir análise
-                                    st.markdown(f"""
-                                    <div class='{cor_status}'>
-                                        <h4>{indicador}</h4>
-                                        <p><strong>Empresa:</strong> {valor_emp:.2f}</p>
-                                        <p><strong>Média do Setor:</strong> {media_set:.2f}</p>
-                                        <p><strong>Desvio:</strong> {desvio_perc:+.1f}%</p>
-                                        <p><strong>Status:</strong> {status}</p>
-                                        <p><small>Faixa ideal: {ideal_min:.1f} a {ideal_max:.1f}</small></p>
-                                    </div>
-                                    """, unsafe_allow_html=True)
-                                
-                                # Gráfico de radar comparativo
-                                st.markdown("---")
-                                st.markdown("#### 📊 Comparação Visual com o Setor")
-                                
+                            }
+
+                            # ✅ NOVO: Limpar valores None do dicionário
+                            for indicador in indicadores_analise:
+                                if indicadores_analise[indicador]['valor_empresa'] is None or \
+                                   pd.isna(indicadores_analise[indicador]['valor_empresa']):
+                                    indicadores_analise[indicador]['valor_empresa'] = 0
+
+                                if indicadores_analise[indicador]['media_setor'] is None or \
+                                   pd.isna(indicadores_analise[indicador]['media_setor']):
+                                    indicadores_analise[indicador]['media_setor'] = 0
+
+                            # Criar visualização para cada indicador
+                            for indicador, valores in indicadores_analise.items():
+                                valor_emp = valores['valor_empresa']
+                                media_set = valores['media_setor']
+                                ideal_min = valores['ideal_min']
+                                ideal_max = valores['ideal_max']
+
+                                # Calcular desvio percentual
+                                if media_set != 0:
+                                    desvio_perc = ((valor_emp - media_set) / abs(media_set)) * 100
+                                else:
+                                    desvio_perc = 0
+
+                                # Determinar status
+                                if valor_emp == 0 and media_set == 0:
+                                    status = "⚪ Sem dados"
+                                    cor_status = "alert-medio"
+                                elif ideal_min <= valor_emp <= ideal_max:
+                                    status = "✅ Normal"
+                                    cor_status = "alert-positivo"
+                                elif abs(desvio_perc) > 50:
+                                    status = "🚨 Anômalo (>50% de desvio)"
+                                    cor_status = "alert-critico"
+                                elif abs(desvio_perc) > 25:
+                                    status = "⚠️ Atenção (>25% de desvio)"
+                                    cor_status = "alert-alto"
+                                else:
+                                    status = "⚡ Levemente diferente"
+                                    cor_status = "alert-medio"
+
+                                # Exibir análise
+                                st.markdown(f"""
+                                <div class='{cor_status}'>
+                                    <h4>{indicador}</h4>
+                                    <p><strong>Empresa:</strong> {valor_emp:.2f}</p>
+                                    <p><strong>Média do Setor:</strong> {media_set:.2f}</p>
+                                    <p><strong>Desvio:</strong> {desvio_perc:+.1f}%</p>
+                                    <p><strong>Status:</strong> {status}</p>
+                                    <p><small>Faixa ideal: {ideal_min:.1f} a {ideal_max:.1f}</small></p>
+                                </div>
+                                """, unsafe_allow_html=True)
+
+                            # Gráfico de radar comparativo
+                            st.markdown("---")
+                            st.markdown("#### 📊 Comparação Visual com o Setor")
+
+                            def construir_figura():
                                 fig = go.Figure()
-                                
+
                                 categorias = list(indicadores_analise.keys())
                                 valores_empresa = [indicadores_analise[cat]['valor_empresa'] for cat in categorias]
                                 valores_setor = [indicadores_analise[cat]['media_setor'] for cat in categorias]
-                                
+
                                 # Normalizar valores para o gráfico (0-100)
                                 def normalizar(valor, minimo, maximo):
                                     if maximo == minimo:
                                         return 50
                                     return ((valor - minimo) / (maximo - minimo)) * 100
-                                
+
                                 valores_empresa_norm = []
                                 valores_setor_norm = []
-                                
+
                                 for cat in categorias:
                                     val_emp = indicadores_analise[cat]['valor_empresa']
                                     val_set = indicadores_analise[cat]['media_setor']
                                     minimo = min(val_emp, val_set, 0)
                                     maximo = max(val_emp, val_set, indicadores_analise[cat]['ideal_max'])
-                                    
+
                                     valores_empresa_norm.append(normalizar(val_emp, minimo, maximo))
                                     valores_setor_norm.append(normalizar(val_set, minimo, maximo))
-                                
+
                                 fig.add_trace(go.Scatterpolar(
                                     r=valores_empresa_norm + [valores_empresa_norm[0]],
                                     theta=categorias + [categorias[0]],
@@ -2233,7 +4268,7 @@ elif pagina == "🏢 Detalhamento de Empresa":
                                     name='Empresa',
                                     line=dict(color='#e53e3e', width=3)
                                 ))
-                                
+
                                 fig.add_trace(go.Scatterpolar(
                                     r=valores_setor_norm + [valores_setor_norm[0]],
                                     theta=categorias + [categorias[0]],
@@ -2242,33 +4277,42 @@ elif pagina == "🏢 Detalhamento de Empresa":
                                     line=dict(color='#3182ce', width=2),
                                     opacity=0.6
                                 ))
-                                
+
                                 fig.update_layout(
                                     polar=dict(radialaxis=dict(visible=True, range=[0, 100])),
                                     showlegend=True,
                                     title="Perfil da Empresa vs Setor (Normalizado 0-100)",
                                     height=500
                                 )
-                                
-                                st.plotly_chart(fig, use_container_width=True)
-                            else:
-                                st.info("Setor não encontrado na base de dados para comparação.")
+                                return fig
+
+                            exibir_figura('detalhamento_de_empresa_comparacao_visual_com_o_setor', (indicadores_analise,), construir_figura)
                         else:
-                            st.warning("Não foi possível carregar dados do setor para comparação.")
+                            st.info("Setor não encontrado na base de dados para comparação.")
                     else:
-                        st.info("Dados insuficientes para análise comparativa com o setor.")
-                    
-                    st.markdown("---")
-                    
-                    # Detalhamento dos scores
-                    st.markdown("### 📊 Detalhamento dos Scores")
-                    
-                    scores = {
-                        'Equação Contábil': risco_atual['score_equacao_contabil'],
-                        'NEAF': risco_atual['score_neaf'],
-                        'Risco Financeiro': risco_atual['score_risco_financeiro']
-                    }
-                    
+                        st.warning("Não foi possível carregar dados do setor para comparação.")
+                else:
+                    st.info("Dados insuficientes para análise comparativa com o setor.")
+
+                st.markdown("---")
+
+            def exibir_scores_risco(risco):
+                """ABA 5: detalhamento dos scores, alertas e evolução do risco."""
+                if risco is None or risco.empty:
+                    return
+                
+                risco_atual = risco.iloc[0]
+                
+                # Detalhamento dos scores
+                st.markdown("### 📊 Detalhamento dos Scores")
+
+                scores = {
+                    'Equação Contábil': risco_atual['score_equacao_contabil'],
+                    'NEAF': risco_atual['score_neaf'],
+                    'Risco Financeiro': risco_atual['score_risco_financeiro']
+                }
+
+                def construir_figura():
                     fig = go.Figure(data=[
                         go.Bar(
                             x=list(scores.values()),
@@ -2284,51 +4328,53 @@ elif pagina == "🏢 Detalhamento de Empresa":
                             textposition='outside'
                         )
                     ])
-                    
+
                     fig.update_layout(
-                        title="Componentes do Score de Risco",
-                        xaxis_title="Pontuação",
-                        height=300,
-                        showlegend=False
-                    )
-                    
-                    st.plotly_chart(fig, use_container_width=True)
-                    
-                    # Alertas
-                    if risco_atual['score_risco_total'] >= 7:
-                        st.markdown("""
-                        <div class='alert-critico'>
-                            <h4>🚨 ALERTA CRÍTICO</h4>
-                            <p>Esta empresa apresenta alto risco e deve ser priorizada para fiscalização.</p>
-                        </div>
-                        """, unsafe_allow_html=True)
-                    elif risco_atual['score_risco_total'] >= 5:
-                        st.markdown("""
-                        <div class='alert-alto'>
-                            <h4>⚠️ ALERTA ALTO</h4>
-                            <p>Esta empresa apresenta riscos significativos e merece atenção.</p>
-                        </div>
-                        """, unsafe_allow_html=True)
-                    else:
-                        st.markdown("""
-                        <div class='alert-positivo'>
-                            <h4>✅ RISCO CONTROLADO</h4>
-                            <p>Esta empresa apresenta baixo risco fiscal.</p>
-                        </div>
-                        """, unsafe_allow_html=True)
-                    
-                    # Histórico de risco
-                    if len(dados_empresa['risco']) > 1:
-                        st.markdown("---")
-                        st.markdown("### 📈 Evolução do Risco")
-                        
-                        df_risco = dados_empresa['risco'].copy()
-                        df_risco = limpar_dataframe_para_exibicao(df_risco)  # ✅ ADICIONAR
-                        df_risco['ano'] = df_risco['ano_referencia'] // 100
-                        df_risco = df_risco.sort_values('ano')
-                        
+                        title="Componentes do Score de Risco",
+                        xaxis_title="Pontuação",
+                        height=300,
+                        showlegend=False
+                    )
+                    return fig
+
+                exibir_figura('detalhamento_de_empresa_detalhamento_dos_scores', (scores,), construir_figura)
+
+                # Alertas
+                if risco_atual['score_risco_total'] >= 7:
+                    st.markdown("""
+                    <div class='alert-critico'>
+                        <h4>🚨 ALERTA CRÍTICO</h4>
+                        <p>Esta empresa apresenta alto risco e deve ser priorizada para fiscalização.</p>
+                    </div>
+                    """, unsafe_allow_html=True)
+                elif risco_atual['score_risco_total'] >= 5:
+                    st.markdown("""
+                    <div class='alert-alto'>
+                        <h4>⚠️ ALERTA ALTO</h4>
+                        <p>Esta empresa apresenta riscos significativos e merece atenção.</p>
+                    </div>
+                    """, unsafe_allow_html=True)
+                else:
+                    st.markdown("""
+                    <div class='alert-positivo'>
+                        <h4>✅ RISCO CONTROLADO</h4>
+                        <p>Esta empresa apresenta baixo risco fiscal.</p>
+                    </div>
+                    """, unsafe_allow_html=True)
+
+                # Histórico de risco
+                if len(risco) > 1:
+                    st.markdown("---")
+                    st.markdown("### 📈 Evolução do Risco")
+
+                    df_risco = risco.copy()
+                    df_risco = limpar_dataframe_para_exibicao(df_risco)  # ✅ ADICIONAR
+                    df_risco['ano'] = df_risco['ano_fiscal']
+                    df_risco = df_risco.sort_values('ano')
+
+                    def construir_figura():
                         fig = go.Figure()
-                        
+
                         fig.add_trace(go.Scatter(
                             x=df_risco['ano'],
                             y=df_risco['score_risco_total'],
@@ -2337,7 +4383,7 @@ elif pagina == "🏢 Detalhamento de Empresa":
                             line=dict(color='#e53e3e', width=3),
                             marker=dict(size=10)
                         ))
-                        
+
                         fig.add_trace(go.Scatter(
                             x=df_risco['ano'],
                             y=df_risco['score_equacao_contabil'],
@@ -2345,7 +4391,7 @@ elif pagina == "🏢 Detalhamento de Empresa":
                             name='Equação Contábil',
                             line=dict(color='#3182ce', width=2)
                         ))
-                        
+
                         fig.add_trace(go.Scatter(
                             x=df_risco['ano'],
                             y=df_risco['score_neaf'],
@@ -2353,7 +4399,7 @@ elif pagina == "🏢 Detalhamento de Empresa":
                             name='NEAF',
                             line=dict(color='#f59e0b', width=2)
                         ))
-                        
+
                         fig.update_layout(
                             title="Evolução dos Scores de Risco",
                             xaxis_title="Ano",
@@ -2361,14 +4407,37 @@ elif pagina == "🏢 Detalhamento de Empresa":
                             height=400,
                             hovermode='x unified'
                         )
-                        
-                        st.plotly_chart(fig, use_container_width=True)
-                else:
-                    st.warning("Sem dados de análise de risco.")
+                        return fig
+
+                    exibir_figura('detalhamento_de_empresa_evolucao_do_risco', (df_risco,), construir_figura)
+
+            # Seções da aba escolhida, desenhadas assim que as suas consultas terminam
+            if aba == "📊 Indicadores Financeiros":
+                secoes = [(secao_pendente("Carregando indicadores financeiros..."), ['indicadores'], exibir_indicadores)]
+            elif aba == "💰 Balanço Patrimonial":
+                secoes = [(secao_pendente("Carregando Balanço Patrimonial..."), ['balanco'], exibir_balanco)]
+            elif aba == "📈 DRE":
+                secoes = [(secao_pendente("Carregando DRE..."), ['dre'], exibir_dre)]
+            elif aba == "⚠️ Análise de Risco":
+                secoes = [
+                    (secao_pendente("Carregando análise de risco..."), ['risco'], exibir_risco),
+                    (secao_pendente("Carregando dados do setor para comparação..."), ['risco', 'indicadores', 'setor'], exibir_comparativo_setor),
+                    (st.empty(), ['risco'], exibir_scores_risco)
+                ]
+            else:
+                secoes = []
+            renderizar_progressivo(futuros, secoes)
+
+            # Pré-carga das outras abas em segundo plano, enquanto o usuário lê a atual
+            for parte in PARTES_EMPRESA:
+                if parte not in futuros:
+                    prefetch_pagina(carregar_parte_empresa, engine, cnpj_busca, parte)
+            if 'setor' not in futuros:
+                prefetch_pagina(carregar_indicadores_agregados, engine, ano_selecionado)
         else:
             st.error("Empresa não encontrada no banco de dados.")
     else:
-        st.info("👆 Digite um CNPJ válido (14 dígitos) e clique em Buscar para consultar os dados da empresa.")
+        st.info("👆 Digite um CNPJ ou o nome da empresa e selecione uma das sugestões para consultar os dados.")
 
 # ---------------------------------------------------------------------------
 # PÁGINA: FISCALIZAÇÃO INTELIGENTE (ML)
@@ -2401,7 +4470,7 @@ elif pagina == "🎯 Fiscalização Inteligente (ML)":
 
     # Carregar dados de alto risco
     with st.spinner("Carregando dados para análise de ML..."):
-        df_alto_risco = carregar_empresas_alto_risco(engine, limite=1000, ano=ano_selecionado)
+        df_alto_risco = carregar_empresas_alto_risco(engine, limite=LIMITE_EMPRESAS_ML, ano=ano_selecionado)
 
     if df_alto_risco is not None and not df_alto_risco.empty:
         # Treinar modelo
@@ -2459,7 +4528,8 @@ elif pagina == "🎯 Fiscalização Inteligente (ML)":
             with col1:
                 st.markdown("### 📊 Distribuição de Prioridades ML")
                 prioridade_counts = df_ml_completo['prioridade_ml'].value_counts()
-                fig = px.pie(
+                exibir_grafico(
+                    'fiscalizacao_inteligente_ml_distribuicao_de_prioridades_ml', px.pie,
                     values=prioridade_counts.values,
                     names=prioridade_counts.index,
                     color=prioridade_counts.index,
@@ -2470,27 +4540,29 @@ elif pagina == "🎯 Fiscalização Inteligente (ML)":
                         'Baixa': '#689f38'
                     }
                 )
-                st.plotly_chart(fig, use_container_width=True)
             
             with col2:
                 st.markdown("### 🎯 Clusters de Risco")
                 cluster_counts = dados_ml['cluster'].value_counts()
-                fig = px.bar(
+                exibir_grafico(
+                    'fiscalizacao_inteligente_ml_clusters_de_risco', px.bar,
                     x=cluster_counts.index,
                     y=cluster_counts.values,
                     labels={'x': 'Cluster', 'y': 'Quantidade'},
                     color=cluster_counts.values,
                     color_continuous_scale='Reds'
                 )
-                st.plotly_chart(fig, use_container_width=True)
             
             # Scatter plot
             st.markdown("### 🔍 Análise Multidimensional")
             
-            fig = px.scatter(
+            # Anomalias do Isolation Forest e prioridades críticas nunca saem da amostra
+            exibir_scatter_grande(
                 df_ml_completo,
-                x='ativo_milhoes',
-                y='score_risco_total',
+                'ativo_milhoes',
+                'score_risco_total',
+                chave='ml',
+                preservar=(df_ml_completo['score_ml_anomalia'] > 0) | (df_ml_completo['prioridade_ml'] == 'Crítica'),
                 color='prioridade_ml',
                 size='score_ml_total',
                 hover_data=['nm_razao_social', 'setor', 'cd_uf'],
@@ -2504,12 +4576,10 @@ elif pagina == "🎯 Fiscalização Inteligente (ML)":
                     'ativo_milhoes': 'Ativo (R$ Milhões)',
                     'score_risco_total': 'Score de Risco',
                     'prioridade_ml': 'Prioridade ML'
-                }
+                },
+                layout=dict(height=600)
             )
             
-            fig.update_layout(height=600)
-            st.plotly_chart(fig, use_container_width=True)
-            
             # Top prioridades
             st.markdown("---")
             st.markdown("### 🎯 Top 50 Empresas Prioritárias para Fiscalização (ML)")
@@ -2549,6 +4619,9 @@ elif pagina == "🎯 Fiscalização Inteligente (ML)":
                     file_name=f"fiscalizacao_ml_{datetime.now().strftime('%Y%m%d')}.csv",
                     mime="text/csv"
                 )
+
+            if st.button("📦 Dossiê em Lote (Top 50)"):
+                enviar_para_dossie(df_top_ml['cnpj'])
         else:
             st.warning("Não foi possível treinar o modelo de ML com os dados disponíveis.")
     else:
@@ -2597,18 +4670,30 @@ elif pagina == "⚠️ Empresas Alto Risco":
         uf_filtro = st.selectbox("Filtrar por UF", ufs, help="Filtrar por Unidade Federativa")
 
     with col3:
-        limite_registros = st.selectbox("Quantidade de registros", [50, 100, 200, 500], index=2, help="Limite de empresas a exibir")
+        limite_registros = st.selectbox("Empresas por página", [50, 100, 200, 500], index=2, help="Quantidade de empresas em cada página da fila")
+
+    # Filtros aplicados no servidor; a página atual é identificada pelo cursor
+    uf_consulta = None if uf_filtro == 'Todos' else uf_filtro
+    cursor_atual, numero_pagina = obter_cursor_pagina(
+        'paginas_alto_risco', (ano_selecionado, min_score, uf_consulta, limite_registros)
+    )
 
     # Carregar dados
     with st.spinner("Carregando empresas de alto risco..."):
-        df_alto_risco = carregar_empresas_alto_risco(engine, limite=limite_registros, ano=ano_selecionado)
+        df_alto_risco, proximo_cursor = carregar_pagina_alto_risco(
+            engine, ano=ano_selecionado, cursor=cursor_atual, tamanho_pagina=limite_registros,
+            score_minimo=min_score, uf=uf_consulta
+        )
 
-    if df_alto_risco is not None and not df_alto_risco.empty:
-        # Aplicar filtros
-        df_filtrado = df_alto_risco[df_alto_risco['score_risco_total'] >= min_score].copy()
+    # Pré-carregar a próxima página enquanto o analista lê esta
+    if proximo_cursor is not None:
+        prefetch_pagina(
+            carregar_pagina_alto_risco, engine, ano=ano_selecionado, cursor=proximo_cursor,
+            tamanho_pagina=limite_registros, score_minimo=min_score, uf=uf_consulta
+        )
 
-        if uf_filtro != 'Todos':
-            df_filtrado = df_filtrado[df_filtrado['cd_uf'] == uf_filtro]
+    if df_alto_risco is not None and not df_alto_risco.empty:
+        df_filtrado = df_alto_risco.copy()
 
         # Estatísticas com tooltips
         col1, col2, col3, col4 = st.columns(4)
@@ -2616,8 +4701,8 @@ elif pagina == "⚠️ Empresas Alto Risco":
         with col1:
             st.markdown(criar_card_com_tooltip(
                 str(len(df_filtrado)),
-                "Empresas Listadas",
-                f"Total de empresas com score de risco ≥ {min_score} após aplicação dos filtros selecionados.",
+                f"Empresas na Página {numero_pagina}",
+                f"Empresas com score de risco ≥ {min_score} exibidas nesta página da fila de fiscalização.",
                 "metric-card"
             ), unsafe_allow_html=True)
 
@@ -2656,7 +4741,8 @@ elif pagina == "⚠️ Empresas Alto Risco":
         with col1:
             st.markdown("### 📊 Distribuição por Classificação")
             class_counts = df_filtrado['classificacao_risco'].value_counts()
-            fig = px.bar(
+            exibir_grafico(
+                'empresas_alto_risco_distribuicao_por_classificacao', px.bar,
                 x=class_counts.index,
                 y=class_counts.values,
                 color=class_counts.index,
@@ -2667,19 +4753,18 @@ elif pagina == "⚠️ Empresas Alto Risco":
                 },
                 labels={'x': 'Classificação', 'y': 'Quantidade'}
             )
-            st.plotly_chart(fig, use_container_width=True)
         
         with col2:
             st.markdown("### 🎯 Distribuição por Prioridade")
             prior_counts = df_filtrado['prioridade_fiscalizacao'].value_counts().sort_index()
-            fig = px.bar(
+            exibir_grafico(
+                'empresas_alto_risco_distribuicao_por_prioridade', px.bar,
                 x=prior_counts.index,
                 y=prior_counts.values,
                 color=prior_counts.values,
                 color_continuous_scale='Reds',
                 labels={'x': 'Prioridade', 'y': 'Quantidade'}
             )
-            st.plotly_chart(fig, use_container_width=True)
         
         # Tabela principal
         st.markdown("---")
@@ -2705,6 +4790,8 @@ elif pagina == "⚠️ Empresas Alto Risco":
             use_container_width=True,
             height=600
         )
+
+        exibir_controles_paginacao('paginas_alto_risco', proximo_cursor)
         
         # Download
         st.markdown("---")
@@ -2721,11 +4808,171 @@ elif pagina == "⚠️ Empresas Alto Risco":
                 )
         
         with col2:
-            if st.button("📄 Gerar Relatório"):
-                st.info("Funcionalidade em desenvolvimento")
+            if st.button("📦 Dossiê em Lote"):
+                enviar_para_dossie(df_filtrado['cnpj'])
     else:
         st.error("Não foi possível carregar os dados.")
 
+    # Simulador what-if de ponderação
+    st.markdown("---")
+    st.markdown("### 🧪 Simulador de Ponderação (What-if)")
+
+    with st.expander("Ajustar pesos e limites do score de risco", expanded=False):
+        st.markdown(criar_info_box(
+            "Como funciona",
+            f"Os componentes do score de todas as empresas de {ano_selecionado} são carregados uma única vez. Ao mover os controles, score, classificação e prioridade são recalculados para toda a população, sem reconstruir as tabelas no Impala."
+        ), unsafe_allow_html=True)
+
+        componentes = carregar_componentes_risco(engine, ano_selecionado)
+
+        if componentes is not None and len(componentes['cnpj_id']) > 0:
+            col1, col2, col3 = st.columns(3)
+            with col1:
+                peso_equacao = st.slider("Peso Equação Contábil", 0.0, 1.0, PESOS_SCORE_TOTAL['score_equacao_contabil'], 0.05)
+            with col2:
+                peso_neaf = st.slider("Peso NEAF", 0.0, 1.0, PESOS_SCORE_TOTAL['score_neaf'], 0.05)
+            with col3:
+                peso_financeiro = st.slider("Peso Risco Financeiro", 0.0, 1.0, PESOS_SCORE_TOTAL['score_risco_financeiro'], 0.05)
+
+            col1, col2, col3, col4 = st.columns(4)
+            with col1:
+                limite_critico = st.slider("Limite Risco Crítico", 0.0, 10.0, float(CLASSIFICACAO_RISCO[0][0]), 0.5)
+            with col2:
+                limite_alto = st.slider("Limite Risco Alto", 0.0, 10.0, float(CLASSIFICACAO_RISCO[1][0]), 0.5)
+            with col3:
+                limite_moderado = st.slider("Limite Risco Moderado", 0.0, 10.0, float(CLASSIFICACAO_RISCO[2][0]), 0.5)
+            with col4:
+                ativo_relevante_milhoes = st.number_input(
+                    "Ativo relevante (R$ milhões)",
+                    min_value=0,
+                    value=int(REGRAS_PRIORIDADE['ativo_relevante'] / 1000000),
+                    step=10
+                )
+
+            soma_pesos = peso_equacao + peso_neaf + peso_financeiro
+            if abs(soma_pesos - 1.0) > 0.001:
+                st.warning(f"⚠️ A soma dos pesos é {soma_pesos:.2f}. Com soma diferente de 1 a escala do score deixa de ser 0-10.")
+
+            # np.digitize exige limites ordenados
+            if not limite_moderado <= limite_alto <= limite_critico:
+                st.warning("⚠️ Os limites devem respeitar Moderado ≤ Alto ≤ Crítico. Ajuste os controles para simular.")
+            else:
+                pesos_simulados = {
+                    'score_equacao_contabil': peso_equacao,
+                    'score_neaf': peso_neaf,
+                    'score_risco_financeiro': peso_financeiro
+                }
+                faixas_simuladas = [
+                    (limite_critico, 'RISCO CRÍTICO'),
+                    (limite_alto, 'RISCO ALTO'),
+                    (limite_moderado, 'RISCO MODERADO')
+                ]
+                regras_prioridade_simuladas = {
+                    'score_critico': limite_critico,
+                    'ativo_relevante': ativo_relevante_milhoes * 1000000,
+                    'faixas': [(limite_alto, 3), (limite_moderado, 4)],
+                    'padrao': REGRAS_PRIORIDADE['padrao']
+                }
+
+                atual = simular_ponderacao(componentes, PESOS_SCORE_TOTAL)
+                simulado = simular_ponderacao(
+                    componentes, pesos_simulados, faixas_simuladas,
+                    CLASSIFICACAO_RISCO_PADRAO, regras_prioridade_simuladas
+                )
+
+                top_n = limite_registros
+                entram = (simulado['posicao'] <= top_n) & (atual['posicao'] > top_n)
+                mudam_classe = simulado['classificacao_risco'] != atual['classificacao_risco']
+
+                col1, col2, col3, col4 = st.columns(4)
+                with col1:
+                    st.markdown(criar_card_com_tooltip(
+                        f"{len(componentes['cnpj_id']):,}",
+                        "Empresas Simuladas",
+                        "Total de empresas do ano recalculadas a cada ajuste.",
+                        "metric-card"
+                    ), unsafe_allow_html=True)
+                with col2:
+                    st.markdown(criar_card_com_tooltip(
+                        f"{int(entram.sum()):,}",
+                        f"Entram no Top {top_n}",
+                        f"Empresas que passam a figurar entre as {top_n} primeiras da fila de fiscalização com os novos parâmetros.",
+                        "metric-card-red"
+                    ), unsafe_allow_html=True)
+                with col3:
+                    st.markdown(criar_card_com_tooltip(
+                        f"{int(mudam_classe.sum()):,}",
+                        "Mudam de Classificação",
+                        "Empresas cuja classificação de risco muda em relação aos parâmetros atuais.",
+                        "metric-card-yellow"
+                    ), unsafe_allow_html=True)
+                with col4:
+                    criticas_simuladas = int((simulado['prioridade_fiscalizacao'] == 1).sum())
+                    criticas_atuais = int((atual['prioridade_fiscalizacao'] == 1).sum())
+                    st.markdown(criar_card_com_tooltip(
+                        f"{criticas_simuladas:,}",
+                        "Prioridade Crítica",
+                        f"Empresas com prioridade 1 na simulação (atualmente: {criticas_atuais:,}).",
+                        "metric-card-blue"
+                    ), unsafe_allow_html=True)
+
+                # Distribuição atual x simulada
+                ordem_classes = [rotulo for _, rotulo in CLASSIFICACAO_RISCO] + [CLASSIFICACAO_RISCO_PADRAO]
+                df_classes = pd.DataFrame({
+                    'Classificação': ordem_classes * 2,
+                    'Cenário': ['Atual'] * len(ordem_classes) + ['Simulado'] * len(ordem_classes),
+                    'Empresas': [int((atual['classificacao_risco'] == c).sum()) for c in ordem_classes] +
+                                [int((simulado['classificacao_risco'] == c).sum()) for c in ordem_classes]
+                })
+
+                exibir_grafico(
+                    'empresas_alto_risco_simulacao_classes', px.bar,
+                    df_classes,
+                    x='Classificação',
+                    y='Empresas',
+                    color='Cenário',
+                    barmode='group',
+                    color_discrete_map={'Atual': '#90a4ae', 'Simulado': '#d32f2f'},
+                    layout=dict(height=400)
+                )
+
+                # Nova fila de fiscalização com variação de posição
+                st.markdown(f"#### 📋 Top {top_n} na Simulação")
+                indices_top = np.argsort(simulado['posicao'])[:top_n]
+                df_simulacao = pd.DataFrame({
+                    'cnpj': [formatar_cnpj(cnpj_id) for cnpj_id in componentes['cnpj_id'][indices_top]],
+                    'nm_razao_social': componentes['nm_razao_social'][indices_top],
+                    'posicao_simulada': simulado['posicao'][indices_top],
+                    'posicao_atual': atual['posicao'][indices_top],
+                    'variacao_posicao': atual['posicao'][indices_top] - simulado['posicao'][indices_top],
+                    'score_simulado': simulado['score_risco_total'][indices_top],
+                    'score_atual': atual['score_risco_total'][indices_top],
+                    'classificacao_simulada': simulado['classificacao_risco'][indices_top],
+                    'classificacao_atual': atual['classificacao_risco'][indices_top],
+                    'prioridade_simulada': simulado['prioridade_fiscalizacao'][indices_top]
+                })
+
+                df_simulacao = limpar_dataframe_para_exibicao(df_simulacao)
+                st.dataframe(
+                    df_simulacao.style.format({
+                        'score_simulado': '{:.2f}',
+                        'score_atual': '{:.2f}',
+                        'variacao_posicao': '{:+d}'
+                    }).background_gradient(subset=['variacao_posicao'], cmap='RdYlGn', vmin=-top_n, vmax=top_n),
+                    use_container_width=True,
+                    height=500
+                )
+
+                csv = df_simulacao.to_csv(index=False)
+                st.download_button(
+                    label="📥 Exportar Simulação (CSV)",
+                    data=csv,
+                    file_name=f"simulacao_risco_{ano_selecionado}_{datetime.now().strftime('%Y%m%d')}.csv",
+                    mime="text/csv"
+                )
+        else:
+            st.info("Componentes do score não disponíveis para o ano selecionado.")
+
 # ---------------------------------------------------------------------------
 # PÁGINA: INDICADORES FINANCEIROS
 # ---------------------------------------------------------------------------
@@ -2802,53 +5049,91 @@ elif pagina == "📉 Indicadores Financeiros":
             df_setores[coluna] = pd.to_numeric(df_setores[coluna], errors='coerce').fillna(0)
             df_top = df_setores.nlargest(15, coluna)
             
-            fig = px.bar(
+            exibir_grafico(
+                'indicadores_financeiros_top_15_setores', px.bar,
                 df_top,
                 x=coluna,
                 y='setor',
                 orientation='h',
                 color=coluna,
                 color_continuous_scale='RdYlGn' if indicador in ['Liquidez Corrente', 'Margem Líquida', 'ROA', 'ROE'] else 'RdYlGn_r',
-                labels={coluna: indicador, 'setor': 'Setor'}
+                labels={coluna: indicador, 'setor': 'Setor'},
+                layout=dict(height=600)
             )
-            fig.update_layout(height=600)
-            st.plotly_chart(fig, use_container_width=True)
         
+        # Distribuição por empresa (resumida no servidor: quantis, box e faixas)
+        with st.spinner("Calculando distribuição por empresa..."):
+            distribuicao = carregar_distribuicao_indicador(engine, indicador, ano=ano_selecionado)
+
         with col2:
-            st.markdown(f"### Distribuição - {indicador}")
-            fig = px.histogram(
-                df_setores,
-                x=coluna,
-                nbins=30,
-                labels={coluna: indicador},
-                color_discrete_sequence=['#3b82f6']
-            )
-            fig.update_layout(height=600)
-            st.plotly_chart(fig, use_container_width=True)
+            st.markdown(f"### Distribuição por Empresa - {indicador}")
+            if distribuicao is not None:
+                setor_distribuicao = st.selectbox(
+                    "Setor",
+                    ["Todos os setores"] + sorted(distribuicao['setores'].keys()),
+                    key='setor_distribuicao'
+                )
+                dist_exibida = distribuicao['geral'] if setor_distribuicao == "Todos os setores" else distribuicao['setores'][setor_distribuicao]
+                exibir_grafico(
+                    'indicadores_financeiros_distribuicao_por_empresa', criar_histograma_distribuicao,
+                    dist_exibida,
+                    indicador,
+                    layout=dict(height=520)
+                )
+            else:
+                st.warning("Distribuição por empresa indisponível.")
         
-        # Box plot
-        st.markdown("---")
-        st.markdown(f"### 📊 Análise de Dispersão - {indicador}")
-        
-        fig = px.box(
-            df_setores,
-            y=coluna,
-            points='all',
-            labels={coluna: indicador},
-            color_discrete_sequence=['#06b6d4']
-        )
-        fig.update_layout(height=400)
-        st.plotly_chart(fig, use_container_width=True)
+        if distribuicao is not None:
+            # Quantis
+            st.markdown("---")
+            st.markdown(f"### 📏 Quantis por Empresa - {indicador} ({setor_distribuicao})")
+
+            df_quantis = pd.DataFrame([{
+                'Empresas': dist_exibida['qtd'],
+                'Média': dist_exibida['media'],
+                **{percentil.upper(): valor for percentil, valor in dist_exibida['quantis'].items()},
+                'Outliers': dist_exibida['box']['qtd_outliers']
+            }])
+            st.dataframe(
+                df_quantis.style.format('{:,.2f}', subset=[c for c in df_quantis.columns if c not in ('Empresas', 'Outliers')]),
+                use_container_width=True,
+                hide_index=True
+            )
+
+            # Box plot
+            st.markdown("---")
+            st.markdown(f"### 📊 Análise de Dispersão por Setor - {indicador}")
+
+            maiores_setores = sorted(distribuicao['setores'].items(), key=lambda item: item[1]['qtd'], reverse=True)[:15]
+            exibir_grafico(
+                'indicadores_financeiros_analise_de_dispersao_por_setor', criar_box_distribuicao,
+                {'Todos os setores': distribuicao['geral'], **dict(maiores_setores)},
+                indicador,
+                layout=dict(height=500)
+            )
+            st.caption("Box plot de Tukey por empresa (bigodes até 1,5 × IQR) dos 15 setores com mais empresas.")
         
         # NOVA SEÇÃO: EMPRESAS SUSPEITAS
         st.markdown("---")
         st.markdown(f"### 🚨 Empresas Suspeitas - {indicador}")
         
+        cursor_suspeitas, pagina_suspeitas = obter_cursor_pagina(
+            'paginas_suspeitas', (indicador, ano_selecionado)
+        )
+
         with st.spinner(f"Carregando empresas com {indicador} suspeito..."):
-            df_suspeitas = carregar_empresas_suspeitas_indicador(engine, indicador, ano=ano_selecionado)
+            df_suspeitas, proximo_cursor_suspeitas = carregar_empresas_suspeitas_indicador(
+                engine, indicador, ano=ano_selecionado, cursor=cursor_suspeitas
+            )
+
+        if proximo_cursor_suspeitas is not None:
+            prefetch_pagina(
+                carregar_empresas_suspeitas_indicador, engine, indicador,
+                ano=ano_selecionado, cursor=proximo_cursor_suspeitas
+            )
         
         if df_suspeitas is not None and not df_suspeitas.empty:
-            st.markdown(f"**{len(df_suspeitas)} empresas** com valores críticos de {indicador}")
+            st.markdown(f"**{len(df_suspeitas)} empresas** com valores críticos de {indicador} (página {pagina_suspeitas})")
             
             # Explicar critérios
             criterios = {
@@ -2868,7 +5153,8 @@ elif pagina == "📉 Indicadores Financeiros":
                 st.markdown("#### Top 20 Valores Mais Críticos")
                 df_top_suspeitas = df_suspeitas.head(20)
                 
-                fig = px.bar(
+                exibir_grafico(
+                    'indicadores_financeiros_top_20_valores_mais_criticos', px.bar,
                     df_top_suspeitas,
                     x='valor_indicador',
                     y='nm_razao_social',
@@ -2876,32 +5162,31 @@ elif pagina == "📉 Indicadores Financeiros":
                     color='score_risco_total',
                     color_continuous_scale='Reds',
                     labels={'valor_indicador': indicador, 'nm_razao_social': 'Empresa'},
-                    hover_data=['setor', 'cd_uf', 'ativo_milhoes']
+                    hover_data=['setor', 'cd_uf', 'ativo_milhoes'],
+                    layout=dict(height=600)
                 )
-                fig.update_layout(height=600)
-                st.plotly_chart(fig, use_container_width=True)
             
             with col2:
                 st.markdown("#### Distribuição por UF")
                 uf_counts = df_suspeitas['cd_uf'].value_counts()
-                fig = px.pie(
+                exibir_grafico(
+                    'indicadores_financeiros_distribuicao_por_uf', px.pie,
                     values=uf_counts.values,
                     names=uf_counts.index,
-                    title="Empresas Suspeitas por Estado"
+                    title="Empresas Suspeitas por Estado",
+                    layout=dict(height=300)
                 )
-                fig.update_layout(height=300)
-                st.plotly_chart(fig, use_container_width=True)
                 
                 st.markdown("#### Distribuição por Setor")
                 setor_counts = df_suspeitas['setor'].value_counts().head(10)
-                fig = px.bar(
+                exibir_grafico(
+                    'indicadores_financeiros_distribuicao_por_setor', px.bar,
                     x=setor_counts.values,
                     y=setor_counts.index,
                     orientation='h',
-                    labels={'x': 'Quantidade', 'y': 'Setor'}
+                    labels={'x': 'Quantidade', 'y': 'Setor'},
+                    layout=dict(height=300)
                 )
-                fig.update_layout(height=300)
-                st.plotly_chart(fig, use_container_width=True)
             
             # Tabela detalhada
             st.markdown("#### 📋 Listagem Detalhada")
@@ -2932,6 +5217,8 @@ elif pagina == "📉 Indicadores Financeiros":
                 use_container_width=True,
                 height=400
             )
+
+            exibir_controles_paginacao('paginas_suspeitas', proximo_cursor_suspeitas)
             
             # Botão de exportação
             if st.button(f"📥 Exportar Empresas Suspeitas - {indicador}"):
@@ -3086,7 +5373,8 @@ elif pagina == "🗂️ Plano de Contas":
             df_filtrado['qtd_empresas_usam'] = pd.to_numeric(df_filtrado['qtd_empresas_usam'], errors='coerce').fillna(0)
             df_top = df_filtrado.nlargest(20, 'qtd_empresas_usam')
             
-            fig = px.bar(
+            exibir_grafico(
+                'plano_de_contas_top_20_contas_mais_utilizadas', px.bar,
                 df_top,
                 x='qtd_empresas_usam',
                 y='nm_conta',
@@ -3094,11 +5382,10 @@ elif pagina == "🗂️ Plano de Contas":
                 color='total_saldo_bilhoes',
                 color_continuous_scale='Blues',
                 labels={'qtd_empresas_usam': 'Quantidade de Empresas', 'nm_conta': 'Conta'},
-                hover_data=['cd_conta', 'descricao_grupo_balanco']
+                hover_data=['cd_conta', 'descricao_grupo_balanco'],
+                layout=dict(height=700),
+                ajustes=[('update_yaxes', dict(tickfont=dict(size=9)))]
             )
-            fig.update_layout(height=700)
-            fig.update_yaxes(tickfont=dict(size=9))
-            st.plotly_chart(fig, use_container_width=True)
         
         with col2:
             st.markdown("### 💰 Top 20 Maiores Saldos Totais")
@@ -3110,7 +5397,8 @@ elif pagina == "🗂️ Plano de Contas":
             
             df_top_saldo = df_filtrado.nlargest(20, 'total_saldo_bilhoes')
             
-            fig = px.bar(
+            exibir_grafico(
+                'plano_de_contas_top_20_maiores_saldos_totais', px.bar,
                 df_top_saldo,
                 x='total_saldo_bilhoes',
                 y='nm_conta',
@@ -3118,11 +5406,10 @@ elif pagina == "🗂️ Plano de Contas":
                 color='qtd_empresas_usam',
                 color_continuous_scale='Greens',
                 labels={'total_saldo_bilhoes': 'Saldo Total (R$ Bilhões)', 'nm_conta': 'Conta'},
-                hover_data=['cd_conta', 'descricao_grupo_balanco']
+                hover_data=['cd_conta', 'descricao_grupo_balanco'],
+                layout=dict(height=700),
+                ajustes=[('update_yaxes', dict(tickfont=dict(size=9)))]
             )
-            fig.update_layout(height=700)
-            fig.update_yaxes(tickfont=dict(size=9))
-            st.plotly_chart(fig, use_container_width=True)
         
         # Distribuições
         st.markdown("---")
@@ -3143,15 +5430,15 @@ elif pagina == "🗂️ Plano de Contas":
             grupo_counts = grupo_counts[grupo_counts['Qtd Contas'] > 0]
             
             if len(grupo_counts) > 0:
-                fig = px.pie(
+                exibir_grafico(
+                    'plano_de_contas_distribuicao_por_grupo_de_balanco', px.pie,
                     grupo_counts,
                     values='Qtd Contas',
                     names='Grupo',
                     title='Quantidade de Contas por Grupo',
-                    hole=0.4
+                    hole=0.4,
+                    layout=dict(height=400)
                 )
-                fig.update_layout(height=400)
-                st.plotly_chart(fig, use_container_width=True)
             else:
                 st.info("Sem dados de grupos disponíveis para visualização")
         
@@ -3160,58 +5447,92 @@ elif pagina == "🗂️ Plano de Contas":
             if 'nivel_conta' in df_filtrado.columns:
                 nivel_counts = df_filtrado['nivel_conta'].value_counts().sort_index()
                 
-                fig = px.bar(
+                exibir_grafico(
+                    'plano_de_contas_distribuicao_por_nivel_hierarquico', px.bar,
                     x=nivel_counts.index,
                     y=nivel_counts.values,
                     labels={'x': 'Nível', 'y': 'Quantidade de Contas'},
                     color=nivel_counts.values,
-                    color_continuous_scale='Oranges'
+                    color_continuous_scale='Oranges',
+                    layout=dict(height=400, showlegend=False)
                 )
-                fig.update_layout(height=400, showlegend=False)
-                st.plotly_chart(fig, use_container_width=True)
             else:
                 st.info("Informação de nível não disponível")
-        
+
+        # Roll-up pela hierarquia completa (closure table)
+        st.markdown("---")
+        st.markdown("### 🌳 Roll-up por Conta Sintética")
+
+        df_rollup = carregar_rollup_contas_sinteticas(engine, ano_selecionado)
+
+        if df_rollup is not None and not df_rollup.empty:
+            df_rollup['qtd_contas_analiticas'] = pd.to_numeric(df_rollup['qtd_contas_analiticas'], errors='coerce').fillna(0)
+
+            niveis_rollup = ['Todos'] + sorted(df_rollup['nivel_conta'].dropna().unique().tolist())
+            nivel_rollup = st.selectbox("Nível da conta sintética", niveis_rollup, key='nivel_rollup')
+
+            df_rollup_filtrado = df_rollup
+            if nivel_rollup != 'Todos':
+                df_rollup_filtrado = df_rollup[df_rollup['nivel_conta'] == nivel_rollup]
+
+            df_top_rollup = df_rollup_filtrado.nlargest(20, 'qtd_contas_analiticas')
+
+            exibir_grafico(
+                'plano_de_contas_rollup_hierarquico', px.bar,
+                df_top_rollup,
+                x='qtd_contas_analiticas',
+                y='nm_conta',
+                orientation='h',
+                color='qtd_empresas_usam',
+                color_continuous_scale='Purples',
+                labels={
+                    'qtd_contas_analiticas': 'Contas Analíticas Abaixo',
+                    'nm_conta': 'Conta Sintética',
+                    'qtd_empresas_usam': 'Empresas'
+                },
+                hover_data=['cd_conta', 'nivel_conta', 'profundidade_max'],
+                layout=dict(height=600),
+                ajustes=[('update_yaxes', dict(tickfont=dict(size=9)))]
+            )
+        else:
+            st.info("Hierarquia do plano de contas não disponível")
+
         # Análise de variabilidade
         st.markdown("---")
         st.markdown("### 📈 Análise de Variabilidade de Saldos")
         
-        # Calcular coeficiente de variação
-        df_filtrado['coef_variacao'] = (
-            (df_filtrado['max_saldo_milhoes'] - df_filtrado['min_saldo_milhoes']) / 
-            df_filtrado['media_saldo_milhoes'].abs()
-        ) * 100
-        
-        # ✅ Garantir tipo numérico
+        # Coeficiente de variação (desvio / |média|) calculado no carregamento
         df_filtrado['coef_variacao'] = pd.to_numeric(df_filtrado['coef_variacao'], errors='coerce').fillna(0)
         df_variabilidade = df_filtrado.nlargest(20, 'coef_variacao')
         
-        fig = go.Figure()
-        
-        fig.add_trace(go.Bar(
-            x=df_variabilidade['nm_conta'],
-            y=df_variabilidade['media_saldo_milhoes'],
-            name='Média',
-            marker_color='lightblue',
-            error_y=dict(
-                type='data',
-                symmetric=False,
-                array=df_variabilidade['max_saldo_milhoes'] - df_variabilidade['media_saldo_milhoes'],
-                arrayminus=df_variabilidade['media_saldo_milhoes'] - df_variabilidade['min_saldo_milhoes']
+        def construir_figura():
+            fig = go.Figure()
+
+            fig.add_trace(go.Bar(
+                x=df_variabilidade['nm_conta'],
+                y=df_variabilidade['media_saldo_milhoes'],
+                name='Média',
+                marker_color='lightblue',
+                error_y=dict(
+                    type='data',
+                    symmetric=False,
+                    array=df_variabilidade['max_saldo_milhoes'] - df_variabilidade['media_saldo_milhoes'],
+                    arrayminus=df_variabilidade['media_saldo_milhoes'] - df_variabilidade['min_saldo_milhoes']
+                )
+            ))
+
+            fig.update_layout(
+                title='Top 20 Contas com Maior Variabilidade de Saldos',
+                xaxis_title='Conta',
+                yaxis_title='Saldo (R$ Milhões)',
+                height=500,
+                showlegend=False
             )
-        ))
-        
-        fig.update_layout(
-            title='Top 20 Contas com Maior Variabilidade de Saldos',
-            xaxis_title='Conta',
-            yaxis_title='Saldo (R$ Milhões)',
-            height=500,
-            showlegend=False
-        )
-        
-        fig.update_xaxes(tickangle=45, tickfont=dict(size=8))
-        
-        st.plotly_chart(fig, use_container_width=True)
+
+            fig.update_xaxes(tickangle=45, tickfont=dict(size=8))
+            return fig
+
+        exibir_figura('plano_de_contas_analise_de_variabilidade_de_saldos', (df_variabilidade,), construir_figura)
         
         # Tabela detalhada
         st.markdown("---")
@@ -3220,14 +5541,14 @@ elif pagina == "🗂️ Plano de Contas":
         # Preparar dados para exibição
         df_exibir = df_filtrado[[
             'cd_conta', 'nm_conta', 'descricao_grupo_balanco', 'nivel_conta',
-            'qtd_empresas_usam', 'media_saldo_milhoes', 'min_saldo_milhoes',
-            'max_saldo_milhoes', 'total_saldo_bilhoes'
+            'qtd_empresas_usam', 'media_saldo_milhoes', 'mediana_saldo_milhoes',
+            'min_saldo_milhoes', 'max_saldo_milhoes', 'total_saldo_bilhoes', 'coef_variacao'
         ]].copy()
         
         df_exibir.columns = [
             'Código', 'Nome da Conta', 'Grupo', 'Nível',
-            'Qtd Empresas', 'Média Saldo (R$M)', 'Min Saldo (R$M)',
-            'Max Saldo (R$M)', 'Total (R$B)'
+            'Qtd Empresas', 'Média Saldo (R$M)', 'Mediana Saldo (R$M)', 'Min Saldo (R$M)',
+            'Max Saldo (R$M)', 'Total (R$B)', 'CV (%)'
         ]
         
         # Adicionar busca
@@ -3245,9 +5566,11 @@ elif pagina == "🗂️ Plano de Contas":
             df_exibir.style.format({
                 'Qtd Empresas': '{:,.0f}',
                 'Média Saldo (R$M)': '{:,.2f}',
+                'Mediana Saldo (R$M)': '{:,.2f}',
                 'Min Saldo (R$M)': '{:,.2f}',
                 'Max Saldo (R$M)': '{:,.2f}',
-                'Total (R$B)': '{:,.2f}'
+                'Total (R$B)': '{:,.2f}',
+                'CV (%)': '{:,.1f}'
             }).background_gradient(subset=['Qtd Empresas'], cmap='Blues')
               .background_gradient(subset=['Total (R$B)'], cmap='Greens'),
             use_container_width=True,
@@ -3287,6 +5610,83 @@ elif pagina == "🗂️ Plano de Contas":
                     mime="text/csv"
                 )
         
+        # Saldos por empresa das contas escolhidas (uma consulta para todas)
+        st.markdown("---")
+        st.markdown("### 🔎 Saldos por Empresa")
+
+        opcoes_contas = df_filtrado.nlargest(50, 'qtd_empresas_usam')['cd_conta'].astype(str).drop_duplicates().tolist()
+        nomes_contas = dict(zip(df_filtrado['cd_conta'].astype(str), df_filtrado['nm_conta']))
+        contas_escolhidas = st.multiselect(
+            "Contas",
+            opcoes_contas,
+            default=opcoes_contas[:5],
+            format_func=lambda conta: f"{conta} - {nomes_contas.get(conta, '')}",
+            key='contas_saldos'
+        )
+
+        if contas_escolhidas:
+            saldos_contas = carregar_saldos_contas(engine, contas_escolhidas, ano_selecionado)
+
+            if saldos_contas:
+                resumos = resumir_saldos_contas(saldos_contas)
+
+                if resumos:
+                    df_resumo_saldos = pd.DataFrame([
+                        {
+                            'Código': conta,
+                            'Nome da Conta': nomes_contas.get(conta, ''),
+                            'Empresas': dist['qtd'],
+                            'Registros': dist['qtd_registros'],
+                            'Média (R$M)': dist['media'] / 1e6,
+                            'Mediana (R$M)': dist['quantis']['p50'] / 1e6,
+                            'P5 (R$M)': dist['quantis']['p5'] / 1e6,
+                            'P95 (R$M)': dist['quantis']['p95'] / 1e6,
+                            'CV (%)': dist['desvio'] / abs(dist['media']) * 100 if dist['media'] else 0.0
+                        }
+                        for conta, dist in resumos.items()
+                    ])
+                    st.dataframe(
+                        df_resumo_saldos.style.format({
+                            'Empresas': '{:,.0f}',
+                            'Registros': '{:,.0f}',
+                            'Média (R$M)': '{:,.2f}',
+                            'Mediana (R$M)': '{:,.2f}',
+                            'P5 (R$M)': '{:,.2f}',
+                            'P95 (R$M)': '{:,.2f}',
+                            'CV (%)': '{:,.1f}'
+                        }),
+                        use_container_width=True,
+                        hide_index=True
+                    )
+
+                    distribuicoes_milhoes = {
+                        conta: {
+                            'media': dist['media'] / 1e6,
+                            'box': {chave: valor / 1e6 if chave != 'qtd_outliers' else valor for chave, valor in dist['box'].items()}
+                        }
+                        for conta, dist in resumos.items()
+                    }
+
+                    exibir_grafico(
+                        'plano_de_contas_saldos_por_empresa', criar_box_distribuicao,
+                        distribuicoes_milhoes,
+                        'Saldo de Fim de Período (R$ Milhões)',
+                        layout=dict(height=450)
+                    )
+                else:
+                    st.info("Nenhum saldo encontrado para as contas escolhidas no ano.")
+
+                if st.checkbox("Incluir todos os registros de saldo na exportação", key='exportar_linhas_saldos'):
+                    buffer_saldos = io.StringIO()
+                    for indice, (_, df_conta) in enumerate(iterar_linhas_saldos(saldos_contas)):
+                        df_conta.to_csv(buffer_saldos, index=False, header=indice == 0)
+                    st.download_button(
+                        label="Download Saldos CSV",
+                        data=buffer_saldos.getvalue(),
+                        file_name=f"saldos_contas_{ano_selecionado}.csv",
+                        mime="text/csv"
+                    )
+        
         # Insights
         st.markdown("---")
         st.markdown("### 💡 Insights")
@@ -3362,9 +5762,11 @@ elif pagina == "🔍 Indícios NEAF":
 
     # Carregar dados de score NEAF
     with st.spinner("Carregando dados de NEAF..."):
-        df_score_neaf = carregar_score_neaf(engine, limite=500)
+        df_score_neaf = carregar_score_neaf(engine, ano=ano_selecionado, limite=None)
 
     if df_score_neaf is not None and not df_score_neaf.empty:
+        st.caption(f"Scores do ano fiscal {int(df_score_neaf['ano_fiscal'].iloc[0])}: contam os indícios vigentes no ano.")
+
         # Métricas principais
         col1, col2, col3, col4 = st.columns(4)
 
@@ -3412,7 +5814,8 @@ elif pagina == "🔍 Indícios NEAF":
         with col1:
             st.markdown("### 📊 Distribuição por Classificação de Risco")
             class_counts = df_score_neaf['classificacao_risco_neaf'].value_counts()
-            fig = px.pie(
+            exibir_grafico(
+                'indicios_neaf_distribuicao_por_classificacao_de_risco', px.pie,
                 values=class_counts.values,
                 names=class_counts.index,
                 color=class_counts.index,
@@ -3422,33 +5825,34 @@ elif pagina == "🔍 Indícios NEAF":
                     'MODERADO': '#fbc02d',
                     'BAIXO': '#689f38'
                 },
-                hole=0.4
+                hole=0.4,
+                layout=dict(height=400)
             )
-            fig.update_layout(height=400)
-            st.plotly_chart(fig, use_container_width=True)
 
         with col2:
             st.markdown("### 🏭 Top 10 Setores com Mais Indícios")
             setor_indicios = df_score_neaf.groupby('setor')['qtd_total_indicios'].sum().nlargest(10)
-            fig = px.bar(
+            exibir_grafico(
+                'indicios_neaf_top_10_setores_com_mais_indicios', px.bar,
                 x=setor_indicios.values,
                 y=setor_indicios.index,
                 orientation='h',
                 color=setor_indicios.values,
                 color_continuous_scale='Reds',
-                labels={'x': 'Quantidade de Indícios', 'y': 'Setor'}
+                labels={'x': 'Quantidade de Indícios', 'y': 'Setor'},
+                layout=dict(height=400, showlegend=False)
             )
-            fig.update_layout(height=400, showlegend=False)
-            st.plotly_chart(fig, use_container_width=True)
 
         # Scatter plot
         st.markdown("---")
         st.markdown("### 🎯 Análise Multidimensional de Risco NEAF")
 
-        fig = px.scatter(
+        exibir_scatter_grande(
             df_score_neaf,
-            x='qtd_total_indicios',
-            y='qtd_tipos_indicios_distintos',
+            'qtd_total_indicios',
+            'qtd_tipos_indicios_distintos',
+            chave='neaf',
+            preservar=df_score_neaf['classificacao_risco_neaf'] == 'CRÍTICO',
             size='score_risco_neaf',
             color='classificacao_risco_neaf',
             hover_data=['nm_razao_social', 'setor', 'cd_uf'],
@@ -3462,10 +5866,121 @@ elif pagina == "🔍 Indícios NEAF":
                 'qtd_total_indicios': 'Quantidade Total de Indícios',
                 'qtd_tipos_indicios_distintos': 'Tipos Distintos de Indícios',
                 'classificacao_risco_neaf': 'Classificação'
-            }
+            },
+            layout=dict(height=500)
         )
-        fig.update_layout(height=500)
-        st.plotly_chart(fig, use_container_width=True)
+
+        # Tipos de indício (catálogo do build, já com as contagens)
+        df_tipos_indicio = carregar_tipos_indicio_neaf(engine)
+
+        if df_tipos_indicio is not None and not df_tipos_indicio.empty:
+            st.markdown("---")
+            st.markdown("### 🧾 Tipos de Indício Mais Frequentes")
+
+            df_top_tipos = df_tipos_indicio.nlargest(15, 'qtd_empresas')
+
+            exibir_grafico(
+                'indicios_neaf_tipos_de_indicio_mais_frequentes', px.bar,
+                df_top_tipos,
+                x='qtd_empresas',
+                y='descricao_indicio',
+                orientation='h',
+                color='qtd_ocorrencias',
+                color_continuous_scale='Reds',
+                labels={
+                    'qtd_empresas': 'Empresas',
+                    'descricao_indicio': 'Indício',
+                    'qtd_ocorrencias': 'Ocorrências'
+                },
+                layout=dict(height=500, yaxis={'categoryorder': 'total ascending'}),
+                ajustes=[('update_yaxes', dict(tickfont=dict(size=9)))]
+            )
+
+        # Tipos de indício que aparecem juntos (calculado uma vez por build)
+        padroes_neaf = calcular_coocorrencia_neaf(engine, versao_build)
+
+        if padroes_neaf is not None and not padroes_neaf['associacoes'].empty:
+            st.markdown("---")
+            st.markdown("### 🔗 Indícios que Aparecem Juntos")
+            st.caption(
+                f"{padroes_neaf['qtd_empresas']:,} empresas com indícios. Lift > 1: os dois tipos "
+                "aparecem juntos mais do que o esperado se fossem independentes."
+            )
+
+            col1, col2 = st.columns([1, 2])
+            with col1:
+                qtd_tipos_heatmap = st.slider("Tipos no mapa de calor", 5, 40, 20, key='qtd_tipos_coocorrencia')
+            with col2:
+                min_empresas_par = st.number_input(
+                    "Mínimo de empresas por par", min_value=1, value=SUPORTE_MINIMO_ITEMSETS, key='min_empresas_par'
+                )
+
+            tipos_heatmap = padroes_neaf['tipos'].nlargest(qtd_tipos_heatmap, 'qtd_empresas')
+            posicoes = tipos_heatmap.index.to_numpy()
+            qtd_tipos = tipos_heatmap['qtd_empresas'].to_numpy(dtype=float)
+            matriz = padroes_neaf['coocorrencia'][np.ix_(posicoes, posicoes)].astype(float)
+            lift_heatmap = matriz * padroes_neaf['qtd_empresas'] / np.outer(qtd_tipos, qtd_tipos)
+            np.fill_diagonal(lift_heatmap, np.nan)
+            rotulos = [texto if len(texto) <= 40 else texto[:37] + '...' for texto in tipos_heatmap['indicio']]
+
+            def construir_figura():
+                fig = go.Figure(go.Heatmap(
+                    z=lift_heatmap,
+                    x=rotulos,
+                    y=rotulos,
+                    customdata=matriz,
+                    colorscale='Reds',
+                    colorbar=dict(title='Lift'),
+                    hovertemplate='%{y}<br>%{x}<br>Lift: %{z:.2f}<br>Empresas: %{customdata:,.0f}<extra></extra>'
+                ))
+                fig.update_layout(height=650)
+                fig.update_xaxes(tickangle=45, tickfont=dict(size=8))
+                fig.update_yaxes(tickfont=dict(size=8), autorange='reversed')
+                return fig
+
+            exibir_figura('indicios_neaf_coocorrencia_lift', (lift_heatmap, matriz, rotulos), construir_figura)
+
+            col1, col2 = st.columns(2)
+            with col1:
+                st.markdown("#### Associações (maior lift)")
+                df_associacoes = padroes_neaf['associacoes']
+                df_associacoes = df_associacoes[df_associacoes['qtd_empresas'] >= min_empresas_par].head(200)
+                df_associacoes = df_associacoes.rename(columns={
+                    'indicio_a': 'Indício A',
+                    'indicio_b': 'Indício B',
+                    'qtd_empresas': 'Empresas',
+                    'suporte': 'Suporte',
+                    'confianca_a_b': 'Confiança A→B',
+                    'confianca_b_a': 'Confiança B→A',
+                    'lift': 'Lift'
+                })
+                st.dataframe(
+                    df_associacoes.style.format({
+                        'Empresas': '{:,.0f}',
+                        'Suporte': '{:.2%}',
+                        'Confiança A→B': '{:.1%}',
+                        'Confiança B→A': '{:.1%}',
+                        'Lift': '{:.2f}'
+                    }),
+                    use_container_width=True,
+                    hide_index=True,
+                    height=400
+                )
+            with col2:
+                st.markdown("#### Conjuntos frequentes")
+                df_itemsets = padroes_neaf['itemsets']
+                df_itemsets = df_itemsets[df_itemsets['tamanho'] > 1].head(200).rename(columns={
+                    'indicios': 'Indícios',
+                    'qtd_empresas': 'Empresas',
+                    'tamanho': 'Tipos',
+                    'suporte': 'Suporte'
+                })
+                st.dataframe(
+                    df_itemsets.style.format({'Empresas': '{:,.0f}', 'Suporte': '{:.2%}'}),
+                    use_container_width=True,
+                    hide_index=True,
+                    height=400
+                )
 
         # Tabela detalhada
         st.markdown("---")
@@ -3497,8 +6012,10 @@ elif pagina == "🔍 Indícios NEAF":
         df_filtrado_neaf = df_filtrado_neaf[df_filtrado_neaf['qtd_total_indicios'] >= min_indicios]
 
         st.info(f"**{len(df_filtrado_neaf)} empresas** encontradas com os filtros aplicados")
+        if len(df_filtrado_neaf) > 1000:
+            st.caption("Tabela limitada às 1.000 empresas de maior score; a exportação inclui todas.")
 
-        df_exibir = df_filtrado_neaf[[
+        df_exibir = df_filtrado_neaf.head(1000)[[
             'nm_razao_social', 'cnpj', 'setor', 'cd_uf',
             'qtd_total_indicios', 'qtd_tipos_indicios_distintos',
             'score_risco_neaf', 'classificacao_risco_neaf'
@@ -3529,6 +6046,30 @@ elif pagina == "🔍 Indícios NEAF":
                 file_name=f"neaf_indicios_{datetime.now().strftime('%Y%m%d')}.csv",
                 mime="text/csv"
             )
+
+        # Indícios de uma empresa (resumo por tipo, sem agrupar na consulta)
+        st.markdown("---")
+        st.markdown("### 🔎 Indícios por Empresa")
+
+        if not df_filtrado_neaf.empty:
+            empresas_neaf = df_filtrado_neaf.head(1000)
+            nomes_neaf = dict(zip(empresas_neaf['cnpj'], empresas_neaf['nm_razao_social']))
+            cnpj_neaf = st.selectbox(
+                "Empresa",
+                list(nomes_neaf),
+                format_func=lambda cnpj: f"{cnpj} - {nomes_neaf[cnpj]}",
+                key='empresa_indicios_neaf'
+            )
+            df_indicios_empresa = carregar_indicios_neaf(engine, cnpj_neaf, limite=None)
+
+            if df_indicios_empresa is not None and not df_indicios_empresa.empty:
+                df_indicios_exibir = df_indicios_empresa[[
+                    'descricao_indicio', 'qtd_ocorrencias', 'qtd_complementos_distintos', 'complementos'
+                ]].copy()
+                df_indicios_exibir.columns = ['Indício', 'Ocorrências', 'Complementos Distintos', 'Complementos']
+                st.dataframe(df_indicios_exibir, use_container_width=True, hide_index=True)
+            else:
+                st.info("Nenhum indício detalhado para a empresa.")
     else:
         st.warning("Não há dados de NEAF disponíveis ou a tabela ainda não foi populada.")
 
@@ -3550,16 +6091,14 @@ elif pagina == "⚖️ Inconsistências Contábeis":
 
     st.markdown("---")
 
-    # Tabs para diferentes análises
-    tab1, tab2 = st.tabs(["⚖️ Equação Patrimonial", "📊 Variações de Contas"])
-
-    with tab1:
-        st.markdown("### Inconsistências na Equação Patrimonial")
-        st.info("**Regra Básica:** Ativo Total = Passivo Total + Patrimônio Líquido")
-
-        with st.spinner("Carregando inconsistências..."):
-            df_equacao = carregar_inconsistencias_equacao(engine, ano=ano_selecionado, limite=500)
+    # Submeter as duas consultas de uma vez; cada aba é desenhada quando a sua termina
+    futuros = submeter_consultas({
+        'equacao': (carregar_inconsistencias_equacao, (engine,), {'ano': ano_selecionado, 'limite': 500}),
+        'variacoes': (carregar_inconsistencias_variacoes, (engine,), {'ano': ano_selecionado, 'limite': 500})
+    })
 
+    def exibir_inconsistencias_equacao(df_equacao):
+        """Aba da equação patrimonial."""
         if df_equacao is not None and not df_equacao.empty:
             # Métricas
             col1, col2, col3, col4 = st.columns(4)
@@ -3588,7 +6127,8 @@ elif pagina == "⚖️ Inconsistências Contábeis":
             with col1:
                 st.markdown("#### Distribuição por Classificação")
                 class_counts = df_equacao['classificacao_inconsistencia'].value_counts()
-                fig = px.pie(
+                exibir_grafico(
+                    'inconsistencias_contabeis_distribuicao_por_classificacao', px.pie,
                     values=class_counts.values,
                     names=class_counts.index,
                     color=class_counts.index,
@@ -3597,28 +6137,27 @@ elif pagina == "⚖️ Inconsistências Contábeis":
                         'Alta': '#f57c00',
                         'Moderada': '#fbc02d',
                         'Diferença Mínima': '#689f38'
-                    }
+                    },
+                    layout=dict(height=350)
                 )
-                fig.update_layout(height=350)
-                st.plotly_chart(fig, use_container_width=True)
 
             with col2:
                 st.markdown("#### Top 15 por Diferença Absoluta")
                 df_equacao['diferenca_absoluta'] = pd.to_numeric(df_equacao['diferenca_absoluta'], errors='coerce').fillna(0)
                 df_top = df_equacao.nlargest(15, 'diferenca_absoluta')
 
-                fig = px.bar(
+                exibir_grafico(
+                    'inconsistencias_contabeis_top_15_por_diferenca_absoluta', px.bar,
                     df_top,
                     x='diferenca_absoluta',
                     y='nm_razao_social',
                     orientation='h',
                     color='score_risco_equacao',
                     color_continuous_scale='Reds',
-                    labels={'diferenca_absoluta': 'Diferença (R$)', 'nm_razao_social': 'Empresa'}
+                    labels={'diferenca_absoluta': 'Diferença (R$)', 'nm_razao_social': 'Empresa'},
+                    layout=dict(height=500),
+                    ajustes=[('update_yaxes', dict(tickfont=dict(size=8)))]
                 )
-                fig.update_layout(height=500)
-                fig.update_yaxes(tickfont=dict(size=8))
-                st.plotly_chart(fig, use_container_width=True)
 
             # Tabela
             st.markdown("---")
@@ -3651,13 +6190,8 @@ elif pagina == "⚖️ Inconsistências Contábeis":
         else:
             st.success("✅ Nenhuma inconsistência significativa na equação patrimonial encontrada!")
 
-    with tab2:
-        st.markdown("### Variações Anômalas de Contas")
-        st.info("**Detecta:** Mudanças de mais de 100% ou reduções acima de 50% entre anos")
-
-        with st.spinner("Carregando variações anômalas..."):
-            df_variacoes = carregar_inconsistencias_variacoes(engine, ano=ano_selecionado, limite=500)
-
+    def exibir_variacoes_anomalas(df_variacoes):
+        """Aba das variações anômalas de contas."""
         if df_variacoes is not None and not df_variacoes.empty:
             # Métricas
             col1, col2, col3, col4 = st.columns(4)
@@ -3686,7 +6220,8 @@ elif pagina == "⚖️ Inconsistências Contábeis":
             with col1:
                 st.markdown("#### Distribuição por Classificação")
                 class_counts = df_variacoes['classificacao_variacao'].value_counts()
-                fig = px.pie(
+                exibir_grafico(
+                    'inconsistencias_contabeis_distribuicao_por_classificacao_2', px.pie,
                     values=class_counts.values,
                     names=class_counts.index,
                     color=class_counts.index,
@@ -3694,24 +6229,23 @@ elif pagina == "⚖️ Inconsistências Contábeis":
                         'Variação Extrema': '#d32f2f',
                         'Variação Muito Alta': '#f57c00',
                         'Variação Alta': '#fbc02d'
-                    }
+                    },
+                    layout=dict(height=350)
                 )
-                fig.update_layout(height=350)
-                st.plotly_chart(fig, use_container_width=True)
 
             with col2:
                 st.markdown("#### Distribuição por Setor")
                 setor_counts = df_variacoes['setor'].value_counts().head(10)
-                fig = px.bar(
+                exibir_grafico(
+                    'inconsistencias_contabeis_distribuicao_por_setor', px.bar,
                     x=setor_counts.values,
                     y=setor_counts.index,
                     orientation='h',
                     color=setor_counts.values,
                     color_continuous_scale='OrRd',
-                    labels={'x': 'Quantidade', 'y': 'Setor'}
+                    labels={'x': 'Quantidade', 'y': 'Setor'},
+                    layout=dict(height=350, showlegend=False)
                 )
-                fig.update_layout(height=350, showlegend=False)
-                st.plotly_chart(fig, use_container_width=True)
 
             # Tabela
             st.markdown("---")
@@ -3744,6 +6278,24 @@ elif pagina == "⚖️ Inconsistências Contábeis":
         else:
             st.success("✅ Nenhuma variação anômala significativa encontrada!")
 
+    # Tabs para diferentes análises
+    tab1, tab2 = st.tabs(["⚖️ Equação Patrimonial", "📊 Variações de Contas"])
+
+    with tab1:
+        st.markdown("### Inconsistências na Equação Patrimonial")
+        st.info("**Regra Básica:** Ativo Total = Passivo Total + Patrimônio Líquido")
+        espaco_equacao = secao_pendente("Carregando inconsistências...")
+
+    with tab2:
+        st.markdown("### Variações Anômalas de Contas")
+        st.info("**Detecta:** Mudanças de mais de 100% ou reduções acima de 50% entre anos")
+        espaco_variacoes = secao_pendente("Carregando variações anômalas...")
+
+    renderizar_progressivo(futuros, [
+        (espaco_equacao, ['equacao'], exibir_inconsistencias_equacao),
+        (espaco_variacoes, ['variacoes'], exibir_variacoes_anomalas)
+    ])
+
 # ---------------------------------------------------------------------------
 # PÁGINA: BENCHMARK SETORIAL
 # ---------------------------------------------------------------------------
@@ -3855,45 +6407,46 @@ elif pagina == "📈 Benchmark Setorial":
             df_benchmark[coluna_bench] = pd.to_numeric(df_benchmark[coluna_bench], errors='coerce').fillna(0)
             df_top_bench = df_benchmark.nlargest(15, coluna_bench)
 
-            fig = px.bar(
+            exibir_grafico(
+                'benchmark_setorial_top_15_setores', px.bar,
                 df_top_bench,
                 x=coluna_bench,
                 y='cnae_divisao_descricao',
                 orientation='h',
                 color=coluna_bench,
                 color_continuous_scale='Viridis',
-                labels={coluna_bench: indicador_bench, 'cnae_divisao_descricao': 'Setor'}
+                labels={coluna_bench: indicador_bench, 'cnae_divisao_descricao': 'Setor'},
+                layout=dict(height=600, showlegend=False),
+                ajustes=[('update_yaxes', dict(tickfont=dict(size=9)))]
             )
-            fig.update_layout(height=600, showlegend=False)
-            fig.update_yaxes(tickfont=dict(size=9))
-            st.plotly_chart(fig, use_container_width=True)
 
         with col2:
             st.markdown("### 🏭 Empresas por Setor (Top 15)")
             df_benchmark['qtd_empresas_setor'] = pd.to_numeric(df_benchmark['qtd_empresas_setor'], errors='coerce').fillna(0)
             df_top_emp = df_benchmark.nlargest(15, 'qtd_empresas_setor')
 
-            fig = px.bar(
+            exibir_grafico(
+                'benchmark_setorial_empresas_por_setor_top_15', px.bar,
                 df_top_emp,
                 x='qtd_empresas_setor',
                 y='cnae_divisao_descricao',
                 orientation='h',
                 color='qtd_empresas_setor',
                 color_continuous_scale='Blues',
-                labels={'qtd_empresas_setor': 'Quantidade de Empresas', 'cnae_divisao_descricao': 'Setor'}
+                labels={'qtd_empresas_setor': 'Quantidade de Empresas', 'cnae_divisao_descricao': 'Setor'},
+                layout=dict(height=600, showlegend=False),
+                ajustes=[('update_yaxes', dict(tickfont=dict(size=9)))]
             )
-            fig.update_layout(height=600, showlegend=False)
-            fig.update_yaxes(tickfont=dict(size=9))
-            st.plotly_chart(fig, use_container_width=True)
 
         # Scatter comparativo
         st.markdown("---")
         st.markdown("### 📊 Análise Comparativa de Setores")
 
-        fig = px.scatter(
+        exibir_scatter_grande(
             df_benchmark,
-            x='media_liquidez_corrente_setor',
-            y='media_margem_liquida_setor',
+            'media_liquidez_corrente_setor',
+            'media_margem_liquida_setor',
+            chave='benchmark',
             size='qtd_empresas_setor',
             color='media_roe_setor',
             hover_name='cnae_divisao_descricao',
@@ -3902,12 +6455,10 @@ elif pagina == "📈 Benchmark Setorial":
                 'media_liquidez_corrente_setor': 'Liquidez Corrente Média',
                 'media_margem_liquida_setor': 'Margem Líquida Média (%)',
                 'media_roe_setor': 'ROE Médio (%)'
-            }
+            },
+            linhas_referencia=[('v', 1, "Liquidez = 1"), ('h', 0, "Margem = 0%")],
+            layout=dict(height=600)
         )
-        fig.add_vline(x=1, line_dash="dash", line_color="gray", annotation_text="Liquidez = 1")
-        fig.add_hline(y=0, line_dash="dash", line_color="gray", annotation_text="Margem = 0%")
-        fig.update_layout(height=600)
-        st.plotly_chart(fig, use_container_width=True)
 
         # Tabela completa
         st.markdown("---")
@@ -3971,6 +6522,182 @@ elif pagina == "📈 Benchmark Setorial":
         - Tente selecionar um ano diferente na barra lateral
         """)
 
+# -----------------------------------------------------------------------------
+# PÁGINA: OPERAÇÕES DO BUILD
+# -----------------------------------------------------------------------------
+elif pagina == "🛠️ Operações do Build":
+    st.markdown("<h1 class='main-header'>🛠️ Operações do Build</h1>", unsafe_allow_html=True)
+
+    st.markdown("### Telemetria das etapas de criação das tabelas ECD")
+
+    st.markdown(criar_info_box(
+        "Sobre esta página",
+        "Cada etapa dos scripts de criação grava duração, linhas de entrada e saída, CNPJs distintos e taxa de nulos em ecd_build_metrics. Use a evolução das durações para identificar etapas que estão crescendo antes que estourem a janela noturna."
+    ), unsafe_allow_html=True)
+
+    qtd_builds = st.selectbox("Quantidade de builds", [10, 30, 90], index=1)
+
+    with st.spinner("Carregando telemetria..."):
+        df_metricas = carregar_metricas_build(engine, qtd_builds)
+
+    if df_metricas is not None and not df_metricas.empty:
+        ultimo_build = df_metricas['id_build'].max()
+        df_ultimo = df_metricas[df_metricas['id_build'] == ultimo_build]
+
+        col1, col2, col3, col4 = st.columns(4)
+
+        with col1:
+            st.markdown(criar_card_com_tooltip(
+                f"{ultimo_build}",
+                "Último Build",
+                "Identificador do build mais recente (data e hora de início). O último build concluído é usado como versão dos dados do cache.",
+                "metric-card"
+            ), unsafe_allow_html=True)
+
+        with col2:
+            duracao_total = df_ultimo['duracao_min'].sum()
+            st.markdown(criar_card_com_tooltip(
+                f"{duracao_total:.0f} min",
+                "Duração Total",
+                "Soma das durações de todas as etapas do último build.",
+                "metric-card-blue"
+            ), unsafe_allow_html=True)
+
+        with col3:
+            etapa_lenta = df_ultimo.loc[df_ultimo['duracao_min'].idxmax()]
+            st.markdown(criar_card_com_tooltip(
+                f"{etapa_lenta['duracao_min']:.0f} min",
+                "Etapa Mais Lenta",
+                f"Etapa com maior duração no último build: {etapa_lenta['etapa']}",
+                "metric-card-yellow"
+            ), unsafe_allow_html=True)
+
+        with col4:
+            qtd_builds_carregados = df_metricas['id_build'].nunique()
+            st.markdown(criar_card_com_tooltip(
+                f"{qtd_builds_carregados}",
+                "Builds Analisados",
+                "Quantidade de builds com telemetria considerados nos gráficos abaixo.",
+                "metric-card-green"
+            ), unsafe_allow_html=True)
+
+        st.markdown("---")
+
+        # Evolução das durações
+        st.markdown("### ⏱️ Duração por Etapa ao Longo dos Builds")
+        exibir_grafico(
+            'operacoes_do_build_duracao_por_etapa_ao_longo_dos_builds', px.line,
+            df_metricas,
+            x='id_build',
+            y='duracao_min',
+            color='etapa',
+            markers=True,
+            labels={'id_build': 'Build', 'duracao_min': 'Duração (min)', 'etapa': 'Etapa'},
+            layout=dict(height=500),
+            ajustes=[('update_xaxes', dict(type='category'))]
+        )
+
+        col1, col2 = st.columns(2)
+
+        with col1:
+            st.markdown("### 📊 Duração no Último Build")
+            exibir_grafico(
+                'operacoes_do_build_duracao_no_ultimo_build', px.bar,
+                df_ultimo,
+                x='duracao_min',
+                y='etapa',
+                orientation='h',
+                color='duracao_min',
+                color_continuous_scale='Reds',
+                labels={'duracao_min': 'Duração (min)', 'etapa': 'Etapa'},
+                layout=dict(height=500, showlegend=False)
+            )
+
+        with col2:
+            st.markdown("### 🔢 Linhas Gravadas por Etapa")
+            exibir_grafico(
+                'operacoes_do_build_linhas_gravadas_por_etapa', px.line,
+                df_metricas,
+                x='id_build',
+                y='linhas_saida',
+                color='etapa',
+                markers=True,
+                labels={'id_build': 'Build', 'linhas_saida': 'Linhas', 'etapa': 'Etapa'},
+                layout=dict(height=500),
+                ajustes=[('update_xaxes', dict(type='category'))]
+            )
+
+        # Qualidade e volume do último build
+        st.markdown("---")
+        st.markdown("### 📋 Detalhe do Último Build")
+
+        df_tamanhos = carregar_catalogo_tabelas(engine, versao_build)
+        df_exibir = df_ultimo.copy()
+        if df_tamanhos is not None and not df_tamanhos.empty:
+            df_exibir = df_exibir.merge(
+                df_tamanhos[['tabela', 'bytes']], left_on='etapa', right_on='tabela', how='left'
+            )
+            df_exibir['mb_gravados'] = pd.to_numeric(df_exibir['bytes'], errors='coerce') / (1024 ** 2)
+        else:
+            df_exibir['mb_gravados'] = np.nan
+
+        df_exibir = df_exibir[[
+            'etapa', 'duracao_min', 'linhas_entrada', 'linhas_saida', 'qtd_cnpjs',
+            'taxa_nulos_cnpj', 'coluna_chave', 'taxa_nulos_chave', 'mb_gravados'
+        ]]
+        df_exibir['taxa_nulos_cnpj'] = pd.to_numeric(df_exibir['taxa_nulos_cnpj'], errors='coerce') * 100
+        df_exibir['taxa_nulos_chave'] = pd.to_numeric(df_exibir['taxa_nulos_chave'], errors='coerce') * 100
+        df_exibir.columns = [
+            'Etapa', 'Duração (min)', 'Linhas Entrada', 'Linhas Saída', 'CNPJs',
+            'Nulos CNPJ %', 'Coluna Chave', 'Nulos Chave %', 'MB Gravados'
+        ]
+
+        df_exibir = limpar_dataframe_para_exibicao(df_exibir)
+        st.dataframe(
+            df_exibir.style.format({
+                'Duração (min)': '{:.1f}',
+                'Linhas Entrada': '{:,.0f}',
+                'Linhas Saída': '{:,.0f}',
+                'CNPJs': '{:,.0f}',
+                'Nulos CNPJ %': '{:.2f}',
+                'Nulos Chave %': '{:.2f}',
+                'MB Gravados': '{:,.1f}'
+            }, na_rep='-').background_gradient(subset=['Nulos Chave %'], cmap='Reds', vmin=0, vmax=50),
+            use_container_width=True,
+            height=500
+        )
+
+        # Catálogo consultado pelos carregadores com fallback
+        if df_tamanhos is not None and not df_tamanhos.empty:
+            st.markdown("### 📦 Disponibilidade das Tabelas")
+            indisponiveis = df_tamanhos[~df_tamanhos['com_dados']]['tabela'].tolist()
+            if indisponiveis:
+                st.warning(f"Tabelas ausentes ou vazias (carregadores usam fallback): {', '.join(indisponiveis)}")
+            else:
+                st.success(f"✅ Todas as {len(df_tamanhos)} tabelas do build estão disponíveis")
+
+        # Snapshots usados pela consulta pontual de empresas
+        st.markdown("### 💾 Snapshots Locais por Empresa")
+        partes_snapshot = status_snapshot_empresas(versao_build)
+        situacao = situacao_snapshot(versao_build)
+        if len(partes_snapshot) == len(PARTES_EMPRESA):
+            st.success(f"✅ Snapshots do build {versao_build} gerados: o detalhamento de empresas não consulta o Impala")
+        elif situacao['erro']:
+            proxima = datetime.fromtimestamp(situacao['proxima_tentativa']).strftime('%d/%m %H:%M')
+            st.error(
+                f"❌ Falha ao gerar os snapshots do build {versao_build} ({situacao['falhas']} tentativa(s)): "
+                f"{situacao['erro']}. Próxima tentativa a partir de {proxima}; até lá as consultas vão ao Impala"
+            )
+        else:
+            st.info("⏳ Snapshots do build atual ainda não gerados (geração em segundo plano); enquanto isso as consultas vão ao Impala")
+    else:
+        st.warning("""
+        **Não há telemetria de build disponível.**
+
+        A tabela ecd_build_metrics é preenchida pelos scripts de criação (Partes 1 e 2).
+        Execute um build completo para popular esta página.
+        """)
+
 # =============================================================================
 # 11. RODAPÉ
 # =============================================================================